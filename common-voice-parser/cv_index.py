@@ -0,0 +1,228 @@
+import argparse
+import os
+import sys
+from array import array
+
+import numpy as np
+
+'''
+A compact, columnar index of a Common Voice validated.tsv.
+
+Reading the .tsv and checking every sentence against the known words takes
+minutes for zh-CN. Instead, the .tsv is streamed once and turned into a few
+NumPy arrays, which are cached next to it (validated.tsv.index.npz):
+- clip names and sentences as UTF-8 blobs plus offsets
+- up votes, sentence lengths and a gender code per row
+- the distinct characters of every sentence as IDs into a character
+  vocabulary, stored as one flat array plus per-sentence offsets
+
+Re-filtering with a bigger known words list is then a couple of vectorized
+operations over these arrays (see unknown_counts). SentenceIndex adds an
+inverted index on top for "comprehensible input" queries.
+
+Usage:
+python cv_index.py cv-corpus/zh-CN/validated.tsv known_words.txt --max_unknown 1 --top 20 --unlock 猫 狗
+'''
+
+INDEX_CACHE_SUFFIX = '.index.npz'
+# Columns we need from validated.tsv. Older releases don't have a header we can
+# rely on, so these positions are used when a column name isn't found.
+DEFAULT_COLUMNS = {'path': 1, 'sentence': 2, 'up_votes': 3, 'gender': 6}
+
+# Loads the index for cv_index, building (and caching) it if the cache is missing or stale
+def load_index(cv_index, cache_file=None, verbose=False):
+    cache_file = cache_file or cv_index + INDEX_CACHE_SUFFIX
+    # np.savez appends .npz to names that don't already end in it, so look for the name it writes
+    if not cache_file.endswith('.npz'):
+        cache_file += '.npz'
+    source_stat = os.stat(cv_index)
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as cached:
+            index = {name: cached[name] for name in cached.files}
+        if int(index['source_size']) == source_stat.st_size and int(index['source_mtime_ns']) == source_stat.st_mtime_ns:
+            return index
+    
+    if verbose:
+        print(f'Building index of {cv_index}', flush=True)
+    index = build_index(cv_index)
+    index['source_size'] = np.int64(source_stat.st_size)
+    index['source_mtime_ns'] = np.int64(source_stat.st_mtime_ns)
+    np.savez(cache_file, **index)
+    return index
+
+# Streams validated.tsv row by row into the columnar index
+def build_index(cv_index):
+    clip_blob = bytearray()
+    clip_offsets = array('q', [0])
+    sentence_blob = bytearray()
+    sentence_offsets = array('q', [0])
+    sentence_lengths = array('i')
+    upvotes = array('i')
+    genders = array('B')
+    gender_codes = {}
+    char_ids = array('i')
+    char_offsets = array('q', [0])
+    vocabulary = {}
+
+    with open(cv_index, 'r', encoding='utf-8', newline='') as index_file:
+        header = index_file.readline().rstrip('\r\n').split('\t')
+        columns = {name: header.index(name) if name in header else position for name, position in DEFAULT_COLUMNS.items()}
+
+        for line in index_file:
+            values = line.rstrip('\r\n').split('\t')
+            if len(values) <= max(columns.values()):
+                continue
+            sentence = values[columns['sentence']]
+
+            clip_blob += values[columns['path']].encode('utf-8')
+            clip_offsets.append(len(clip_blob))
+            sentence_blob += sentence.encode('utf-8')
+            sentence_offsets.append(len(sentence_blob))
+            sentence_lengths.append(len(sentence))
+            upvotes.append(int(values[columns['up_votes']] or 0))
+            genders.append(gender_codes.setdefault(values[columns['gender']], len(gender_codes)))
+
+            for character in set(sentence):
+                char_ids.append(vocabulary.setdefault(character, len(vocabulary)))
+            char_offsets.append(len(char_ids))
+
+    return {
+        'clip_blob': np.frombuffer(bytes(clip_blob), dtype=np.uint8),
+        'clip_offsets': np.array(clip_offsets, dtype=np.int64),
+        'sentence_blob': np.frombuffer(bytes(sentence_blob), dtype=np.uint8),
+        'sentence_offsets': np.array(sentence_offsets, dtype=np.int64),
+        'sentence_lengths': np.array(sentence_lengths, dtype=np.int32),
+        'upvotes': np.array(upvotes, dtype=np.int32),
+        'genders': np.array(genders, dtype=np.uint8),
+        'gender_names': np.array(list(gender_codes), dtype=str),
+        'char_ids': np.array(char_ids, dtype=np.int32),
+        'char_offsets': np.array(char_offsets, dtype=np.int64),
+        'vocabulary': np.array(list(vocabulary), dtype=str)
+    }
+
+def clip_name(index, row):
+    return bytes(index['clip_blob'][index['clip_offsets'][row]: index['clip_offsets'][row+1]]).decode('utf-8')
+
+def sentence_text(index, row):
+    return bytes(index['sentence_blob'][index['sentence_offsets'][row]: index['sentence_offsets'][row+1]]).decode('utf-8')
+
+# Boolean mask over the index's character vocabulary: True where the character is known
+def known_mask(index, known_characters):
+    return np.fromiter((character in known_characters for character in index['vocabulary']), 
+                       dtype=bool, count=len(index['vocabulary']))
+
+# Number of distinct unknown characters in every sentence of the index
+def unknown_counts(index, known_characters):
+    unknown = ~known_mask(index, known_characters)[index['char_ids']]
+    cumulative = np.concatenate(([0], np.cumsum(unknown, dtype=np.int64)))
+    return (cumulative[index['char_offsets'][1:]] - cumulative[index['char_offsets'][:-1]]).astype(np.int32)
+
+# Rows matching the given genders (empty string = not specified)
+def gender_mask(index, genders):
+    codes = [code for code, name in enumerate(index['gender_names']) if name in genders]
+    return np.isin(index['genders'], codes)
+
+# Rows that pass the basic clip filters used by parse_common_voice
+def filter_mask(index, genders=None, min_upvotes=0, min_sentence_len=0):
+    mask = (index['upvotes'] >= min_upvotes) & (index['sentence_lengths'] >= min_sentence_len)
+    if genders is not None:
+        mask &= gender_mask(index, genders)
+    return mask
+
+'''
+SentenceIndex answers comprehensible-input questions over a whole corpus:
+- sentences(max_unknown): sentences with at most N unknown characters
+- unlocked_by(characters): sentences that become fully known by learning them
+- top_unlocking_characters(n): which single characters unlock the most
+  sentences that are currently one character away
+
+It keeps an inverted index from each character to the sentences containing it
+(CSR layout: postings[posting_offsets[c]: posting_offsets[c+1]]) and the
+number of distinct unknown characters per sentence. learn() only touches the
+sentences that contain the newly known characters, so growing the known words
+list never rescans the corpus.
+
+An optional row mask (see filter_mask) restricts every query, e.g. to
+well-voted male clips.
+'''
+class SentenceIndex:
+    def __init__(self, index, known_characters=(), mask=None):
+        self.index = index
+        self.mask = mask if mask is not None else np.ones(len(index['upvotes']), dtype=bool)
+        self.character_ids = {character: i for i, character in enumerate(index['vocabulary'])}
+
+        vocabulary_size = len(index['vocabulary'])
+        self.entry_rows = np.repeat(np.arange(len(index['upvotes']), dtype=np.int32), np.diff(index['char_offsets']))
+        self.postings = self.entry_rows[np.argsort(index['char_ids'], kind='stable')]
+        self.posting_offsets = np.concatenate(([0], np.cumsum(np.bincount(index['char_ids'], minlength=vocabulary_size))))
+
+        self.known = known_mask(index, set(known_characters))
+        self.unknown = unknown_counts(index, set(known_characters))
+
+    # Rows of the sentences that contain a character
+    def rows_with(self, character):
+        character_id = self.character_ids.get(character)
+        if character_id is None:
+            return np.zeros(0, dtype=np.int32)
+        return self.postings[self.posting_offsets[character_id]: self.posting_offsets[character_id+1]]
+
+    # Marks characters as known, updating the unknown counts of only the sentences that contain them
+    def learn(self, characters):
+        for character in set(characters):
+            character_id = self.character_ids.get(character)
+            if character_id is None or self.known[character_id]:
+                continue
+            self.known[character_id] = True
+            self.unknown[self.rows_with(character)] -= 1
+
+    # Rows with at most max_unknown unknown characters, fewest unknown first
+    def sentences(self, max_unknown=0):
+        rows = np.flatnonzero(self.mask & (self.unknown <= max_unknown))
+        return rows[np.argsort(self.unknown[rows], kind='stable')]
+
+    # Rows that would become fully known by learning characters (and aren't already)
+    def unlocked_by(self, characters):
+        new_counts = np.zeros(len(self.unknown), dtype=np.int32)
+        for character in set(characters):
+            character_id = self.character_ids.get(character)
+            if character_id is not None and not self.known[character_id]:
+                new_counts[self.rows_with(character)] += 1
+        return np.flatnonzero(self.mask & (new_counts > 0) & (new_counts == self.unknown))
+
+    # [(character, sentences unlocked)] for the n characters that would unlock the most sentences on their own
+    def top_unlocking_characters(self, n=10):
+        one_away = self.mask & (self.unknown == 1)
+        entries = one_away[self.entry_rows] & ~self.known[self.index['char_ids']]
+        unlocks = np.bincount(self.index['char_ids'][entries], minlength=len(self.known))
+        top = np.argsort(unlocks, kind='stable')[::-1][:n]
+        return [(str(self.index['vocabulary'][i]), int(unlocks[i])) for i in top if unlocks[i] > 0]
+
+if __name__ == '__main__':
+    sys.stdout.reconfigure(encoding='utf-8')
+    parser = argparse.ArgumentParser(description='Query a Common Voice corpus for comprehensible sentences.')
+    parser.add_argument('cv_index', help='Path to validated.tsv')
+    parser.add_argument('known_words_file', help='Known words, one per line')
+    parser.add_argument('--max_unknown', type=int, default=1)
+    parser.add_argument('--limit', type=int, default=20, help='Sentences to print')
+    parser.add_argument('--top', type=int, default=20, help='Characters to print by sentences unlocked')
+    parser.add_argument('--unlock', nargs='*', default=[], help='Characters to check the unlocks of')
+    args = parser.parse_args()
+
+    with open(args.known_words_file, 'r', encoding='utf-8') as fp:
+        known_words = [word.rstrip('\n') for word in fp]
+    sentence_index = SentenceIndex(load_index(args.cv_index, verbose=True), known_words)
+
+    rows = sentence_index.sentences(args.max_unknown)
+    print(f'{len(rows)} sentences with at most {args.max_unknown} unknown characters')
+    for row in rows[:args.limit]:
+        print(f'\t{sentence_index.unknown[row]}\t{sentence_text(sentence_index.index, row)}')
+
+    print('Top characters by sentences unlocked:')
+    for character, unlocks in sentence_index.top_unlocking_characters(args.top):
+        print(f'\t{character}\t{unlocks}')
+
+    if args.unlock:
+        rows = sentence_index.unlocked_by(args.unlock)
+        print(f'Learning {"".join(args.unlock)} would unlock {len(rows)} sentences')
+        for row in rows[:args.limit]:
+            print(f'\t{sentence_text(sentence_index.index, row)}')
@@ -1,6 +1,25 @@
+import contextlib
 import os
 import shutil
+import sys
+import types
 from mutagen.id3 import ID3NoHeaderError, ID3, COMM
+import numpy as np
+
+from cv_index import load_index, clip_name, sentence_text, unknown_counts, filter_mask
+# Shared with the flashcard-generator pipeline when it's checked out alongside;
+# appended so its modules never shadow this folder's or installed ones
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'flashcard-generator', 'utils'))
+try:
+    from metrics import Metrics, NoMetrics
+except ImportError:
+    # Without it nothing is timed
+    Metrics = None
+
+    class NoMetrics:
+        @contextlib.contextmanager
+        def stage(self, name, unit='items', items=0):
+            yield types.SimpleNamespace(items=items)
 
 '''
 We expect other.tsv in common-voice to have the following schema:
@@ -15,35 +34,49 @@ CV_INDEX = 'cv-corpus/zh-CN/validated.tsv'
 NEW_AUDIO_FOLDER = 'audio/to_do'
 PRACTICED_AUDIO_FOLDER = 'audio/complete'
 
-import sys
 sys.stdout.reconfigure(encoding='utf-8')
 
-def parse_common_voice(cv_index, cv_clips, new_audio_folder, practiced_audio_folder, known_words, min_upvotes=2, genders=['male', ''], min_sentence_len=5):
-    index_file = open(cv_index, 'r', encoding='utf-8')
-    lines = index_file.readlines()
-    for line in lines[1:]:
-        values = line.split('\t')
-        clip_name = values[1]
-        sentence = values[2]
-        upvotes = values[3]
-        gender = values[6]
+'''
+The .tsv is read through cv_index, which caches it as a compact columnar index
+the first time, so re-running with a larger known words list only re-does the
+filtering. Clips already in new_audio_folder/practiced_audio_folder are found
+with one directory listing each instead of a stat per candidate.
+
+If a Metrics is given (see flashcard-generator/utils/metrics.py), loading the
+index, filtering, and copying/tagging clips are timed as separate stages.
+'''
+def parse_common_voice(cv_index, cv_clips, new_audio_folder, practiced_audio_folder, known_words, min_upvotes=2, genders=['male', ''], min_sentence_len=5, index_cache=None, metrics=None, verbose=False):
+    if metrics is None:
+        metrics = NoMetrics()
+    with metrics.stage('load_index', unit='rows') as stage:
+        index = load_index(cv_index, cache_file=index_cache, verbose=verbose)
+        stage.items = len(index['upvotes'])
+
+    # Check which sentences meet our acceptance criteria
+    with metrics.stage('filter', unit='rows', items=len(index['upvotes'])):
+        known_characters = set(known_words)
+        candidates = filter_mask(index, genders, min_upvotes, min_sentence_len) & \
+                     (unknown_counts(index, known_characters) == 0)
+
+    with metrics.stage('copy_and_tag', unit='clips') as stage:
+        copy_and_tag_clips(index, candidates, cv_clips, new_audio_folder, practiced_audio_folder, stage)
+
+# Copies each candidate clip that isn't in either folder yet to new_audio_folder and writes its sentence into the ID3 tags
+def copy_and_tag_clips(index, candidates, cv_clips, new_audio_folder, practiced_audio_folder, stage):
+    existing_clips = set(os.listdir(new_audio_folder)) | set(os.listdir(practiced_audio_folder))
+    for row in np.flatnonzero(candidates):
+        clip = clip_name(index, row)
+        sentence = sentence_text(index, row)
 
-        # Check if sentence meets our acceptance criteria
-        if gender not in genders or \
-           int(upvotes) < min_upvotes or \
-           len(sentence) < min_sentence_len or \
-           any([character not in known_words for character in sentence]):
-            continue
-    
         # Check if clip has already been parsed
-        if os.path.exists(new_audio_folder + '/' + clip_name) or \
-           os.path.exists(practiced_audio_folder + '/' + clip_name):
+        if clip in existing_clips:
             continue
         
-        print(f'Added {clip_name}! Sentence is 『 {sentence} 』', flush=True)
+        print(f'Added {clip}! Sentence is 『 {sentence} 』', flush=True)
         # Copy clip to new_audio_folder
-        output_file = new_audio_folder + '/' + clip_name
-        shutil.copy(cv_clips + '/' + clip_name, output_file)
+        output_file = new_audio_folder + '/' + clip
+        shutil.copy(cv_clips + '/' + clip, output_file)
+        existing_clips.add(clip)
 
         # Adding lyrics
         try: 
@@ -54,8 +87,7 @@ def parse_common_voice(cv_index, cv_clips, new_audio_folder, practiced_audio_fol
         
         tags['COMM'] = COMM(encoding=3, lang=u'chi', desc='desc', text=sentence)
         tags.save(output_file)
-
-    index_file.close()
+        stage.items += 1
 
 if __name__ == '__main__':
     known_words_file = '../known_words_01_02_24.txt'
@@ -64,4 +96,8 @@ if __name__ == '__main__':
         for word in fp.readlines():
             known_words.append(word.replace('\n', ''))
 
-    parse_common_voice(CV_INDEX, CV_CLIPS_FOLDER, NEW_AUDIO_FOLDER, PRACTICED_AUDIO_FOLDER, known_words)
\ No newline at end of file
+    metrics = Metrics() if Metrics is not None else None
+    parse_common_voice(CV_INDEX, CV_CLIPS_FOLDER, NEW_AUDIO_FOLDER, PRACTICED_AUDIO_FOLDER, known_words, metrics=metrics, verbose=True)
+    if metrics is not None:
+        metrics.print_report()
+        metrics.save('parse_common_voice_metrics.json')
\ No newline at end of file
@@ -0,0 +1,38 @@
+import os
+
+import cv_index
+
+VALIDATED_TSV = '''client_id\tpath\tsentence\tup_votes\tdown_votes\tage\tgender
+c1\tcommon_voice_zh-CN_1.mp3\t我们走吧。\t2\t0\tthirties\tmale
+c2\tcommon_voice_zh-CN_2.mp3\t你好。\t1\t0\ttwenties\tfemale
+'''
+
+def write_index(tmp_path):
+    index_file = tmp_path / 'validated.tsv'
+    index_file.write_text(VALIDATED_TSV, encoding='utf-8')
+    return str(index_file)
+
+def test_default_cache_name(tmp_path):
+    index_file = write_index(tmp_path)
+    cv_index.load_index(index_file)
+    assert os.path.exists(index_file + cv_index.INDEX_CACHE_SUFFIX)
+
+def test_cache_name_without_npz_is_found_again(tmp_path, monkeypatch):
+    index_file = write_index(tmp_path)
+    cache_file = str(tmp_path / 'validated.index')
+    index = cv_index.load_index(index_file, cache_file=cache_file)
+    # np.savez adds the .npz
+    assert os.path.exists(cache_file + '.npz')
+
+    def build_index(cv_index_file):
+        raise AssertionError('the cached index should have been used')
+    monkeypatch.setattr(cv_index, 'build_index', build_index)
+    cached = cv_index.load_index(index_file, cache_file=cache_file)
+    assert cached['upvotes'].tolist() == index['upvotes'].tolist() == [2, 1]
+
+def test_stale_cache_is_rebuilt(tmp_path):
+    index_file = write_index(tmp_path)
+    cv_index.load_index(index_file)
+    with open(index_file, 'a', encoding='utf-8') as fp:
+        fp.write('c3\tcommon_voice_zh-CN_3.mp3\t谢谢。\t3\t0\tforties\tmale\n')
+    assert cv_index.load_index(index_file)['upvotes'].tolist() == [2, 1, 3]
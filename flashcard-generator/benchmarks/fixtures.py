@@ -0,0 +1,216 @@
+'''
+Synthetic, reproducible inputs for the benchmarks, so they run on a plain Linux
+box without private media, an API key or a Common Voice download:
+- write_synthetic_audio: a 16kHz mono .wav with a known speech/silence layout
+- write_synthetic_srt: a large .srt with repeats, English lines and Whisper hallucinations
+- write_chunk_srts: per-chunk .srt files and VAD timestamps, as transcribeChunks leaves them
+- write_synthetic_sentences: line-separated Mandarin sentences for txt2pleco
+- write_synthetic_validated_tsv: a Common Voice validated.tsv with as many rows as asked for
+- write_synthetic_epub: a web-novel-sized .epub with as many chapters as asked for
+
+Every generator takes a seed, so the same arguments always produce the same file.
+The stub chat completions server lives in utils/stub_openai_server.py.
+'''
+import os
+import random
+import sys
+import wave
+import zipfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+import subs2txt
+
+COMMON_CHARACTERS = '的一是不了人我在有他这中大来上国个到说们为子和你地出道也时年得就那要下以生会自着去之过家学对可她里后小么心多天而能好都然没日于起还发成事只作当想看文无开手十用主行方又如前所本见经头面公同三已老从动两长知民样现分将外但身些与高意进把法此实回二理美点月明其种声全工己话儿者向情部正名定女问力机给等几很业最间新什打便位因重被走电四第门相次东政海口使教西再平真听世气信北少关并内加化由却代军产入先山五太水万市眼体别处总才场师书比住员九笑性通目华报立马命张活难神数件安表原车白应路期叫死常提感金何更反合放做系计或司利受光王果亲界及今京务制解各任至清物台象记边共风战干接它许八特觉望直服毛林题建南度统色字请交爱让认算论百吃义科怎元社术结六功指思非流每青管夫连远资队跟带花快条院变联言权往展该领传近留红治决周保达办运武半候七必城父强步完革深区即求品士转量空甚众技轻程告江语英基派满式李息写呢识极令黄德收脸钱党倒未持取设始版双历越史商千片容研像找友孩站广改议形委早房音火际则首单据导影失拿网香似斯专石若兵弟谁校读志飞观争究包组造落视济喜离虽坐集编宝谈府拉黑且随格尽剑讲布杀微怕母调局根曾准团段终乐切级克精哪官示冷域读'
+# The first KNOWN_CHARACTER_COUNT common characters stand in for a learner's known words
+KNOWN_CHARACTER_COUNT = 150
+SAMPLE_RATE = 16000
+
+'''
+write_synthetic_audio writes `seconds` of audio alternating between speech-like
+stretches (voiced syllables: a glottal pulse train with a gliding pitch,
+shaped by two formants and a syllable envelope) and near-silence (a low noise
+floor). Returns the (start, end) times in seconds of the speech stretches,
+which is what a perfect VAD would find.
+'''
+def write_synthetic_audio(output_file, seconds=600, seed=0, speech_range=(1.0, 8.0), silence_range=(0.4, 3.0)):
+    random_state = np.random.RandomState(seed)
+    samples = np.zeros(int(seconds * SAMPLE_RATE), dtype=np.float32)
+    # Noise floor, a block at a time so hour-long fixtures don't need a float64 copy of the track
+    for block_start in range(0, len(samples), SAMPLE_RATE * 60):
+        block = samples[block_start: block_start + SAMPLE_RATE * 60]
+        block += random_state.normal(0, 0.002, len(block)).astype(np.float32)
+
+    speech_segments = []
+    position = random_state.uniform(*silence_range)
+    while True:
+        duration = random_state.uniform(*speech_range)
+        if position + duration > seconds:
+            break
+        start = int(position * SAMPLE_RATE)
+        speech = synthetic_speech(duration, random_state)
+        samples[start: start + len(speech)] += speech
+        speech_segments.append((position, position + len(speech) / SAMPLE_RATE))
+        position += duration + random_state.uniform(*silence_range)
+
+    pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype(np.int16)
+    with wave.open(output_file, 'wb') as out:
+        out.setnchannels(1)
+        out.setsampwidth(2)
+        out.setframerate(SAMPLE_RATE)
+        out.writeframes(pcm.tobytes())
+    return speech_segments
+
+# One stretch of voiced syllables, about 4-6 per second
+def synthetic_speech(duration, random_state):
+    syllables = []
+    total = 0
+    while total < duration * SAMPLE_RATE:
+        length = int(random_state.uniform(0.15, 0.3) * SAMPLE_RATE)
+        t = np.arange(length) / SAMPLE_RATE
+        # Mandarin-ish tone: pitch glides between two values over the syllable
+        pitch = np.linspace(random_state.uniform(100, 220), random_state.uniform(100, 220), length)
+        phase = 2 * np.pi * np.cumsum(pitch) / SAMPLE_RATE
+        voiced = sum(np.sin(harmonic * phase) / harmonic for harmonic in range(1, 16))
+        formants = sum(np.sin(2 * np.pi * random_state.uniform(low, high) * t) for low, high in ((300, 900), (900, 2500)))
+        envelope = np.sin(np.pi * t / t[-1]) ** 2
+        syllables.append((0.3 * voiced * (1 + 0.3 * formants) * envelope).astype(np.float32))
+        total += length
+    return np.concatenate(syllables)[:int(duration * SAMPLE_RATE)]
+
+# Reads a 16-bit mono .wav into float32 samples, the format av2subs.extractAudio returns
+def read_wav(input_file):
+    with wave.open(input_file, 'rb') as wav:
+        pcm = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+    return pcm.astype(np.float32) / 32768
+
+# Writes an .srt of n subtitles where about a third of the lines repeat and a few are English or hallucinations
+def write_synthetic_srt(output_file, n, seed=0):
+    random_state = random.Random(seed)
+    vocabulary = [''.join(random_state.choice(COMMON_CHARACTERS) for _ in range(random_state.randint(3, 16))) for _ in range(max(1, n * 2 // 3))]
+    with open(output_file, 'w', encoding='utf-8') as fp:
+        for i in range(n):
+            roll = random_state.random()
+            if roll < 0.02:
+                text = 'Subtitles by the community'
+            elif roll < 0.04:
+                text = random_state.choice(subs2txt.BLACKLISTED_LINES) + random_state.choice(['', '。', '!'])
+            else:
+                text = random_state.choice(vocabulary) + random_state.choice(['', '。', '？'])
+            fp.write(f'{i+1}\n{srt_time(i * 2000)} --> {srt_time(i * 2000 + 1000)}\n{text}\n\n')
+
+'''
+write_chunk_srts writes n_chunks small .srt files into directory, one per VAD
+chunk with 1-4 subtitles each, and returns (files, speech_timestamps_ms) ready
+for av2subs.combineSubtitleFiles.
+'''
+def write_chunk_srts(directory, n_chunks, seed=0):
+    random_state = random.Random(seed)
+    files = []
+    speech_timestamps = []
+    position = 0
+    for i in range(n_chunks):
+        duration = random_state.randint(1000, 25000)
+        position += random_state.randint(300, 3000)
+        speech_timestamps.append((position, position + duration))
+        position += duration
+
+        files.append(os.path.join(directory, f'chunked_audio_{i+1}.srt'))
+        subtitles = random_state.randint(1, 4)
+        with open(files[-1], 'w', encoding='utf-8') as fp:
+            for j in range(subtitles):
+                start, end = duration * j // subtitles, duration * (j + 1) // subtitles
+                text = ''.join(random_state.choice(COMMON_CHARACTERS) for _ in range(random_state.randint(4, 20)))
+                fp.write(f'{j+1}\n{srt_time(start)} --> {srt_time(end)}\n{text}\n\n')
+    return files, speech_timestamps
+
+# Writes n sentences of 5-25 characters, one per line, with some repeats
+def write_synthetic_sentences(output_file, n, seed=0):
+    random_state = random.Random(seed)
+    sentences = [''.join(random_state.choice(COMMON_CHARACTERS) for _ in range(random_state.randint(5, 25))) + '。' for _ in range(n)]
+    for i in range(0, n, 10):
+        sentences[i] = random_state.choice(sentences)
+    with open(output_file, 'w', encoding='utf-8') as fp:
+        fp.write('\n'.join(sentences))
+
+'''
+write_synthetic_validated_tsv writes a Common Voice validated.tsv with `rows`
+clips. About known_fraction of the sentences only use the first
+KNOWN_CHARACTER_COUNT common characters (see known_characters), the rest draw
+from all of them. Up-votes and genders are spread like the real corpus.
+Returns the clip names of every sentence made of known characters only.
+'''
+def write_synthetic_validated_tsv(output_file, rows=1000000, known_fraction=0.005, seed=0, block_size=100000):
+    random_state = np.random.RandomState(seed)
+    characters = np.array(list(COMMON_CHARACTERS))
+    genders = np.array(['male', 'female', '', 'other'])
+    known_clips = []
+    with open(output_file, 'w', encoding='utf-8') as fp:
+        fp.write('client_id\tpath\tsentence\tup_votes\tdown_votes\tage\tgender\taccents\tvariant\tlocale\tsegment\n')
+        for block_start in range(0, rows, block_size):
+            block = min(block_size, rows - block_start)
+            lengths = random_state.randint(3, 30, size=block)
+            known = random_state.random_sample(block) < known_fraction
+            alphabet_sizes = np.where(known, KNOWN_CHARACTER_COUNT, len(characters))
+            upvotes = random_state.poisson(2, size=block)
+            gender = genders[random_state.choice(len(genders), size=block, p=[0.55, 0.2, 0.2, 0.05])]
+
+            lines = []
+            for i in range(block):
+                clip = f'common_voice_zh-CN_{block_start + i}.mp3'
+                indices = (random_state.random_sample(lengths[i]) * alphabet_sizes[i]).astype(np.int64)
+                sentence = ''.join(characters[indices]) + '。'
+                if indices.max() < KNOWN_CHARACTER_COUNT:
+                    known_clips.append(clip)
+                lines.append(f'client{(block_start + i) % 5000}\t{clip}\t{sentence}\t{upvotes[i]}\t0\ttwenties\t{gender[i]}\t\t\tzh-CN\t\n')
+            fp.writelines(lines)
+    return known_clips
+
+'''
+write_synthetic_epub writes an EPUB 3 book of `chapters` XHTML chapters, each
+with paragraphs_per_chapter paragraphs of 1-4 sentences (some in quotes, some
+repeated from earlier chapters), listed in the spine in reverse file order so
+a reader that ignores the spine gets the chapters wrong.
+'''
+def write_synthetic_epub(output_file, chapters=1000, paragraphs_per_chapter=40, seed=0):
+    random_state = random.Random(seed)
+    sentences = []
+    with zipfile.ZipFile(output_file, 'w', zipfile.ZIP_DEFLATED) as book:
+        book.writestr(zipfile.ZipInfo('mimetype'), 'application/epub+zip')
+        book.writestr('META-INF/container.xml',
+                      '<?xml version="1.0"?>\n<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                      '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles></container>')
+        items = []
+        for chapter in range(chapters):
+            paragraphs = []
+            for _ in range(paragraphs_per_chapter):
+                paragraph = []
+                for _ in range(random_state.randint(1, 4)):
+                    if sentences and random_state.random() < 0.05:
+                        sentence = random_state.choice(sentences)
+                    else:
+                        sentence = ''.join(random_state.choice(COMMON_CHARACTERS) for _ in range(random_state.randint(4, 20)))
+                        sentence = f'“{sentence}！”' if random_state.random() < 0.2 else sentence + random_state.choice('。。。？…')
+                        sentences.append(sentence)
+                    paragraph.append(sentence)
+                paragraphs.append('<p>' + ''.join(paragraph) + '</p>')
+            items.append(f'chapter_{chapter:05}.xhtml')
+            book.writestr(f'OEBPS/text/{items[-1]}',
+                          '<?xml version="1.0" encoding="utf-8"?>\n<html xmlns="http://www.w3.org/1999/xhtml"><head><title>第{chapter+1}章</title></head>'
+                          f'<body><h1>第{chapter+1}章</h1>{"".join(paragraphs)}</body></html>')
+        manifest = ''.join(f'<item id="c{i}" href="text/{item}" media-type="application/xhtml+xml"/>' for i, item in enumerate(items))
+        spine = ''.join(f'<itemref idref="c{i}"/>' for i in reversed(range(len(items))))
+        book.writestr('OEBPS/content.opf',
+                      '<?xml version="1.0" encoding="utf-8"?>\n<package xmlns="http://www.idpf.org/2007/opf" version="3.0">'
+                      f'<manifest>{manifest}</manifest><spine>{spine}</spine></package>')
+
+# Known words for the synthetic validated.tsv (punctuation counts as a character in parse_common_voice)
+def known_characters():
+    return list(COMMON_CHARACTERS[:KNOWN_CHARACTER_COUNT]) + ['。']
+
+def srt_time(milliseconds):
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours:02}:{minutes:02}:{seconds:02},{milliseconds:03}'
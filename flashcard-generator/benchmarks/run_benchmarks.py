@@ -0,0 +1,355 @@
+'''
+Offline benchmark suite for the hot paths of the pipeline, on synthetic
+fixtures (see fixtures.py) so it runs on any Linux box:
+- chunkAudio: silero-vad over an hour of audio with a known speech layout
+- combineSubtitleFiles: merging per-chunk .srt files into one transcript
+- subs2txt: filtering a 200k subtitle .srt
+- txt2pleco_batching: token-budget batching alone, then a full run against the stub chat server
+- parse_common_voice: a million-row validated.tsv, with and without the cached index
+- epub2txt: a 1,000-chapter web novel
+- sentence_ranking: segmenting and ranking 200k candidate lines against a known words list
+
+Fixtures are generated once into benchmarks/fixtures/ and reused. Each
+benchmark runs in its own process, so its peak RSS isn't inflated by the
+others or by fixture generation. Benchmarks whose dependencies aren't
+installed (e.g. torch for chunkAudio) are reported as skipped.
+
+Results (seconds, throughput, peak RSS and a few benchmark-specific numbers)
+can be saved as a baseline and later runs compared against it; a throughput
+drop or memory growth beyond --tolerance is flagged and the exit code is 1.
+
+Usage:
+python run_benchmarks.py --save baselines/laptop.json
+python run_benchmarks.py --compare baselines/laptop.json
+python run_benchmarks.py --scale 0.1 --only subs2txt txt2pleco_batching
+'''
+import argparse
+import contextlib
+import importlib.util
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIRECTORY, '..', 'utils'))
+sys.path.insert(0, os.path.join(BENCHMARK_DIRECTORY, '..', '..', 'common-voice-parser'))
+import fixtures
+from metrics import peak_rss_mb
+from run_manifest import atomic_output
+
+DEFAULT_FIXTURE_DIRECTORY = os.path.join(BENCHMARK_DIRECTORY, 'fixtures')
+PARSE_COMMON_VOICE_SCRIPT = os.path.join(BENCHMARK_DIRECTORY, '..', '..', 'common-voice-parser', 'parse-common-voice.py')
+# Fixture sizes at --scale 1
+FULL_SIZES = {
+    'audio_seconds': 3600,
+    'chunks': 2000,
+    'subtitles': 200000,
+    'sentences': 20000,
+    'tsv_rows': 1000000,
+    'chapters': 1000,
+    'ranking_sentences': 200000
+}
+# Simulated API latency of the stub chat server, in seconds
+STUB_LATENCY = 0.02
+# Relative throughput drop (or peak RSS growth) that counts as a regression
+REGRESSION_TOLERANCE = 0.1
+
+def run_benchmarks(names, scale=1.0, repeat=3, fixture_directory=DEFAULT_FIXTURE_DIRECTORY, verbose=True):
+    if not os.path.exists(fixture_directory):
+        os.makedirs(fixture_directory)
+    sizes = {name: max(1, int(size * scale)) for name, size in FULL_SIZES.items()}
+
+    results = {}
+    for name in names:
+        prepare, _ = BENCHMARKS[name]
+        if verbose:
+            print(f'{name}: preparing fixtures', flush=True)
+        fixture = prepare(fixture_directory, sizes)
+
+        # A fresh interpreter per benchmark keeps peak RSS comparable between runs
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(1) as pool:
+            results[name] = pool.apply(run_benchmark, (name, fixture, repeat))
+        if verbose:
+            print_result(name, results[name])
+
+    return {
+        'machine': {'platform': platform.platform(), 'python': platform.python_version(), 'cpu_count': os.cpu_count()},
+        'scale': scale,
+        'repeat': repeat,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'benchmarks': results
+    }
+
+# Runs in the benchmark's own process
+def run_benchmark(name, fixture, repeat):
+    _, run = BENCHMARKS[name]
+    try:
+        result = run(fixture, repeat)
+    except ImportError as e:
+        return {'skipped': str(e)}
+    result['items_per_second'] = result['items'] / result['seconds'] if result['seconds'] else 0.0
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+# Best wall time of `repeat` calls to function(), which may return a value to keep
+def best_time(function, repeat):
+    best = None
+    value = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, value
+
+'''
+chunkAudio: VAD over synthetic audio. speech_recall is the fraction of the
+fixture's speech stretches that overlap a detected chunk.
+'''
+def prepare_chunk_audio(fixture_directory, sizes):
+    wav_file = os.path.join(fixture_directory, f'speech_{sizes["audio_seconds"]}s.wav')
+    layout_file = wav_file + '.json'
+    if not os.path.exists(layout_file):
+        speech_segments = fixtures.write_synthetic_audio(wav_file, seconds=sizes['audio_seconds'])
+        with open(layout_file, 'w', encoding='utf-8') as fp:
+            json.dump(speech_segments, fp)
+    return {'wav_file': wav_file, 'layout_file': layout_file}
+
+def bench_chunk_audio(fixture, repeat):
+    import av2subs
+    audio = fixtures.read_wav(fixture['wav_file'])
+    with open(fixture['layout_file'], 'r', encoding='utf-8') as fp:
+        speech_segments = json.load(fp)
+
+    temp_directory = tempfile.mkdtemp()
+    try:
+        av2subs.loadSileroVad()
+        seconds, (_, speech_timestamps_ms) = best_time(lambda: av2subs.chunkAudio(audio, save_chunks=False, temp_directory=temp_directory, run_id='bench'), repeat)
+    finally:
+        shutil.rmtree(temp_directory)
+
+    found = sum(any(start * 1000 < end_ms and start_ms < end * 1000 for start_ms, end_ms in speech_timestamps_ms)
+                for start, end in speech_segments)
+    return {'seconds': seconds, 'items': len(audio) / av2subs.AUDIO_SAMPLE_RATE, 'unit': 'audio_seconds',
+            'chunks': len(speech_timestamps_ms), 'speech_recall': found / len(speech_segments) if speech_segments else 1.0}
+
+def prepare_combine_subtitles(fixture_directory, sizes):
+    directory = os.path.join(fixture_directory, f'chunk_srts_{sizes["chunks"]}')
+    timestamps_file = os.path.join(directory, 'speech_timestamps.json')
+    if not os.path.exists(timestamps_file):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        files, speech_timestamps = fixtures.write_chunk_srts(directory, sizes['chunks'])
+        with open(timestamps_file, 'w', encoding='utf-8') as fp:
+            json.dump({'files': files, 'speech_timestamps': speech_timestamps}, fp)
+    return {'timestamps_file': timestamps_file}
+
+def bench_combine_subtitles(fixture, repeat):
+    import av2subs
+    with open(fixture['timestamps_file'], 'r', encoding='utf-8') as fp:
+        chunks = json.load(fp)
+
+    temp_directory = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(temp_directory, 'bench'))
+        seconds, _ = best_time(lambda: av2subs.combineSubtitleFiles(chunks['files'], chunks['speech_timestamps'], temp_directory=temp_directory, run_id='bench'), repeat)
+    finally:
+        shutil.rmtree(temp_directory)
+    return {'seconds': seconds, 'items': len(chunks['files']), 'unit': 'chunks'}
+
+def prepare_subs2txt(fixture_directory, sizes):
+    srt_file = os.path.join(fixture_directory, f'subtitles_{sizes["subtitles"]}.srt')
+    if not os.path.exists(srt_file):
+        with atomic_output(srt_file) as temp_file:
+            fixtures.write_synthetic_srt(temp_file, sizes['subtitles'])
+    return {'srt_file': srt_file, 'subtitles': sizes['subtitles']}
+
+def bench_subs2txt(fixture, repeat):
+    import subs2txt
+    temp_directory = tempfile.mkdtemp()
+    try:
+        seconds, stats = best_time(lambda: subs2txt.subs2txt(fixture['srt_file'], os.path.join(temp_directory, 'subs.txt')), repeat)
+    finally:
+        shutil.rmtree(temp_directory)
+    return {'seconds': seconds, 'items': fixture['subtitles'], 'unit': 'subtitles', 'kept': stats['kept']}
+
+'''
+txt2pleco_batching: seconds is a full txt2pleco run against the local stub
+server (simulated latency, no rate limits); batching_lines_per_second is
+batch_lines on its own.
+'''
+def prepare_txt2pleco(fixture_directory, sizes):
+    txt_file = os.path.join(fixture_directory, f'sentences_{sizes["sentences"]}.txt')
+    if not os.path.exists(txt_file):
+        with atomic_output(txt_file) as temp_file:
+            fixtures.write_synthetic_sentences(temp_file, sizes['sentences'])
+    return {'txt_file': txt_file}
+
+def bench_txt2pleco(fixture, repeat):
+    import txt2pleco
+    from stub_openai_server import run_stub_server
+    with open(fixture['txt_file'], 'r', encoding='utf-8') as fp:
+        lines = fp.readlines()
+    model = 'gpt-3.5-turbo'
+    instruction_tokens = txt2pleco.estimate_tokens(txt2pleco.SYSTEM_MESSAGE + txt2pleco.INSTRUCTIONS + '</INPUT>', model)
+    batching_seconds, batches = best_time(lambda: txt2pleco.batch_lines(lines, model, instruction_tokens), repeat)
+
+    server = run_stub_server(latency=STUB_LATENCY)
+    temp_directory = tempfile.mkdtemp()
+    try:
+        seconds, report = best_time(lambda: txt2pleco.txt2pleco(fixture['txt_file'], os.path.join(temp_directory, 'pleco.txt'), model=model,
+                                                                base_url=server.base_url, api_key='stub'), repeat)
+    finally:
+        server.shutdown()
+        shutil.rmtree(temp_directory)
+    return {'seconds': seconds, 'items': len(lines), 'unit': 'lines', 'batches': len(batches),
+            'batching_lines_per_second': len(lines) / batching_seconds if batching_seconds else 0.0,
+            'cost_per_card': report['cost_per_card']}
+
+'''
+parse_common_voice: seconds is a run with the index already cached (the usual
+case when re-running with a longer known words list); cold_seconds includes
+building the index from the .tsv.
+'''
+def prepare_parse_common_voice(fixture_directory, sizes):
+    tsv_file = os.path.join(fixture_directory, f'validated_{sizes["tsv_rows"]}.tsv')
+    clips_directory = os.path.join(fixture_directory, f'clips_{sizes["tsv_rows"]}')
+    if not os.path.exists(clips_directory):
+        with atomic_output(tsv_file) as temp_file:
+            known_clips = fixtures.write_synthetic_validated_tsv(temp_file, rows=sizes['tsv_rows'])
+        os.makedirs(clips_directory + '.tmp', exist_ok=True)
+        for clip in known_clips:
+            with open(os.path.join(clips_directory + '.tmp', clip), 'wb') as fp:
+                fp.write(b'\xff\xfb\x90\x00' + bytes(413))
+        os.replace(clips_directory + '.tmp', clips_directory)
+    return {'tsv_file': tsv_file, 'clips_directory': clips_directory, 'rows': sizes['tsv_rows']}
+
+def bench_parse_common_voice(fixture, repeat):
+    spec = importlib.util.spec_from_file_location('parse_common_voice', PARSE_COMMON_VOICE_SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    temp_directory = tempfile.mkdtemp()
+    index_cache = os.path.join(temp_directory, 'validated.index.npz')
+    new_audio_folder = os.path.join(temp_directory, 'to_do')
+    practiced_audio_folder = os.path.join(temp_directory, 'complete')
+
+    def parse(cold):
+        if cold and os.path.exists(index_cache):
+            os.remove(index_cache)
+        for folder in (new_audio_folder, practiced_audio_folder):
+            shutil.rmtree(folder, ignore_errors=True)
+            os.mkdir(folder)
+        # parse_common_voice prints a line per clip it adds
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            module.parse_common_voice(fixture['tsv_file'], fixture['clips_directory'], new_audio_folder, practiced_audio_folder,
+                                      fixtures.known_characters(), index_cache=index_cache)
+        return len(os.listdir(new_audio_folder))
+
+    try:
+        cold_seconds, _ = best_time(lambda: parse(cold=True), 1)
+        seconds, clips_added = best_time(lambda: parse(cold=False), repeat)
+    finally:
+        shutil.rmtree(temp_directory)
+    return {'seconds': seconds, 'items': fixture['rows'], 'unit': 'rows', 'cold_seconds': cold_seconds, 'clips_added': clips_added}
+
+def prepare_epub2txt(fixture_directory, sizes):
+    epub_file = os.path.join(fixture_directory, f'novel_{sizes["chapters"]}.epub')
+    if not os.path.exists(epub_file):
+        with atomic_output(epub_file) as temp_file:
+            fixtures.write_synthetic_epub(temp_file, sizes['chapters'])
+    return {'epub_file': epub_file, 'chapters': sizes['chapters']}
+
+def bench_epub2txt(fixture, repeat):
+    import epub2txt
+    temp_directory = tempfile.mkdtemp()
+    try:
+        seconds, stats = best_time(lambda: epub2txt.epub2txt(fixture['epub_file'], os.path.join(temp_directory, 'book.txt')), repeat)
+    finally:
+        shutil.rmtree(temp_directory)
+    return {'seconds': seconds, 'items': fixture['chapters'], 'unit': 'chapters', 'kept': stats['kept'], 'duplicate': stats['duplicate']}
+
+def prepare_sentence_ranking(fixture_directory, sizes):
+    txt_file = os.path.join(fixture_directory, f'sentences_{sizes["ranking_sentences"]}.txt')
+    if not os.path.exists(txt_file):
+        with atomic_output(txt_file) as temp_file:
+            fixtures.write_synthetic_sentences(temp_file, sizes['ranking_sentences'])
+    return {'txt_file': txt_file, 'sentences': sizes['ranking_sentences']}
+
+def bench_sentence_ranking(fixture, repeat):
+    import sentence_ranking
+    with open(fixture['txt_file'], 'r', encoding='utf-8') as fp:
+        sentences = fp.read().split('\n')
+    # Twice the known characters of the Common Voice fixture, so a useful share of lines are i+1
+    segmenter = sentence_ranking.Segmenter(fixtures.COMMON_CHARACTERS[:fixtures.KNOWN_CHARACTER_COUNT * 2] + '。')
+    seconds, (selected, stats) = best_time(lambda: sentence_ranking.select_sentences(sentences, segmenter), repeat)
+    return {'seconds': seconds, 'items': fixture['sentences'], 'unit': 'sentences', 'selected': len(selected)}
+
+BENCHMARKS = {
+    'chunkAudio': (prepare_chunk_audio, bench_chunk_audio),
+    'combineSubtitleFiles': (prepare_combine_subtitles, bench_combine_subtitles),
+    'subs2txt': (prepare_subs2txt, bench_subs2txt),
+    'txt2pleco_batching': (prepare_txt2pleco, bench_txt2pleco),
+    'parse_common_voice': (prepare_parse_common_voice, bench_parse_common_voice),
+    'epub2txt': (prepare_epub2txt, bench_epub2txt),
+    'sentence_ranking': (prepare_sentence_ranking, bench_sentence_ranking)
+}
+
+def print_result(name, result):
+    if 'skipped' in result:
+        print(f'{name}: skipped ({result["skipped"]})', flush=True)
+        return
+    extras = ', '.join(f'{key}: {value:g}' for key, value in result.items()
+                       if key not in ('seconds', 'items', 'unit', 'items_per_second', 'peak_rss_mb'))
+    print(f'{name}: {result["seconds"]:.3f}s, {result["items_per_second"]:,.0f} {result["unit"]}/s, '
+          f'peak RSS {result["peak_rss_mb"] or 0:.0f}MB' + (f' ({extras})' if extras else ''), flush=True)
+
+'''
+compare_results prints each benchmark's throughput and peak RSS against the
+baseline and returns the names of those that regressed by more than tolerance.
+'''
+def compare_results(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    if results['scale'] != baseline['scale']:
+        print(f'Warning: baseline was run at scale {baseline["scale"]}, this run at {results["scale"]}', flush=True)
+
+    regressions = []
+    for name, result in results['benchmarks'].items():
+        base = baseline['benchmarks'].get(name)
+        if base is None or 'skipped' in base or 'skipped' in result:
+            continue
+        speed = result['items_per_second'] / base['items_per_second'] if base['items_per_second'] else 1.0
+        memory = result['peak_rss_mb'] / base['peak_rss_mb'] if base.get('peak_rss_mb') and result.get('peak_rss_mb') else 1.0
+        regressed = speed < 1 - tolerance or memory > 1 + tolerance
+        if regressed:
+            regressions.append(name)
+        print(f'{name}: {speed:.2f}x throughput, {memory:.2f}x peak RSS vs baseline' + (' <-- REGRESSION' if regressed else ''), flush=True)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the offline benchmark suite.')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument('--scale', type=float, default=1.0, help='Fixture size relative to the full suite (e.g. 0.1 for a quick run)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per benchmark; the best time is kept')
+    parser.add_argument('--fixtures', default=DEFAULT_FIXTURE_DIRECTORY)
+    parser.add_argument('--save', help='Save the results as a baseline JSON file')
+    parser.add_argument('--compare', help='Compare against a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE)
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.only, scale=args.scale, repeat=args.repeat, fixture_directory=args.fixtures)
+    if args.save:
+        if os.path.dirname(args.save) and not os.path.exists(os.path.dirname(args.save)):
+            os.makedirs(os.path.dirname(args.save))
+        with atomic_output(args.save) as temp_file, open(temp_file, 'w', encoding='utf-8') as fp:
+            json.dump(results, fp, indent=2)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as fp:
+            baseline = json.load(fp)
+        if compare_results(results, baseline, tolerance=args.tolerance):
+            sys.exit(1)
@@ -0,0 +1,70 @@
+'''
+Compares subs2txt against the original pysrt-based implementation (kept below
+as legacy_subs2txt) on a synthetic .srt with repeated lines, Latin text and
+hallucination variants.
+
+Usage:
+python subs2txt_bench.py --subtitles 200000
+'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+import subs2txt
+from fixtures import write_synthetic_srt
+
+def legacy_subs2txt(input_file, output_file, min_chars=5, no_english=True):
+    import pysrt
+    output = open(output_file, 'wb+')
+    subs = pysrt.open(input_file)
+    texts_to_write = []
+    for sub in subs:
+        qualifying_chars = [char in sub.text for char in sub.text if char not in subs2txt.CHARS_TO_IGNORE]
+        if len(qualifying_chars) < min_chars:
+            continue
+        if no_english:
+            if any([char in subs2txt.LATIN_ALPHABET for char in sub.text]):
+                continue
+        if sub.text in subs2txt.BLACKLISTED_LINES:
+            continue
+        texts_to_write.append(sub.text)
+    texts_to_write = list(set(texts_to_write))
+    output.write('\n'.join(texts_to_write).encode('utf-8'))
+    output.close()
+
+def benchmark(n_subtitles, repeat=1):
+    directory = tempfile.mkdtemp()
+    input_file = os.path.join(directory, 'synthetic.srt')
+    write_synthetic_srt(input_file, n_subtitles)
+    size_mb = os.path.getsize(input_file) / (1024 * 1024)
+    print(f'{n_subtitles} subtitles ({size_mb:.1f} MB)', flush=True)
+
+    results = {}
+    implementations = {
+        'legacy': lambda: legacy_subs2txt(input_file, os.path.join(directory, 'legacy.txt')),
+        'exact': lambda: subs2txt.subs2txt(input_file, os.path.join(directory, 'exact.txt'), near_duplicate_threshold=None),
+        'near_duplicate': lambda: subs2txt.subs2txt(input_file, os.path.join(directory, 'near_duplicate.txt'))
+    }
+    for name, run in implementations.items():
+        try:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                run()
+            elapsed = (time.perf_counter() - start) / repeat
+        except ImportError as e:
+            print(f'{name}: skipped ({e})', flush=True)
+            continue
+        results[name] = n_subtitles / elapsed
+        print(f'{name}: {elapsed:.2f}s ({results[name]:,.0f} subtitles/s)', flush=True)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark subs2txt.')
+    parser.add_argument('--subtitles', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args()
+
+    benchmark(args.subtitles, repeat=args.repeat)
@@ -0,0 +1,59 @@
+'''
+Compares the two transcription engines in av2subs on the same VAD chunks:
+- subprocess: one whisper CLI process per chunk (av2subs.transcribeChunks)
+- inprocess: one resident model, batched decoding (av2subs.transcribeChunksInProcess)
+- parallel: a pool of CPU workers running the in-process engine (av2subs.transcribeChunksParallel)
+
+Usage:
+python transcribe_bench.py episode.mp4 --model small --limit 50
+'''
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+import av2subs
+
+def benchmark(input_file, whisper_model, whisper_prompt, limit=None, batch_size=av2subs.DEFAULT_BATCH_SIZE, workers=None, engines=('subprocess', 'inprocess'), temp_directory=av2subs.DEFAULT_TEMP_DIRECTORY, run_id=av2subs.RUN_ID):
+    for directory in (temp_directory, f'{temp_directory}/{run_id}'):
+        if not os.path.exists(directory):
+            os.mkdir(directory)
+
+    audio = av2subs.extractAudio(input_file, temp_directory=temp_directory, run_id=run_id)
+    chunk_files, _ = av2subs.chunkAudio(audio, temp_directory=temp_directory, run_id=run_id)
+    chunk_arrays, _ = av2subs.chunkAudio(audio, save_chunks=False, temp_directory=temp_directory, run_id=run_id)
+    if limit:
+        chunk_files, chunk_arrays = chunk_files[:limit], chunk_arrays[:limit]
+
+    results = {}
+    for engine in engines:
+        start = time.perf_counter()
+        if engine == 'subprocess':
+            av2subs.transcribeChunks(chunk_files, whisper_model, whisper_prompt, temp_directory=temp_directory, run_id=run_id)
+        elif engine == 'parallel':
+            av2subs.transcribeChunksParallel(chunk_arrays, whisper_model, whisper_prompt, workers=workers)
+        else:
+            av2subs.transcribeChunksInProcess(chunk_arrays, whisper_model, whisper_prompt, batch_size=batch_size)
+        elapsed = time.perf_counter() - start
+        results[engine] = len(chunk_arrays) / elapsed
+        print(f'{engine}: {len(chunk_arrays)} chunks in {elapsed:.1f}s ({results[engine]:.2f} chunks/s)', flush=True)
+
+    if 'subprocess' in results:
+        for engine in results:
+            if engine != 'subprocess':
+                print(f'{engine} speedup: {results[engine] / results["subprocess"]:.1f}x', flush=True)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark av2subs transcription engines.')
+    parser.add_argument('input_file')
+    parser.add_argument('--model', default='small')
+    parser.add_argument('--prompt', default='以下为中文。')
+    parser.add_argument('--limit', type=int, default=None, help='Only transcribe the first N chunks')
+    parser.add_argument('--batch_size', type=int, default=av2subs.DEFAULT_BATCH_SIZE)
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes for the parallel engine')
+    parser.add_argument('--engines', nargs='+', default=['subprocess', 'inprocess'])
+    args = parser.parse_args()
+
+    benchmark(args.input_file, args.model, args.prompt, limit=args.limit, batch_size=args.batch_size, workers=args.workers, engines=args.engines)
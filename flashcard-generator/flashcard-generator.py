@@ -1,4 +1,328 @@
 '''
 This script will combine all the utilities in `utils/` directory to take a variety of media types
 and create Pleco flashcards.
+
+Given media files and/or directories (e.g. a whole season), every episode goes
+through these stages:
+1. decode:     decode the audio and split it into speech chunks (av2subs)
+2. transcribe: transcribe the chunks with Whisper and write an .srt (av2subs)
+3. translate:  filter the subtitles into sentences (subs2txt) and turn them
+               into Pleco flashcards (txt2pleco)
+E-books (.epub) skip the first two stages; their sentences come from epub2txt.
+
+The stages run at the same time on different episodes: while episode N is
+being transcribed, episode N+1 is decoding and episode N-1 is being
+translated. Each stage has its own worker threads and hands episodes to the
+next one through a bounded queue, so a fast stage can't run far ahead of a
+slow one (and hold every decoded episode in memory).
+
+Each episode's run_id is its file name, so re-running the same command after a
+crash resumes every episode from its run manifest (see utils/run_manifest.py):
+finished episodes are skipped, and unfinished ones reuse their VAD segments,
+transcribed chunks and translated batches.
+
+With --known_word_list, only sentences with 1 to --max_unknown_words unknown
+words become cards, picked before anything is sent to the API and capped by
+--max_cards/--max_cost per episode (see utils/sentence_ranking.py).
+
+--metrics_file writes a JSON report of where the time and money went (per-stage
+wall/CPU time, throughput, peak RSS, API tokens and cost; see utils/metrics.py)
+and --profile writes cProfile stats of the whole run.
+
+Usage:
+python flashcard-generator.py season_01/ --output_dir flashcards/ --whisper_model large-v2
 '''
+import argparse
+import contextlib
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils'))
+import av2subs
+import cedict
+import epub2txt
+import models
+import subs2txt
+import txt2pleco
+from metrics import Metrics
+from run_manifest import RunManifest
+from sentence_ranking import MAX_UNKNOWN_WORDS, read_known_words
+from transcription_cache import TranscriptionCache
+from translation_memory import TranslationMemory
+
+MEDIA_EXTENSIONS = ('.mp4', '.mkv', '.avi', '.mov', '.webm', '.mp3', '.wav', '.m4a', '.flac', '.ogg', '.epub')
+# Inputs that are already text, so they skip the decode and transcribe stages
+EBOOK_EXTENSIONS = ('.epub',)
+# Episodes waiting between two stages
+DEFAULT_QUEUE_SIZE = 2
+# Sentinel passed down the queues once a stage has no more work
+END_OF_INPUT = None
+
+def flashcard_generator(input_paths, output_dir, whisper_model='small', whisper_prompt='以下为中文。', speech_threshold=0.5, model='gpt-3.5-turbo',
+                        known_words=[], max_unknown_words=MAX_UNKNOWN_WORDS, max_cards=None, max_cost=None,
+                        decode_workers=1, translate_workers=2, queue_size=DEFAULT_QUEUE_SIZE,
+                        cache=None, memory=None, dictionary=None, metrics=None, temp_directory=av2subs.DEFAULT_TEMP_DIRECTORY, verbose=False):
+    if metrics is None:
+        metrics = Metrics()
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    if not os.path.exists(temp_directory):
+        os.makedirs(temp_directory)
+
+    episodes = find_media_files(input_paths)
+    if verbose:
+        print(f'Found {len(episodes)} episodes', flush=True)
+    # Read silero-vad and Whisper from disk while the first episode is decoding
+    if any(not episode['ebook'] for episode in episodes):
+        models.warm_up(whisper_model)
+
+    # Every worker shares the transcription cache and translation memory
+    cache = cache and Locked(cache)
+    memory = memory and Locked(memory)
+
+    # Each episode's run manifest (an open file) is only held while the episode is in the pipeline
+    def decode(episode):
+        episode['manifest'] = RunManifest(episode['run_id'], temp_directory=temp_directory)
+        if episode['ebook']:
+            return episode
+        run_id = episode['run_id']
+        with metrics.stage('decode', unit='audio_seconds') as stage:
+            audio = av2subs.extractAudio(episode['input_file'], temp_directory=temp_directory, run_id=run_id)
+            stage.items = len(audio) / av2subs.AUDIO_SAMPLE_RATE
+        with metrics.stage('vad', unit='audio_seconds', items=len(audio) / av2subs.AUDIO_SAMPLE_RATE):
+            episode['audio_chunks'], episode['speech_timestamps_ms'] = av2subs.chunkAudio(audio,
+                                                                                         threshold=speech_threshold,
+                                                                                         save_chunks=False,
+                                                                                         manifest=episode['manifest'],
+                                                                                         temp_directory=temp_directory,
+                                                                                         run_id=run_id)
+        return episode
+
+    def transcribe(episode):
+        if episode['ebook']:
+            return episode
+        audio_chunks = episode.pop('audio_chunks')
+        with metrics.stage('transcribe', unit='chunks', items=len(audio_chunks)):
+            chunk_segments = av2subs.transcribeChunksCached(audio_chunks, whisper_model, whisper_prompt, cache, manifest=episode['manifest'])
+        with metrics.stage('combine', unit='chunks', items=len(audio_chunks)):
+            # Written straight to the output directory, which may be on another filesystem than temp_directory
+            av2subs.combineSegments(chunk_segments, episode['speech_timestamps_ms'], output_file=episode['srt_file'])
+        return episode
+
+    def translate(episode):
+        try:
+            if episode['ebook']:
+                epub2txt.epub2txt(episode['input_file'], episode['txt_file'], metrics=metrics)
+            else:
+                subs2txt.subs2txt(episode['srt_file'], episode['txt_file'], metrics=metrics)
+            episode['report'] = txt2pleco.txt2pleco(episode['txt_file'], episode['pleco_file'], model=model, header=episode['name'],
+                                                  known_words=known_words, max_unknown_words=max_unknown_words, max_cards=max_cards, max_cost=max_cost,
+                                                  memory=memory, dictionary=dictionary, manifest=episode['manifest'], metrics=metrics)
+            episode['manifest'].record('flashcard-generator', episode['pleco_file'], episode['report'])
+        finally:
+            episode['manifest'].close()
+        return episode
+
+    # An episode that fails is dropped by run_pipeline, so its manifest is closed on the way out
+    def closing_manifest_on_failure(function):
+        def stage(episode):
+            try:
+                return function(episode)
+            except Exception:
+                if 'manifest' in episode:
+                    episode['manifest'].close()
+                raise
+        return stage
+
+    unfinished_episodes = []
+    for episode in episodes:
+        episode['srt_file'] = os.path.join(output_dir, episode['name'] + '.srt')
+        episode['txt_file'] = os.path.join(output_dir, episode['name'] + '.txt')
+        episode['pleco_file'] = os.path.join(output_dir, episode['name'] + '_pleco.txt')
+        with contextlib.closing(RunManifest(episode['run_id'], temp_directory=temp_directory)) as manifest:
+            manifest.check_input(episode['input_file'])
+            finished = manifest.get('flashcard-generator', episode['pleco_file']) is not None
+        if finished and os.path.exists(episode['pleco_file']):
+            continue
+        unfinished_episodes.append(episode)
+    if verbose and len(unfinished_episodes) < len(episodes):
+        print(f'Skipping {len(episodes) - len(unfinished_episodes)} episodes finished by an earlier run', flush=True)
+
+    stages = [('decode', closing_manifest_on_failure(decode), decode_workers),
+              # One thread only: Whisper models are shared by every thread and whisper.decode
+              # isn't thread-safe (see utils/models.py); transcribing faster takes worker processes
+              ('transcribe', closing_manifest_on_failure(transcribe), 1),
+              ('translate', translate, translate_workers)]
+    return run_pipeline(unfinished_episodes, stages, queue_size=queue_size, verbose=verbose)
+
+'''
+Media files in input_paths (directories are searched recursively), as episode
+dicts in name order. An episode's name (also its run_id and the stem of its
+output files) is its path relative to the directory it was found in, with
+subdirectories joined by '_', e.g. show/S1/E01.mkv -> S1_E01 when show/ is
+given. Two inputs that would share a name are an error, since they'd share a
+run manifest and output files.
+'''
+def find_media_files(input_paths):
+    media_files = []
+    for path in input_paths:
+        if os.path.isdir(path):
+            for directory, _, files in os.walk(path):
+                media_files.extend((os.path.join(directory, file), path) for file in files if file.lower().endswith(MEDIA_EXTENSIONS))
+        else:
+            media_files.append((path, os.path.dirname(path)))
+
+    episodes = []
+    input_files_by_name = {}
+    for input_file, root in sorted(media_files):
+        name = os.path.splitext(os.path.relpath(input_file, root or os.curdir))[0].replace(os.sep, '_')
+        if name in input_files_by_name:
+            raise Exception(f'{input_files_by_name[name]} and {input_file} would both be named {name}')
+        input_files_by_name[name] = input_file
+        episodes.append({'input_file': input_file, 'name': name, 'run_id': name, 'ebook': input_file.lower().endswith(EBOOK_EXTENSIONS)})
+    return episodes
+
+'''
+run_pipeline pushes items through stages, a list of (name, function, workers).
+Every stage runs `workers` threads that take items off the stage's input queue,
+call function(item) and put the result on the next stage's queue. Queues hold
+at most queue_size items, so upstream stages block instead of running ahead.
+
+An item that raises is logged and dropped; the rest keep going. Returns the
+items that made it through every stage, and prints per-stage busy time when
+verbose.
+'''
+def run_pipeline(items, stages, queue_size=DEFAULT_QUEUE_SIZE, verbose=False):
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages] + [queue.Queue()]
+    stage_time = {name: 0.0 for name, _, _ in stages}
+    failures = []
+    lock = threading.Lock()
+
+    def worker(stage_index, finished_workers):
+        name, function, workers = stages[stage_index]
+        while True:
+            item = queues[stage_index].get()
+            if item is END_OF_INPUT:
+                break
+
+            start = time.perf_counter()
+            try:
+                result = function(item)
+            except Exception:
+                with lock:
+                    failures.append((name, item))
+                print(f'[{name}] {item.get("name", item)} failed:\n{traceback.format_exc()}', flush=True)
+                continue
+            with lock:
+                stage_time[name] += time.perf_counter() - start
+            if verbose:
+                print(f'[{name}] {result.get("name", result)} done in {time.perf_counter() - start:.1f}s', flush=True)
+            queues[stage_index+1].put(result)
+
+        # The last worker of a stage to finish tells every worker of the next stage to stop
+        with lock:
+            finished_workers[stage_index] += 1
+            last_worker = finished_workers[stage_index] == workers
+        if last_worker:
+            next_workers = stages[stage_index+1][2] if stage_index + 1 < len(stages) else 1
+            for _ in range(next_workers):
+                queues[stage_index+1].put(END_OF_INPUT)
+
+    finished_workers = [0] * len(stages)
+    threads = []
+    for stage_index, (name, _, workers) in enumerate(stages):
+        for i in range(workers):
+            thread = threading.Thread(target=worker, args=(stage_index, finished_workers), name=f'{name}-{i}', daemon=True)
+            thread.start()
+            threads.append(thread)
+
+    start = time.perf_counter()
+    for item in items:
+        queues[0].put(item)
+    for _ in range(stages[0][2]):
+        queues[0].put(END_OF_INPUT)
+
+    completed = []
+    while True:
+        item = queues[-1].get()
+        if item is END_OF_INPUT:
+            break
+        completed.append(item)
+    for thread in threads:
+        thread.join()
+
+    if verbose:
+        elapsed = time.perf_counter() - start
+        print(f'Processed {len(completed)} of {len(items)} items in {elapsed:.1f}s ({len(failures)} failed)', flush=True)
+        for name, busy in stage_time.items():
+            print(f'\t{name}: {busy:.1f}s busy', flush=True)
+    return completed
+
+# Wraps an object (a TranscriptionCache or TranslationMemory) so that its methods
+# can be called from several threads, one call at a time
+class Locked:
+    def __init__(self, wrapped):
+        self.wrapped = wrapped
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attribute = getattr(self.wrapped, name)
+        if not callable(attribute):
+            return attribute
+
+        def locked_method(*args, **kwargs):
+            with self.lock:
+                return attribute(*args, **kwargs)
+        return locked_method
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create Pleco flashcards out of Chinese media.')
+    parser.add_argument('inputs', nargs='+', help='Media files and/or directories of media files')
+    parser.add_argument('--output_dir', default='flashcards')
+    parser.add_argument('--whisper_model', default='small')
+    parser.add_argument('--whisper_prompt', default='以下为中文。')
+    parser.add_argument('--speech_threshold', type=float, default=0.5)
+    parser.add_argument('--model', default='gpt-3.5-turbo', help='Chat model used for the flashcards')
+    parser.add_argument('--known_word_list', help='File of known words, one per line; only sentences with a few unknown words become cards')
+    parser.add_argument('--max_unknown_words', type=int, default=MAX_UNKNOWN_WORDS, help='Most unknown words in a card\'s sentence (with --known_word_list)')
+    parser.add_argument('--max_cards', type=int, help='Most cards per episode (with --known_word_list)')
+    parser.add_argument('--max_cost', type=float, help='Most estimated API spend per episode, in dollars (with --known_word_list)')
+    parser.add_argument('--decode_workers', type=int, default=1)
+    parser.add_argument('--translate_workers', type=int, default=2)
+    parser.add_argument('--queue_size', type=int, default=DEFAULT_QUEUE_SIZE, help='Episodes allowed to wait between stages')
+    parser.add_argument('--no_cache', action='store_true', help="Don't use the transcription cache or translation memory")
+    parser.add_argument('--metrics_file', help='Write a JSON report of per-stage timings, memory and API cost here')
+    parser.add_argument('--profile', help='Write cProfile stats of the run here (open with pstats or snakeviz)')
+    args = parser.parse_args()
+
+    cache = None if args.no_cache else TranscriptionCache()
+    memory = None if args.no_cache else TranslationMemory()
+    # Word boundaries for --known_word_list, and local traditional characters and pinyin
+    dictionary = cedict.load_cedict() if os.path.exists(cedict.DEFAULT_CEDICT_FILE) else None
+    metrics = Metrics()
+    profile = metrics.profile(args.profile) if args.profile else contextlib.nullcontext()
+    with profile:
+        flashcard_generator(args.inputs, args.output_dir,
+                            whisper_model=args.whisper_model,
+                            whisper_prompt=args.whisper_prompt,
+                            speech_threshold=args.speech_threshold,
+                            model=args.model,
+                            known_words=read_known_words(args.known_word_list) if args.known_word_list else [],
+                            max_unknown_words=args.max_unknown_words,
+                            max_cards=args.max_cards,
+                            max_cost=args.max_cost,
+                            decode_workers=args.decode_workers,
+                            translate_workers=args.translate_workers,
+                            queue_size=args.queue_size,
+                            cache=cache,
+                            memory=memory,
+                            dictionary=dictionary,
+                            metrics=metrics,
+                            verbose=True)
+    metrics.print_report()
+    if args.metrics_file:
+        metrics.save(args.metrics_file)
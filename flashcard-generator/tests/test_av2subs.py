@@ -0,0 +1,32 @@
+from av2subs import WHISPER_TIME_PRECISION, segmentsFromTokens
+
+# Text tokens are indexes into VOCABULARY; timestamp tokens start at timestamp_begin
+VOCABULARY = ['你好', '。', '我们', '走吧', ' ']
+
+class FakeTokenizer:
+    timestamp_begin = 100
+
+    def decode(self, tokens):
+        return ''.join(VOCABULARY[token] for token in tokens)
+
+def timestamp(seconds):
+    return FakeTokenizer.timestamp_begin + round(seconds / WHISPER_TIME_PRECISION)
+
+def test_segments_between_timestamp_pairs():
+    tokens = [timestamp(0.0), 0, 1, timestamp(1.2), timestamp(1.2), 2, 3, timestamp(2.4)]
+    assert segmentsFromTokens(tokens, FakeTokenizer(), duration=5.0) == [
+        {'start': 0.0, 'end': 1.2, 'text': '你好。'},
+        {'start': 1.2, 'end': 2.4, 'text': '我们走吧'}
+    ]
+
+def test_unclosed_segment_runs_to_end_of_chunk():
+    tokens = [timestamp(0.0), 0, timestamp(1.0), timestamp(1.0), 2, 3]
+    segments = segmentsFromTokens(tokens, FakeTokenizer(), duration=3.5)
+    assert segments[-1] == {'start': 1.0, 'end': 3.5, 'text': '我们走吧'}
+
+def test_blank_segments_are_dropped():
+    tokens = [timestamp(0.0), 4, timestamp(0.5), timestamp(0.5), 0, timestamp(1.0)]
+    assert segmentsFromTokens(tokens, FakeTokenizer(), duration=1.0) == [{'start': 0.5, 'end': 1.0, 'text': '你好'}]
+
+def test_text_without_timestamps():
+    assert segmentsFromTokens([0, 1], FakeTokenizer(), duration=2.0) == [{'start': 0.0, 'end': 2.0, 'text': '你好。'}]
@@ -0,0 +1,13 @@
+from epub2txt import split_sentences
+
+def test_split_after_sentence_endings():
+    assert split_sentences('你好！我们走吧。好的') == ['你好！', '我们走吧。', '好的']
+
+def test_closing_quotes_stay_with_their_sentence():
+    assert split_sentences('他说：“走吧。”她没说话。') == ['他说：“走吧。”', '她没说话。']
+
+def test_repeated_endings_and_spaces():
+    assert split_sentences('真的吗？？是的…… 再见') == ['真的吗？？', '是的……', '再见']
+
+def test_empty_paragraph():
+    assert split_sentences('') == []
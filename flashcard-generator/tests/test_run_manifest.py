@@ -0,0 +1,39 @@
+import os
+
+from run_manifest import RunManifest
+
+def test_truncated_last_entry_is_dropped(tmp_path):
+    manifest = RunManifest('run', temp_directory=tmp_path)
+    manifest.record('translate', 'a', 'first')
+    manifest.record('translate', 'b', 'second')
+    manifest.close()
+    manifest_file = manifest.manifest_file
+    valid_bytes = os.path.getsize(manifest_file)
+    # What a crash halfway through writing an entry leaves behind
+    with open(manifest_file, 'ab') as fp:
+        fp.write(b'{"stage": "translate", "key": "c", "val')
+
+    manifest = RunManifest('run', temp_directory=tmp_path)
+    assert manifest.get('translate', 'a') == 'first'
+    assert manifest.get('translate', 'b') == 'second'
+    assert manifest.get('translate', 'c') is None
+    assert os.path.getsize(manifest_file) == valid_bytes
+
+    # New entries start on a line of their own
+    manifest.record('translate', 'c', 'third')
+    manifest.close()
+    manifest = RunManifest('run', temp_directory=tmp_path)
+    assert manifest.completed('translate') == 3
+    manifest.close()
+
+def test_entry_without_newline_is_dropped(tmp_path):
+    manifest = RunManifest('run', temp_directory=tmp_path)
+    manifest.record('vad', '0.5', [[0, 100]])
+    manifest.close()
+    with open(manifest.manifest_file, 'ab') as fp:
+        fp.write(b'{"stage": "vad", "key": "0.6", "value": [[0, 200]]}')
+
+    manifest = RunManifest('run', temp_directory=tmp_path)
+    assert manifest.get('vad', '0.5') == [[0, 100]]
+    assert manifest.get('vad', '0.6') is None
+    manifest.close()
@@ -0,0 +1,16 @@
+from sentence_ranking import Segmenter
+
+def test_unknown_words_come_from_the_dictionary():
+    segmenter = Segmenter(['我们', '今天'], dictionary={'公园': ('公園', 'gong1 yuan2')})
+    assert segmenter.segment('我们今天去公园玩') == ['我们', '今天', '去', '公园', '玩']
+    assert segmenter.unknown_words('我们今天去公园玩。') == ['去', '公园', '玩']
+
+def test_fewest_words_then_fewest_unknown():
+    # 研究生|命|起源 and 研究|生命|起源 are both three words; 生命 is known
+    segmenter = Segmenter(['生命'], dictionary={'研究': None, '研究生': None, '命': None, '起源': None})
+    assert segmenter.segment('研究生命起源') == ['研究', '生命', '起源']
+
+def test_characters_outside_the_vocabulary():
+    segmenter = Segmenter(['你好'])
+    assert segmenter.segment('你好，ab') == ['你好', '，', 'a', 'b']
+    assert segmenter.unknown_words('你好，ab') == []
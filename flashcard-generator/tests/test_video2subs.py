@@ -0,0 +1,68 @@
+import numpy as np
+
+import video2subs
+from av2subs import AUDIO_SAMPLE_RATE
+
+# Fake audio: each sample holds its own time in seconds, so the stubbed
+# transcriber can tell which part of the input a window covers
+def fake_stream(duration):
+    def streamAudio(input_file, window_seconds):
+        samples = np.arange(int(duration * AUDIO_SAMPLE_RATE), dtype=np.float64) / AUDIO_SAMPLE_RATE
+        block = int(window_seconds * AUDIO_SAMPLE_RATE)
+        for start in range(0, len(samples), block):
+            yield samples[start: start+block].astype(np.float32)
+    return streamAudio
+
+'''
+Stands in for Whisper: a window hears every segment of timeline that starts
+inside it, with times relative to the window. Segments running past the end of
+the window are cut off there, as Whisper would hear them. retimed maps a
+window's start time to the timeline that window hears instead.
+'''
+def fake_transcriber(timeline, retimed={}):
+    def transcribeChunksInProcess(audio_chunks, whisper_model, whisper_prompt, batch_size):
+        window = audio_chunks[0]
+        offset = round(float(window[0]), 3)
+        end = offset + len(window) / AUDIO_SAMPLE_RATE
+        heard = [{'start': start - offset, 'end': min(stop, end) - offset, 'text': text if stop <= end else text[:1]}
+                 for start, stop, text in retimed.get(offset, timeline) if offset <= start < end]
+        return [heard]
+    return transcribeChunksInProcess
+
+def transcribe(monkeypatch, timeline, duration, retimed={}):
+    monkeypatch.setattr(video2subs, 'streamAudio', fake_stream(duration))
+    monkeypatch.setattr(video2subs, 'transcribeChunksInProcess', fake_transcriber(timeline, retimed))
+    return list(video2subs.transcribeStream('input.mp4', 'tiny', '', window_seconds=30, overlap_seconds=5))
+
+def test_overlapping_windows(monkeypatch):
+    monkeypatch.setattr(video2subs, 'streamAudio', fake_stream(60))
+    windows = [(start / AUDIO_SAMPLE_RATE, len(window) / AUDIO_SAMPLE_RATE, float(window[0]))
+               for start, window in video2subs.overlappingWindows('input.mp4', window_seconds=30, overlap_seconds=5)]
+    # The first window has no overlap to carry; later ones start 5 seconds early
+    assert windows == [(0.0, 25.0, 0.0), (20.0, 30.0, 20.0), (45.0, 15.0, 45.0)]
+
+def test_every_segment_once_across_seams(monkeypatch):
+    timeline = [(start, start + 2.0, f'第{i}句话') for i, start in enumerate(np.arange(0.0, 68.0, 3.0))]
+    segments = transcribe(monkeypatch, timeline, duration=70)
+    assert [segment['text'] for segment in segments] == [text for _, _, text in timeline]
+    assert [(segment['start'], segment['end']) for segment in segments] == \
+           [(float(start), float(stop)) for start, stop, _ in timeline]
+
+def test_segment_cut_by_window_end_is_replaced(monkeypatch):
+    # 24-27s runs past the end of the first window (25s), which only hears '你'
+    timeline = [(10.0, 12.0, '我们走吧'), (24.0, 27.0, '你好世界'), (40.0, 42.0, '再见')]
+    segments = transcribe(monkeypatch, timeline, duration=50)
+    assert [segment['text'] for segment in segments] == ['我们走吧', '你好世界', '再见']
+
+def test_repeat_heard_differently_is_dropped(monkeypatch):
+    # The second window (from 20s) hears the sentence before the seam (22.5s) a little
+    # later and with an extra word, so its midpoint lands past the seam
+    timeline = [(21.5, 23.4, '我们去公园'), (30.0, 32.0, '好的')]
+    retimed = {20.0: [(21.6, 23.6, '我们去公园吧。'), (30.0, 32.0, '好的')]}
+    segments = transcribe(monkeypatch, timeline, duration=40, retimed=retimed)
+    assert [segment['text'] for segment in segments] == ['我们去公园', '好的']
+
+def test_different_sentence_overlapping_the_seam_is_kept(monkeypatch):
+    timeline = [(21.5, 23.4, '我们去公园'), (23.0, 24.0, '好的')]
+    segments = transcribe(monkeypatch, timeline, duration=40)
+    assert [(segment['start'], segment['text']) for segment in segments] == [(21.5, '我们去公园'), (23.4, '好的')]
@@ -1,20 +1,76 @@
 import os
 import random
 import subprocess
+import multiprocessing
+import tempfile
+import wave
 
-from pydub import AudioSegment
-import torch
+import numpy as np
 import pysrt
-import onnxruntime as ort
+
+# torch and whisper are imported inside the functions that need them (and
+# loaded through the model registry), so importing av2subs stays cheap
+import models
+from metrics import NoMetrics
+from run_manifest import RunManifest, atomic_output, content_key, file_fingerprint
+from transcription_cache import chunk_key
 
 RUN_ID = random.randint(100000, 999999)
 DEFAULT_TEMP_DIRECTORY = 'temp'
-# silero-vad spits out tons of warnings that are out of our control without this
-ort.set_default_logger_severity(3)
 # silero-vad only suppored 16kHz and 8kHz sample rates
 AUDIO_SAMPLE_RATE = 16000
+# Bytes read from ffmpeg's stdout at a time while decoding
+FFMPEG_READ_SIZE = 1 << 20
+# silero-vad settings used by both chunkAudio and the streaming pipeline
+SPEECH_PAD_MS = 200
+MIN_SILENCE_DURATION_MS = 200
+# silero-vad's streaming iterator expects 512 sample frames at 16kHz
+VAD_FRAME_SAMPLES = 512
+# Streaming mode: seconds of audio decoded per read, and longest speech chunk
+# before it is cut and sent to Whisper (Whisper's own window is 30 seconds)
+STREAM_WINDOW_SECONDS = 10
+MAX_STREAM_CHUNK_SECONDS = 30
+# Most of ffmpeg's stderr quoted when streaming decode fails (the end has the actual error)
+FFMPEG_ERROR_TAIL_BYTES = 4096
+# Decoding settings shared by the whisper CLI call and the in-process engine
+WHISPER_LANGUAGE = 'zh'
+WHISPER_BEAM_SIZE = 5
+WHISPER_PATIENCE = 2
+# Whisper's temperature fallback (the defaults of whisper.transcribe and the CLI):
+# a result that looks like a repetition loop (text compresses too well) or that
+# the model isn't confident in is decoded again at the next temperature, sampling
+# best_of candidates, unless the model thinks the audio is silence
+WHISPER_TEMPERATURES = (0.0, 0.2, 0.4, 0.6, 0.8, 1.0)
+WHISPER_BEST_OF = 5
+WHISPER_COMPRESSION_RATIO_THRESHOLD = 2.4
+WHISPER_LOGPROB_THRESHOLD = -1.0
+WHISPER_NO_SPEECH_THRESHOLD = 0.6
+# Whisper timestamp tokens are spaced 20ms apart
+WHISPER_TIME_PRECISION = 0.02
+# Number of VAD chunks decoded together by the in-process engine
+DEFAULT_BATCH_SIZE = 8
+# CPU parallel transcription: intra-op threads given to each worker process and
+# number of chunks each worker decodes at once. Batching helps far less on CPU
+# than on GPU, so workers take small batches and pull new ones more often.
+CPU_THREADS_PER_WORKER = 4
+CPU_BATCH_SIZE = 2
+# Settings of a transcribeChunksParallel worker, set by _initTranscriptionWorker
+_WORKER_SETTINGS = {}
+
+'''
+audio2subs transcribes input_file into temp/<run_id>/transcript.srt.
+
+Finished work is recorded in the run's manifest (see run_manifest.py): the VAD
+segments and every transcribed chunk. Calling audio2subs again with the same
+run_id after a crash only transcribes the chunks that weren't done, and returns
+straight away if the whole transcript was already written with these settings.
 
-def audio2subs(input_file, speech_threshold=0.5, whisper_model='small', whisper_prompt='以下为中文。', temp_directory=DEFAULT_TEMP_DIRECTORY, run_id=RUN_ID, verbose=False):  
+If a Metrics is given (see metrics.py), the decode, vad, transcribe and combine
+stages are timed in it.
+'''
+def audio2subs(input_file, speech_threshold=0.5, whisper_model='small', whisper_prompt='以下为中文。', engine='inprocess', batch_size=None, workers=1, mmap=False, cache=None, metrics=None, temp_directory=DEFAULT_TEMP_DIRECTORY, run_id=RUN_ID, verbose=False):
+    if metrics is None:
+        metrics = NoMetrics()
     if verbose:
         print('\nAV2SUBS\n=======', flush=True)
         print(f'Run ID: {run_id}', flush=True)
@@ -24,41 +80,100 @@ def audio2subs(input_file, speech_threshold=0.5, whisper_model='small', whisper_
     if not os.path.exists(f'{temp_directory}/{run_id}'):
         os.mkdir(f'{temp_directory}/{run_id}')
 
+    manifest = RunManifest(run_id, temp_directory=temp_directory)
+    manifest.check_input(input_file)
+    output_key = content_key(speech_threshold, engine, whisperSettings(whisper_model, whisper_prompt))
+    finished_output = manifest.get('audio2subs', output_key)
+    if finished_output is not None and all(os.path.exists(file) for file in [finished_output['srt_file']] + finished_output['temp_srt_files']):
+        if verbose:
+            print(f'Transcript already finished in run {run_id}: {finished_output["srt_file"]}', flush=True)
+        manifest.close()
+        return finished_output['srt_file'], finished_output['temp_srt_files']
+
     if verbose:
         print(f'Loading input file: {input_file}', flush=True)
-    audio, audio_path = extractAudio(input_file, temp_directory=temp_directory, run_id=run_id, verbose=verbose)
+    with metrics.stage('decode', unit='audio_seconds') as stage:
+        audio = extractAudio(input_file, mmap=mmap, temp_directory=temp_directory, run_id=run_id, verbose=verbose)
+        stage.items = len(audio) / AUDIO_SAMPLE_RATE
         
+    if engine not in ('inprocess', 'subprocess'):
+        raise Exception(f'Transcription engine {engine} not supported.')
+    save_chunks = engine == 'subprocess'
+
     if verbose:
         print('Breaking audio into chunks', flush=True)
-    audio_chunks, speech_timestamps_ms = chunkAudio(audio, audio_path, threshold=speech_threshold, temp_directory=temp_directory, run_id=run_id, verbose=verbose)
+    with metrics.stage('vad', unit='audio_seconds') as stage:
+        audio_chunks, speech_timestamps_ms = chunkAudio(audio, threshold=speech_threshold, save_chunks=save_chunks, manifest=manifest, temp_directory=temp_directory, run_id=run_id, verbose=verbose)
+        stage.items = len(audio) / AUDIO_SAMPLE_RATE
 
     if verbose:
         print('Feeding chunks into Whisper', flush=True)
-    temp_srt_files = transcribeChunks(audio_chunks, whisper_model, whisper_prompt, temp_directory=temp_directory, run_id=run_id, verbose=verbose)
+    if engine == 'subprocess':
+        with metrics.stage('transcribe', unit='chunks', items=len(audio_chunks)):
+            temp_srt_files = transcribeChunks(audio_chunks, whisper_model, whisper_prompt, manifest=manifest, temp_directory=temp_directory, run_id=run_id, verbose=verbose)
 
-    if verbose:
-        print('Combining output .srt files into one file', flush=True)
-    combined_srt_file = combineSubtitleFiles(temp_srt_files, speech_timestamps_ms, temp_directory=temp_directory, run_id=run_id)
+        if verbose:
+            print('Combining output .srt files into one file', flush=True)
+        with metrics.stage('combine', unit='chunks', items=len(audio_chunks)):
+            combined_srt_file = combineSubtitleFiles(temp_srt_files, speech_timestamps_ms, temp_directory=temp_directory, run_id=run_id)
+    else:
+        temp_srt_files = []
+        with metrics.stage('transcribe', unit='chunks', items=len(audio_chunks)):
+            chunk_segments = transcribeChunksCached(audio_chunks, whisper_model, whisper_prompt, cache, batch_size=batch_size, workers=workers, manifest=manifest, verbose=verbose)
+
+        if verbose:
+            print('Combining transcribed segments into one file', flush=True)
+        with metrics.stage('combine', unit='chunks', items=len(audio_chunks)):
+            combined_srt_file = combineSegments(chunk_segments, speech_timestamps_ms, temp_directory=temp_directory, run_id=run_id)
+
+    if verbose and cache is not None:
+        stats = cache.stats()
+        print(f'Transcription cache: {stats["hits"]} hits, {stats["misses"]} misses ({stats["hit_rate"]:.0%} hit rate)', flush=True)
 
+    manifest.record('audio2subs', output_key, {'srt_file': combined_srt_file, 'temp_srt_files': temp_srt_files})
+    manifest.close()
     return combined_srt_file, temp_srt_files
 
-# Extracts audio from file
-def extractAudio(input_file, temp_directory=DEFAULT_TEMP_DIRECTORY, run_id=RUN_ID, verbose=False):
-    file_type = input_file.split('.')[-1]
-    try:
-        audio = AudioSegment.from_file(input_file, file_type)
-    except:
-        raise Exception(f'File type {file_type} not supported.')
-    
-    audio = audio.set_frame_rate(AUDIO_SAMPLE_RATE)
+'''
+extractAudio decodes the input once with ffmpeg into a single 16kHz mono
+float32 buffer. Everything downstream (VAD, chunking, transcription) works on
+views of this buffer, so the audio never goes through a .wav on disk.
+
+For very long inputs, mmap=True has ffmpeg write the raw samples to
+temp/<run_id>/audio.f32 and memory-maps that file instead of holding the
+whole track in RAM.
+'''
+def extractAudio(input_file, mmap=False, temp_directory=DEFAULT_TEMP_DIRECTORY, run_id=RUN_ID, verbose=False):
+    cmd = ['ffmpeg', '-nostdin', '-loglevel', 'error', '-i', input_file, 
+           '-vn', '-f', 'f32le', '-ac', '1', '-ar', str(AUDIO_SAMPLE_RATE)]
+
+    if mmap:
+        audio_path = f'{temp_directory}/{run_id}/audio.f32'
+        if verbose:
+            print(f'\tDecoding audio to memory-mapped file {audio_path}', flush=True)
+        result = subprocess.run(cmd + ['-y', audio_path], stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise Exception(f'Could not decode audio from {input_file}: {result.stderr.decode("utf-8", "replace")}')
+        # Copy-on-write keeps the array writable (torch expects that) without touching the file
+        return np.memmap(audio_path, dtype=np.float32, mode='c')
 
-    audio_path = f'{temp_directory}/{run_id}/audio.wav'
     if verbose:
-        print(f'\tSaving extracted audio to {audio_path}')
-    with open(audio_path, 'wb+') as out:
-        audio.export(out, format='wav')
-        
-    return audio, audio_path
+        print('\tDecoding audio into memory', flush=True)
+    # stderr goes to a file rather than a second pipe: ffmpeg would block once the pipe
+    # filled up with decode errors while we're still reading stdout
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(cmd + ['-'], stdout=subprocess.PIPE, stderr=stderr)
+        buffer = bytearray()
+        while True:
+            data = process.stdout.read(FFMPEG_READ_SIZE)
+            if not data:
+                break
+            buffer.extend(data)
+        if process.wait() != 0:
+            stderr.seek(0)
+            raise Exception(f'Could not decode audio from {input_file}: {stderr.read().decode("utf-8", "replace")}')
+
+    return np.frombuffer(buffer, dtype=np.float32)
 
 '''
 chunkAudio breaks the input audio into chunks such that there are no silences
@@ -73,29 +188,41 @@ Potential improvements:
 2. Make sure that no chunk is greater than 25mb. (See also: old chunkAudio
    audio version at the end of this file)
 3. We could try to isolate the voices from any backgroud noise.
+
+With save_chunks=False, the chunks are returned as views into the audio buffer
+from extractAudio instead of being written to .wav files. This is what the
+in-process Whisper engine consumes.
+
+If a RunManifest is given, speech timestamps it already has for this threshold
+are reused instead of running silero-vad again, and new ones are recorded.
 '''
-def chunkAudio(audio, audio_path, threshold=0.5, temp_directory=DEFAULT_TEMP_DIRECTORY, run_id=RUN_ID, verbose=False):
+def chunkAudio(audio, threshold=0.5, save_chunks=True, manifest=None, temp_directory=DEFAULT_TEMP_DIRECTORY, run_id=RUN_ID, verbose=False):
     output_dir = f'{temp_directory}/{run_id}/audio_chunks'
-    if not os.path.exists(output_dir):
+    if save_chunks and not os.path.exists(output_dir):
         os.mkdir(output_dir)
 
-    if verbose:
-        print('\tLoading silero-vad and detecting speech timestamps', flush=True)
-    model, utils = torch.hub.load(repo_or_dir='snakers4/silero-vad',
-                                model='silero_vad',
-                                onnx=True,
-                                verbose=False)
-    (get_speech_timestamps, _, read_audio, _, _) = utils
-    audio_for_vad = read_audio(audio_path, AUDIO_SAMPLE_RATE)
-    speech_timestamps = get_speech_timestamps(audio_for_vad, 
-                                            model, 
-                                            threshold=threshold,
-                                            sampling_rate=AUDIO_SAMPLE_RATE,
-                                            speech_pad_ms=200,
-                                            min_silence_duration_ms=200)
+    speech_timestamps = manifest.get('vad', str(threshold)) if manifest is not None else None
+    if speech_timestamps is not None:
+        if verbose:
+            print(f'\tReusing {len(speech_timestamps)} speech timestamps from the run manifest', flush=True)
+    else:
+        import torch
+        if verbose:
+            print('\tLoading silero-vad and detecting speech timestamps', flush=True)
+        model, utils = loadSileroVad()
+        (get_speech_timestamps, _, _, _, _) = utils
+        # torch.from_numpy shares memory with the buffer, so VAD doesn't copy the audio
+        speech_timestamps = get_speech_timestamps(torch.from_numpy(audio), 
+                                                model, 
+                                                threshold=threshold,
+                                                sampling_rate=AUDIO_SAMPLE_RATE,
+                                                speech_pad_ms=SPEECH_PAD_MS,
+                                                min_silence_duration_ms=MIN_SILENCE_DURATION_MS)
+        if manifest is not None:
+            manifest.record('vad', str(threshold), speech_timestamps)
     
     if verbose:
-        print(f'\tSaving audio chunks', flush=True)
+        print(f'\t{"Saving" if save_chunks else "Slicing"} audio chunks', flush=True)
     output_files = []
     speech_timestamps_ms = []
     samples_to_ms_factor = AUDIO_SAMPLE_RATE / 1000
@@ -104,79 +231,493 @@ def chunkAudio(audio, audio_path, threshold=0.5, temp_directory=DEFAULT_TEMP_DIR
         speech_end_ms = speech_timestamps[i]['end'] // samples_to_ms_factor
         speech_timestamps_ms.append((speech_start_ms, speech_end_ms))
 
-        audio_chunk = audio[speech_start_ms: speech_end_ms]
+        audio_chunk = audio[speech_timestamps[i]['start']: speech_timestamps[i]['end']]
+        if not save_chunks:
+            output_files.append(audio_chunk)
+            continue
+
         output_files.append(f'{output_dir}/chunked_audio_{i+1}.wav')
-        with open(output_files[-1], 'wb+') as out:
-            audio_chunk.export(out, format='wav')
+        saveWav(audio_chunk, output_files[-1])
 
     return output_files, speech_timestamps_ms
 
-# Use command-line Whisper to transcribe each chunk
-def transcribeChunks(input_files, whisper_model, whisper_prompt, temp_directory=DEFAULT_TEMP_DIRECTORY, run_id=RUN_ID, verbose=False):    
+# Loads silero-vad once per process, from the pinned local copy (see models.py)
+def loadSileroVad():
+    return models.load_silero_vad()
+
+# Writes float32 samples as a 16-bit PCM .wav (only needed by the whisper CLI engine)
+def saveWav(samples, output_file):
+    pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype(np.int16)
+    with wave.open(output_file, 'wb') as out:
+        out.setnchannels(1)
+        out.setsampwidth(2)
+        out.setframerate(AUDIO_SAMPLE_RATE)
+        out.writeframes(pcm.tobytes())
+
+# Use command-line Whisper to transcribe each chunk. Chunks a RunManifest
+# already has an .srt for (same .wav, same settings) are skipped.
+def transcribeChunks(input_files, whisper_model, whisper_prompt, manifest=None, temp_directory=DEFAULT_TEMP_DIRECTORY, run_id=RUN_ID, verbose=False):    
     output_dir = f'{temp_directory}/{run_id}/transcript_chunks'
     if not os.path.exists(output_dir):
         os.mkdir(output_dir)
 
+    settings = whisperSettings(whisper_model, whisper_prompt)
     output_files = []
     for i in range(len(input_files)):
         output_files.append(f'{output_dir}/chunked_audio_{i+1}.srt')
+        if manifest is not None:
+            key = content_key(file_fingerprint(input_files[i]), settings)
+            if manifest.get('transcribe', key) == output_files[-1] and os.path.exists(output_files[-1]):
+                continue
         
         if verbose:
             print(f'\tWorking on transcribing chunk {i+1} of {len(input_files)}', flush=True)
-        cmd = (f'whisper {input_files[i]} --model {whisper_model} '
-               f'--initial_prompt "{whisper_prompt}" --patience 2 '
-               f'--output_dir {output_dir} --output_format srt ' 
-               f'--language zh --task transcribe --verbose False')
+        cmd = ['whisper', input_files[i], '--model', whisper_model,
+               '--initial_prompt', whisper_prompt, '--patience', str(WHISPER_PATIENCE),
+               '--output_dir', output_dir, '--output_format', 'srt',
+               '--language', WHISPER_LANGUAGE, '--task', 'transcribe', '--verbose', 'False']
         subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+        if manifest is not None:
+            manifest.record('transcribe', key, output_files[-1])
 
     return output_files
 
+'''
+transcribeChunksCached looks each chunk up in the run's manifest and then in a
+TranscriptionCache (see transcription_cache.py), and only sends the misses to
+the in-process engine (or to the worker pool when workers > 1). Each result is
+written to the manifest and the cache as soon as its batch finishes, so a crash
+only loses the batches that were in flight. With cache=None and manifest=None
+every chunk is transcribed.
+'''
+def transcribeChunksCached(audio_chunks, whisper_model, whisper_prompt, cache, batch_size=None, workers=1, manifest=None, verbose=False):
+    chunk_segments = [None] * len(audio_chunks)
+    if cache is not None or manifest is not None:
+        settings = whisperSettings(whisper_model, whisper_prompt)
+        keys = [chunk_key(audio_chunk, settings) for audio_chunk in audio_chunks]
+    if manifest is not None:
+        chunk_segments = [manifest.get('transcribe', key) for key in keys]
+        if verbose:
+            resumed = sum(segments is not None for segments in chunk_segments)
+            print(f'\t{resumed} of {len(audio_chunks)} chunks already transcribed in this run', flush=True)
+    if cache is not None:
+        for i in range(len(audio_chunks)):
+            if chunk_segments[i] is None:
+                chunk_segments[i] = cache.get(keys[i])
+    missing_chunks = [i for i in range(len(audio_chunks)) if chunk_segments[i] is None]
+
+    if verbose and cache is not None:
+        print(f'\t{len(audio_chunks) - len(missing_chunks)} of {len(audio_chunks)} chunks found in transcription cache', flush=True)
+    if not missing_chunks:
+        return chunk_segments
+
+    # on_transcribed is called with (index into missing_audio, segments) as each chunk finishes
+    def on_transcribed(missing_index, segments):
+        i = missing_chunks[missing_index]
+        chunk_segments[i] = segments
+        if manifest is not None:
+            manifest.record('transcribe', keys[i], segments)
+        if cache is not None:
+            cache.put(keys[i], segments)
+
+    missing_audio = [audio_chunks[i] for i in missing_chunks]
+    if workers > 1:
+        transcribeChunksParallel(missing_audio, whisper_model, whisper_prompt, workers=workers, batch_size=batch_size, on_transcribed=on_transcribed, verbose=verbose)
+    else:
+        transcribeChunksInProcess(missing_audio, whisper_model, whisper_prompt, batch_size=batch_size or DEFAULT_BATCH_SIZE, on_transcribed=on_transcribed, verbose=verbose)
+
+    return chunk_segments
+
+# Everything that affects Whisper's output for a given chunk of audio
+def whisperSettings(whisper_model, whisper_prompt):
+    return {
+        'model': whisper_model,
+        'prompt': whisper_prompt,
+        'language': WHISPER_LANGUAGE,
+        'beam_size': WHISPER_BEAM_SIZE,
+        'patience': WHISPER_PATIENCE,
+        'temperatures': list(WHISPER_TEMPERATURES),
+        'best_of': WHISPER_BEST_OF
+    }
+
+# Loads a Whisper model once per process and keeps it resident for later calls (see models.py)
+def loadWhisperModel(whisper_model, device=None):
+    return models.load_whisper(whisper_model, device=device)
+
+'''
+transcribeChunksInProcess is the in-process counterpart of transcribeChunks.
+The model is loaded once and the in-memory chunks from chunkAudio are decoded
+in batches, so there is no per-chunk process start-up, model load, or
+.wav/.srt round trip.
+
+Chunks that fit in Whisper's 30 second window are padded, stacked and decoded
+together. As in whisper.transcribe, chunks whose result fails the compression
+ratio or log probability checks are decoded again at rising temperatures (see
+decodeWithFallback). Longer chunks fall back to model.transcribe, which slides
+its own window over the audio.
+
+Returns one list of segments per chunk. Each segment is a dict with 'start'
+and 'end' (seconds, relative to the start of the chunk) and 'text'. If given,
+on_transcribed(chunk index, segments) is also called as each batch finishes.
+'''
+def transcribeChunksInProcess(audio_chunks, whisper_model, whisper_prompt, batch_size=DEFAULT_BATCH_SIZE, device=None, on_transcribed=None, verbose=False):
+    import torch
+    import whisper
+    model = loadWhisperModel(whisper_model, device=device)
+    fp16 = model.device.type == 'cuda'
+    tokenizer = whisper.tokenizer.get_tokenizer(model.is_multilingual, 
+                                                num_languages=model.num_languages,
+                                                language=WHISPER_LANGUAGE, 
+                                                task='transcribe')
+    options = whisper.DecodingOptions(language=WHISPER_LANGUAGE,
+                                      task='transcribe',
+                                      prompt=whisper_prompt,
+                                      beam_size=WHISPER_BEAM_SIZE,
+                                      patience=WHISPER_PATIENCE,
+                                      fp16=fp16)
+
+    chunk_segments = [None] * len(audio_chunks)
+    short_chunks = [i for i in range(len(audio_chunks)) if len(audio_chunks[i]) <= whisper.audio.N_SAMPLES]
+    long_chunks = [i for i in range(len(audio_chunks)) if len(audio_chunks[i]) > whisper.audio.N_SAMPLES]
+
+    for batch_start in range(0, len(short_chunks), batch_size):
+        batch = short_chunks[batch_start: batch_start+batch_size]
+        if verbose:
+            print(f'\tWorking on transcribing chunks {batch[0]+1}-{batch[-1]+1} of {len(audio_chunks)}', flush=True)
+        mel = torch.stack([whisper.log_mel_spectrogram(whisper.pad_or_trim(audio_chunks[i]), n_mels=model.dims.n_mels) 
+                           for i in batch]).to(model.device)
+        with torch.no_grad():
+            results = decodeWithFallback(model, mel, options)
+        for i, result in zip(batch, results):
+            duration = len(audio_chunks[i]) / AUDIO_SAMPLE_RATE
+            chunk_segments[i] = segmentsFromTokens(result.tokens, tokenizer, duration)
+            if on_transcribed is not None:
+                on_transcribed(i, chunk_segments[i])
+
+    for i in long_chunks:
+        if verbose:
+            print(f'\tWorking on transcribing long chunk {i+1} of {len(audio_chunks)}', flush=True)
+        result = model.transcribe(audio_chunks[i], 
+                                  language=WHISPER_LANGUAGE, 
+                                  initial_prompt=whisper_prompt, 
+                                  beam_size=WHISPER_BEAM_SIZE, 
+                                  patience=WHISPER_PATIENCE, 
+                                  fp16=fp16, 
+                                  verbose=None)
+        chunk_segments[i] = [{'start': segment['start'], 'end': segment['end'], 'text': segment['text'].strip()} 
+                             for segment in result['segments'] if segment['text'].strip()]
+        if on_transcribed is not None:
+            on_transcribed(i, chunk_segments[i])
+
+    return chunk_segments
+
+# Decodes a batch of mel spectrograms, re-decoding the items that need it at each
+# fallback temperature in turn (beam search only applies at temperature 0)
+def decodeWithFallback(model, mel, options):
+    import dataclasses
+    import whisper
+    results = whisper.decode(model, mel, options)
+    for temperature in WHISPER_TEMPERATURES[1:]:
+        failing = [j for j in range(len(results)) if needsFallback(results[j])]
+        if not failing:
+            break
+        sampling_options = dataclasses.replace(options, temperature=temperature, beam_size=None, patience=None, best_of=WHISPER_BEST_OF)
+        for j, result in zip(failing, whisper.decode(model, mel[failing], sampling_options)):
+            results[j] = result
+    return results
+
+# Same checks as whisper.transcribe's decode_with_fallback
+def needsFallback(result):
+    if result.no_speech_prob > WHISPER_NO_SPEECH_THRESHOLD and result.avg_logprob < WHISPER_LOGPROB_THRESHOLD:
+        return False
+    return result.compression_ratio > WHISPER_COMPRESSION_RATIO_THRESHOLD or result.avg_logprob < WHISPER_LOGPROB_THRESHOLD
+
+'''
+transcribeChunksParallel spreads the in-process engine over a pool of CPU
+worker processes. Each worker loads the model once in its initializer, then
+pulls batches of chunks off the pool's shared task queue until it is empty.
+Batches finish in any order, so results are put back by chunk index before
+they are returned (on_transcribed, if given, is called as each batch arrives).
+
+See transcriptionThreadPolicy for how workers, threads and batch sizes are
+chosen when they aren't given.
+'''
+def transcribeChunksParallel(audio_chunks, whisper_model, whisper_prompt, workers=None, batch_size=None, threads_per_worker=None, on_transcribed=None, verbose=False):
+    workers, threads_per_worker, batch_size = transcriptionThreadPolicy(workers, threads_per_worker, batch_size)
+    if verbose:
+        print(f'\tTranscribing with {workers} workers x {threads_per_worker} threads, batches of {batch_size}', flush=True)
+
+    tasks = []
+    for batch_start in range(0, len(audio_chunks), batch_size):
+        indices = list(range(batch_start, min(batch_start+batch_size, len(audio_chunks))))
+        tasks.append((indices, [audio_chunks[i] for i in indices]))
+
+    # Child processes read the OpenMP/MKL thread counts from the environment at start-up
+    thread_env_vars = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS')
+    previous_env = {var: os.environ.get(var) for var in thread_env_vars}
+    for var in thread_env_vars:
+        os.environ[var] = str(threads_per_worker)
+
+    chunk_segments = [None] * len(audio_chunks)
+    # torch doesn't survive fork() well, so workers are always spawned
+    context = multiprocessing.get_context('spawn')
+    try:
+        with context.Pool(workers, 
+                          initializer=_initTranscriptionWorker, 
+                          initargs=(whisper_model, whisper_prompt, threads_per_worker)) as pool:
+            completed = 0
+            for indices, segments in pool.imap_unordered(_transcribeBatch, tasks):
+                for i, chunk_segment in zip(indices, segments):
+                    chunk_segments[i] = chunk_segment
+                    if on_transcribed is not None:
+                        on_transcribed(i, chunk_segment)
+                completed += len(indices)
+                if verbose:
+                    print(f'\tTranscribed {completed} of {len(audio_chunks)} chunks', flush=True)
+    finally:
+        for var, value in previous_env.items():
+            if value is None:
+                os.environ.pop(var)
+            else:
+                os.environ[var] = value
+
+    return chunk_segments
+
+'''
+Picks (workers, threads_per_worker, batch_size) for CPU transcription so that
+workers x threads never exceeds the core count. Any value passed in is kept
+and the others are derived from it:
+- workers defaults to cores // CPU_THREADS_PER_WORKER
+- threads_per_worker defaults to an even split of the cores between workers
+- batch_size defaults to CPU_BATCH_SIZE
+'''
+def transcriptionThreadPolicy(workers=None, threads_per_worker=None, batch_size=None, cpu_count=None):
+    cpu_count = cpu_count or os.cpu_count() or 1
+    if workers is None:
+        workers = max(1, cpu_count // (threads_per_worker or CPU_THREADS_PER_WORKER))
+    if threads_per_worker is None:
+        threads_per_worker = max(1, cpu_count // workers)
+    if batch_size is None:
+        batch_size = CPU_BATCH_SIZE
+    return workers, threads_per_worker, batch_size
+
+def _initTranscriptionWorker(whisper_model, whisper_prompt, threads_per_worker):
+    import torch
+    torch.set_num_threads(threads_per_worker)
+    loadWhisperModel(whisper_model, device='cpu')
+    _WORKER_SETTINGS.update(whisper_model=whisper_model, whisper_prompt=whisper_prompt)
+
+def _transcribeBatch(task):
+    indices, audio_chunks = task
+    segments = transcribeChunksInProcess(audio_chunks, 
+                                         _WORKER_SETTINGS['whisper_model'], 
+                                         _WORKER_SETTINGS['whisper_prompt'], 
+                                         batch_size=len(audio_chunks),
+                                         device='cpu')
+    return indices, segments
+
+# Splits a decoded token sequence into segments using Whisper's timestamp tokens.
+# Timestamps come in pairs around each segment: <|0.00|> text <|2.40|><|2.40|> text ...
+def segmentsFromTokens(tokens, tokenizer, duration):
+    segments = []
+    text_tokens = []
+    segment_start = 0.0
+    for token in tokens:
+        if token < tokenizer.timestamp_begin:
+            text_tokens.append(token)
+            continue
+        timestamp = (token - tokenizer.timestamp_begin) * WHISPER_TIME_PRECISION
+        if text_tokens:
+            segments.append({'start': segment_start, 'end': timestamp, 'text': tokenizer.decode(text_tokens).strip()})
+            text_tokens = []
+        segment_start = timestamp
+
+    # Output without a closing timestamp runs to the end of the chunk
+    if text_tokens:
+        segments.append({'start': segment_start, 'end': duration, 'text': tokenizer.decode(text_tokens).strip()})
+
+    return [segment for segment in segments if segment['text']]
+
 # Combine the output .srt files
 def combineSubtitleFiles(input_files, speech_timestamps, temp_directory=DEFAULT_TEMP_DIRECTORY, run_id=RUN_ID):
-    output_file_name = f'{temp_directory}/{run_id}/transcript.srt'
-    if len(input_files) == 1:
-        os.rename(input_files[0], output_file_name)
-        return 0
+    chunk_segments = []
+    for current_file in input_files:
+        current_subs = pysrt.open(current_file)
+        chunk_segments.append([{'start': sub.start.ordinal / 1000, 'end': sub.end.ordinal / 1000, 'text': sub.text} 
+                               for sub in current_subs])
+
+    return combineSegments(chunk_segments, speech_timestamps, temp_directory=temp_directory, run_id=run_id)
 
+# Combine per-chunk Whisper segments into one .srt file on the input's timeline
+# (output_file, or temp/<run_id>/transcript.srt by default). The file is written
+# atomically, so a crash never leaves a truncated transcript.
+def combineSegments(chunk_segments, speech_timestamps, output_file=None, temp_directory=DEFAULT_TEMP_DIRECTORY, run_id=RUN_ID):
+    output_file_name = output_file or f'{temp_directory}/{run_id}/transcript.srt'
     output_subs = pysrt.SubRipFile()
     subtitle_index = 1 # .srt files start with index 1
-    for chunk_index in range(len(input_files)):
-        current_file = input_files[chunk_index]
-        current_subs = pysrt.open(current_file)
+    for chunk_index in range(len(chunk_segments)):
+        chunk_subs = chunkSubtitles(chunk_segments[chunk_index], speech_timestamps[chunk_index], subtitle_index)
+        output_subs.extend(chunk_subs)
+        subtitle_index += len(chunk_subs)
+        
+    with atomic_output(output_file_name) as temp_file:
+        output_subs.save(temp_file, encoding='utf-8')
+    return output_file_name
+
+# Turns the Whisper segments of one chunk into numbered subtitles, given the
+# chunk's (start, end) VAD timestamp in milliseconds
+def chunkSubtitles(segments, speech_timestamp, subtitle_index):
+    chunk_subs = []
+    chunk_start = pysrt.SubRipTime(milliseconds=speech_timestamp[0])
+    chunk_end = pysrt.SubRipTime(milliseconds=speech_timestamp[1])
 
-        # If the .srt file only has one sub, we'll just use the timestamp from silero_vad
-        if len(current_subs) == 1:
-            output_subs.append(pysrt.SubRipItem(subtitle_index, 
-                            start=pysrt.SubRipTime(milliseconds=speech_timestamps[chunk_index][0]),
-                            end=pysrt.SubRipTime(milliseconds=speech_timestamps[chunk_index][1]),
-                            text=current_subs[0].text))
-            subtitle_index += 1
-        # If more than one sub, we'll use the VAD timestamp as the start of the first sub
-        #   and the end for the final sub, then use the Whisper .srt timestamps for all
-        #   the other subtitles timings. 
+    # If the chunk only has one segment, we'll just use the timestamp from silero_vad
+    if len(segments) == 1:
+        chunk_subs.append(pysrt.SubRipItem(subtitle_index, 
+                        start=chunk_start,
+                        end=chunk_end,
+                        text=segments[0]['text']))
+        return chunk_subs
+
+    # If more than one segment, we'll use the VAD timestamp as the start of the first sub
+    #   and the end for the final sub, then use the Whisper timestamps for all
+    #   the other subtitles timings. 
+    for sub_i in range(len(segments)):
+        segment_start = pysrt.SubRipTime(milliseconds=round(segments[sub_i]['start'] * 1000))
+        segment_end = pysrt.SubRipTime(milliseconds=round(segments[sub_i]['end'] * 1000))
+        if sub_i == 0:
+            # First sub in this chunk
+            start = chunk_start
+            end = chunk_start + segment_end
+        elif sub_i == len(segments) - 1:
+            # Last sub in this chunk
+            start = chunk_start + segment_start
+            end = chunk_end
         else:
-            chunk_start = pysrt.SubRipTime(milliseconds=speech_timestamps[chunk_index][0])
-            chunk_end = pysrt.SubRipTime(milliseconds=speech_timestamps[chunk_index][1])
-            for sub_i in range(len(current_subs)):
-                if sub_i == 0:
-                    # First sub in this file
-                    start = chunk_start
-                    end = chunk_start + current_subs[sub_i].end
-                elif sub_i == len(current_subs) - 1:
-                    # Last sub in this file
-                    start = chunk_start + current_subs[sub_i].start
-                    end = chunk_end
-                else:
-                    start = chunk_start + current_subs[sub_i].start
-                    end = chunk_start + current_subs[sub_i].end
-                
-                output_subs.append(pysrt.SubRipItem(subtitle_index, 
-                                start=start,
-                                end=end,
-                                text=current_subs[sub_i].text))
-                subtitle_index += 1
+            start = chunk_start + segment_start
+            end = chunk_start + segment_end
         
-    output_subs.save(output_file_name, encoding='utf-8')
+        chunk_subs.append(pysrt.SubRipItem(subtitle_index + sub_i, 
+                        start=start,
+                        end=end,
+                        text=segments[sub_i]['text']))
+
+    return chunk_subs
+
+'''
+audio2subsStream is the streaming counterpart of audio2subs. Instead of running
+each stage over the whole input, audio is decoded in windows (streamAudio),
+silero-vad runs frame by frame with its state carried across windows
+(streamSpeechChunks), and each speech chunk is transcribed as soon as it
+closes. Subtitles are yielded as pysrt items (and appended to output_file, if
+given) while the rest of the input is still decoding.
+
+Only the current speech chunk and one decode window are held in memory, so
+memory use doesn't grow with the length of the input.
+'''
+def audio2subsStream(input_file, speech_threshold=0.5, whisper_model='small', whisper_prompt='以下为中文。', output_file=None, window_seconds=STREAM_WINDOW_SECONDS, cache=None, verbose=False):
+    if verbose:
+        print('\nAV2SUBS (streaming)\n===================', flush=True)
+        print(f'Streaming input file: {input_file}', flush=True)
+
+    samples_to_ms_factor = AUDIO_SAMPLE_RATE / 1000
+    output = open(output_file, 'w', encoding='utf-8') if output_file else None
+    subtitle_index = 1 # .srt files start with index 1
+    try:
+        audio_windows = streamAudio(input_file, window_seconds=window_seconds)
+        for chunk_start, audio_chunk in streamSpeechChunks(audio_windows, threshold=speech_threshold):
+            speech_timestamp = (chunk_start // samples_to_ms_factor, (chunk_start + len(audio_chunk)) // samples_to_ms_factor)
+            if verbose:
+                print(f'\tTranscribing speech at {speech_timestamp[0] / 1000:.1f}s', flush=True)
+            segments = transcribeChunksCached([audio_chunk], whisper_model, whisper_prompt, cache, batch_size=1)[0]
+
+            for sub in chunkSubtitles(segments, speech_timestamp, subtitle_index):
+                if output:
+                    output.write(str(sub) + '\n')
+                    output.flush()
+                subtitle_index += 1
+                yield sub
+    finally:
+        if output:
+            output.close()
+
+# Decodes the input with ffmpeg and yields 16kHz mono float32 windows of window_seconds
+def streamAudio(input_file, window_seconds=STREAM_WINDOW_SECONDS):
+    cmd = ['ffmpeg', '-nostdin', '-loglevel', 'error', '-i', input_file, 
+           '-vn', '-f', 'f32le', '-ac', '1', '-ar', str(AUDIO_SAMPLE_RATE), '-']
+    window_bytes = int(window_seconds * AUDIO_SAMPLE_RATE) * 4
+    # stderr goes to a file for the same reason as in extractAudio; this stream can run for hours
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr)
+        try:
+            while True:
+                data = process.stdout.read(window_bytes)
+                if not data:
+                    break
+                yield np.frombuffer(data[:len(data) - len(data) % 4], dtype=np.float32)
+            if process.wait() != 0:
+                stderr.seek(max(0, stderr.seek(0, os.SEEK_END) - FFMPEG_ERROR_TAIL_BYTES))
+                raise Exception(f'Could not decode audio from {input_file}: {stderr.read().decode("utf-8", "replace")}')
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+'''
+streamSpeechChunks runs silero-vad incrementally over a stream of audio windows
+and yields (start_sample, samples) for each speech chunk as soon as it ends.
+Windows don't have to line up with VAD frames; leftover samples are carried
+into the next window. Chunks longer than max_chunk_seconds are cut so that
+Whisper never sees more than one window's worth of audio.
+
+Only samples that can still end up in a chunk are kept: the current speech
+chunk, or just enough look-behind for the VAD's start padding.
+'''
+def streamSpeechChunks(audio_windows, threshold=0.5, max_chunk_seconds=MAX_STREAM_CHUNK_SECONDS):
+    import torch
+    model, utils = loadSileroVad()
+    (_, _, _, VADIterator, _) = utils
+    vad_iterator = VADIterator(model, 
+                               threshold=threshold, 
+                               sampling_rate=AUDIO_SAMPLE_RATE,
+                               min_silence_duration_ms=MIN_SILENCE_DURATION_MS,
+                               speech_pad_ms=SPEECH_PAD_MS)
+    look_behind = int(SPEECH_PAD_MS * AUDIO_SAMPLE_RATE / 1000) + VAD_FRAME_SAMPLES
+    max_chunk_samples = int(max_chunk_seconds * AUDIO_SAMPLE_RATE)
+
+    buffer = np.zeros(0, dtype=np.float32)
+    buffer_start = 0    # sample index of buffer[0] in the whole input
+    frame_position = 0  # sample index of the next frame fed to the VAD
+    speech_start = None
+    for window in audio_windows:
+        buffer = np.concatenate([buffer, window])
+        while frame_position + VAD_FRAME_SAMPLES <= buffer_start + len(buffer):
+            frame = buffer[frame_position - buffer_start: frame_position - buffer_start + VAD_FRAME_SAMPLES]
+            event = vad_iterator(torch.from_numpy(frame))
+            frame_position += VAD_FRAME_SAMPLES
+
+            if event and 'start' in event:
+                speech_start = max(event['start'], buffer_start)
+            elif event and 'end' in event and speech_start is not None:
+                speech_end = min(event['end'], frame_position)
+                # After a forced cut, the VAD's end can fall at or before the cut, leaving nothing to yield
+                if speech_end > speech_start:
+                    yield speech_start, buffer[speech_start - buffer_start: speech_end - buffer_start]
+                speech_start = None
+            elif speech_start is not None and frame_position + VAD_FRAME_SAMPLES - speech_start > max_chunk_samples:
+                yield speech_start, buffer[speech_start - buffer_start: frame_position - buffer_start]
+                speech_start = frame_position
+
+        # Drop samples that can no longer be part of a chunk
+        keep_from = speech_start if speech_start is not None else frame_position - look_behind
+        keep_from = max(buffer_start, keep_from)
+        buffer = buffer[keep_from - buffer_start:]
+        buffer_start = keep_from
+
+    # Input ended mid-speech
+    if speech_start is not None and frame_position > speech_start:
+        yield speech_start, buffer[speech_start - buffer_start: frame_position - buffer_start]
+    vad_iterator.reset_states()
 
 if __name__ == '__main__':
     input_file = 'qiaohuDVD01.mp4'
@@ -186,12 +727,21 @@ if __name__ == '__main__':
     #run_id = 497139
     #temp_srt_files = [f'temp/{run_id}_chunked_audio_{i+1}.srt' for i in range(21)]
     #combineSubtitleFiles(temp_srt_files, run_id=run_id)
+    from transcription_cache import TranscriptionCache
+    from metrics import Metrics
+    cache = TranscriptionCache()
+    metrics = Metrics()
     audio2subs(input_file, 
                speech_threshold=threshold, 
                whisper_model=whisper_model, 
                whisper_prompt=whisper_prompt, 
+               cache=cache,
+               metrics=metrics,
                run_id=RUN_ID, 
                verbose=True)
+    cache.close()
+    metrics.print_report()
+    metrics.save(f'{DEFAULT_TEMP_DIRECTORY}/{RUN_ID}/metrics.json')
 
 
 # This is an older version of chunkAudio that had the functionality to divide up
@@ -0,0 +1,159 @@
+import marshal
+import os
+import re
+
+'''
+Offline simplified-to-traditional conversion and pinyin for txt2pleco, built on
+CC-CEDICT (https://www.mdbg.net/chinese/dictionary?page=cc-cedict). Download
+and unzip cedict_ts.u8 next to this file (or pass its path to load_cedict).
+
+CC-CEDICT lines look like:
+    他們 他们 [ta1 men5] /they/
+The first time a dictionary file is loaded it is compiled into a marshal file
+(cedict_ts.u8.marshal) holding {simplified: (traditional, numbered pinyin)},
+which loads in a fraction of the time it takes to parse the text file.
+
+Sentences are segmented by forward maximum matching against the dictionary,
+so both the traditional characters and the pinyin are chosen per word rather
+than per character (e.g. 干净 -> 乾淨 but 干部 -> 幹部).
+'''
+
+DEFAULT_CEDICT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cedict_ts.u8')
+COMPILED_SUFFIX = '.marshal'
+# Longest word tried when segmenting. CC-CEDICT has longer entries, but they're
+# rare idioms and proverbs and trying them would slow down every lookup.
+MAX_MATCH_LENGTH = 8
+# Readings for common particles whose first CC-CEDICT reading isn't the usual one
+READING_OVERRIDES = {
+    '了': 'le5',
+    '的': 'de5',
+    '得': 'de5',
+    '着': 'zhe5',
+    '么': 'me5',
+    '吗': 'ma5'
+}
+
+CEDICT_LINE_PATTERN = re.compile(r'^(\S+) (\S+) \[([^\]]*)\] /(.*)/$')
+TONE_MARKS = {
+    'a': 'āáǎàa', 'e': 'ēéěèe', 'i': 'īíǐìi', 'o': 'ōóǒòo', 'u': 'ūúǔùu', 'ü': 'ǖǘǚǜü',
+    'A': 'ĀÁǍÀA', 'E': 'ĒÉĚÈE', 'I': 'ĪÍǏÌI', 'O': 'ŌÓǑÒO', 'U': 'ŪÚǓÙU', 'Ü': 'ǕǗǙǛÜ'
+}
+# Loaded dictionaries, keyed by file path
+_DICTIONARIES = {}
+
+def load_cedict(cedict_file=DEFAULT_CEDICT_FILE):
+    if cedict_file in _DICTIONARIES:
+        return _DICTIONARIES[cedict_file]
+
+    compiled_file = cedict_file + COMPILED_SUFFIX
+    if os.path.exists(compiled_file) and \
+       (not os.path.exists(cedict_file) or os.path.getmtime(compiled_file) >= os.path.getmtime(cedict_file)):
+        with open(compiled_file, 'rb') as fp:
+            entries = marshal.load(fp)
+    else:
+        entries = compile_cedict(cedict_file, compiled_file)
+
+    _DICTIONARIES[cedict_file] = entries
+    return entries
+
+# Parses a CC-CEDICT file into {simplified: (traditional, numbered pinyin)} and saves it to compiled_file
+def compile_cedict(cedict_file, compiled_file):
+    entries = {}
+    definition_counts = {}
+    with open(cedict_file, 'r', encoding='utf-8') as fp:
+        for line in fp:
+            match = CEDICT_LINE_PATTERN.match(line.rstrip('\n'))
+            if match is None:
+                continue
+            traditional, simplified, pinyin, definitions = match.groups()
+            # Prefer common nouns/words (lowercase pinyin) over proper nouns, then the
+            # reading with the most definitions, which is usually the most common one
+            rank = (pinyin[:1].islower(), definitions.count('/') + 1)
+            if simplified not in entries or rank > definition_counts[simplified]:
+                entries[simplified] = (traditional, pinyin)
+                definition_counts[simplified] = rank
+
+    for simplified, reading in READING_OVERRIDES.items():
+        if simplified in entries:
+            entries[simplified] = (entries[simplified][0], reading)
+
+    with open(compiled_file, 'wb') as fp:
+        marshal.dump(entries, fp)
+    return entries
+
+'''
+Forward maximum matching: at each position take the longest dictionary word
+(up to MAX_MATCH_LENGTH characters). Characters not in the dictionary become
+their own word, with no traditional form or pinyin of their own. Runs of
+letters and digits are kept together.
+
+Returns a list of (simplified, traditional, numbered pinyin or None).
+'''
+def segment(sentence, entries):
+    words = []
+    i = 0
+    while i < len(sentence):
+        for length in range(min(MAX_MATCH_LENGTH, len(sentence) - i), 0, -1):
+            word = sentence[i: i+length]
+            if word in entries:
+                traditional, pinyin = entries[word]
+                words.append((word, traditional, pinyin))
+                i += length
+                break
+        else:
+            j = i + 1
+            if sentence[i].isascii() and sentence[i].isalnum():
+                while j < len(sentence) and sentence[j].isascii() and sentence[j].isalnum():
+                    j += 1
+            words.append((sentence[i:j], sentence[i:j], None))
+            i = j
+    return words
+
+# Returns (traditional characters, tone-marked pinyin) for a sentence, e.g.
+# 他们会说两种语言。 -> ('他們會說兩種語言。', 'Tāmen huì shuō liǎng zhǒng yǔyán')
+def pleco_fields(sentence, entries):
+    words = segment(sentence, entries)
+    traditional = ''.join(word[1] for word in words)
+
+    pinyin_words = []
+    for simplified, _, pinyin in words:
+        if pinyin is not None:
+            pinyin_words.append(''.join(numbered_to_tone_marks(syllable) for syllable in pinyin.split(' ')))
+        elif simplified.isascii() and simplified.isalnum():
+            pinyin_words.append(simplified)
+    pinyin = ' '.join(pinyin_words)
+    return traditional, pinyin[:1].upper() + pinyin[1:]
+
+# True if pleco_fields can give sentence a full reading: every word other than
+# punctuation and ASCII letters/digits has an entry (e.g. no rare character missing from the dictionary)
+def covers(sentence, entries):
+    for simplified, _, pinyin in segment(sentence, entries):
+        if pinyin is None and not simplified.isascii() and simplified.isalnum():
+            return False
+    return True
+
+# ni3 -> nǐ, lu:4 -> lǜ, ma5 -> ma. Syllables without a tone number are returned unchanged.
+def numbered_to_tone_marks(syllable):
+    syllable = syllable.replace('u:', 'ü').replace('U:', 'Ü')
+    if not syllable or not syllable[-1].isdigit():
+        return syllable
+    tone = int(syllable[-1])
+    syllable = syllable[:-1]
+    if tone < 1 or tone > 5:
+        return syllable
+
+    # The mark goes on a or e if present, on the o of ou, otherwise on the last vowel
+    lower = syllable.lower()
+    if 'a' in lower:
+        position = lower.index('a')
+    elif 'e' in lower:
+        position = lower.index('e')
+    elif 'ou' in lower:
+        position = lower.index('o')
+    else:
+        vowels = [i for i, char in enumerate(lower) if char in 'iouü']
+        if not vowels:
+            return syllable
+        position = vowels[-1]
+    marked = TONE_MARKS[syllable[position]][tone - 1]
+    return syllable[:position] + marked + syllable[position+1:]
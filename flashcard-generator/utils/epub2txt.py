@@ -1,3 +1,207 @@
+import codecs
+import posixpath
+import re
+import xml.etree.ElementTree as ET
+import zipfile
+from html.parser import HTMLParser
+from urllib.parse import unquote
+
+from metrics import NoMetrics
+from run_manifest import atomic_output
+
 '''
 This script will take an .epub file and create a text file out of all the lines.
+
+An .epub is a zip archive. META-INF/container.xml points to the package (.opf)
+file, whose spine lists the book's XHTML documents in reading order. Each
+document is streamed out of the archive and parsed incrementally, so only one
+block of markup and the paragraph being read are in memory at a time, however
+many chapters the book has.
+
+Paragraphs (<p>, <div>, headings, list items, <br>) are split into sentences
+after 。！？!?… (and any closing quotes or brackets that follow), repeated
+sentences are dropped, and what's left is yielded one sentence per line, the
+format txt2pleco reads.
+
+Given known_words, only sentences with at most max_unknown unknown characters
+are kept. As in parse_common_voice, a character is known if it's one of the
+known words; here only Chinese characters are checked, since a book's
+punctuation isn't in anyone's known words list.
 '''
+
+CONTAINER_FILE = 'META-INF/container.xml'
+# Bytes of a document handed to the parser at a time
+READ_SIZE = 1 << 16
+SENTENCE_ENDINGS = '。！？!?…'
+CLOSING_QUOTES = '」』”’"\'）)》】'
+# A sentence runs up to its ending punctuation plus any closing quotes, or to the end of the paragraph
+SENTENCE_PATTERN = re.compile(f'[^{SENTENCE_ENDINGS}]*(?:[{SENTENCE_ENDINGS}]+[{re.escape(CLOSING_QUOTES)}]*|$)')
+HAN_PATTERN = re.compile('[㐀-䶿一-鿿豈-﫿\U00020000-\U0002ffff]')
+WHITESPACE_PATTERN = re.compile(r'[\s　]+')
+# Elements that end a paragraph, and elements whose text isn't part of the book's prose
+BLOCK_TAGS = frozenset(['p', 'div', 'br', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'li', 'tr', 'blockquote', 'section', 'article', 'hr'])
+SKIPPED_TAGS = frozenset(['head', 'script', 'style', 'rt', 'rp'])
+
+'''
+epub2txt writes the sentences of input_file to output_file, one per line, and
+returns the number of sentences kept and dropped for each reason (and times the
+run as the 'epub2txt' stage of metrics, if given).
+output_file is replaced atomically once every sentence has been written.
+'''
+def epub2txt(input_file, output_file, known_words=None, max_unknown=0, metrics=None, verbose=False):
+    if verbose:
+        print('\nEPUB2TXT\n========', flush=True)
+    if metrics is None:
+        metrics = NoMetrics()
+
+    stats = {'kept': 0, 'no_chinese': 0, 'duplicate': 0, 'unknown_words': 0}
+    with metrics.stage('epub2txt', unit='sentences') as stage:
+        with atomic_output(output_file) as temp_output_file, open(temp_output_file, 'w', encoding='utf-8') as output:
+            for sentence in epub2sentences(input_file, known_words, max_unknown, stats):
+                if stats['kept'] > 1:
+                    output.write('\n')
+                output.write(sentence)
+        stage.items = sum(stats.values())
+
+    if verbose:
+        print(', '.join(f'{reason}: {count}' for reason, count in stats.items()), flush=True)
+    return stats
+
+'''
+epub2sentences yields the book's sentences in reading order, without repeats.
+It can be passed straight to txt2pleco in place of an input file. If given,
+stats counts what was kept and dropped (see epub2txt).
+'''
+def epub2sentences(input_file, known_words=None, max_unknown=0, stats=None):
+    if stats is None:
+        stats = {'kept': 0, 'no_chinese': 0, 'duplicate': 0, 'unknown_words': 0}
+    known_characters = set(known_words) if known_words is not None else None
+    # Hashes rather than the sentences themselves keep memory flat on very long books;
+    # a 64-bit collision dropping a sentence isn't a concern at this size
+    seen_sentences = set()
+
+    with zipfile.ZipFile(input_file) as book:
+        for document in spine_documents(book):
+            for paragraph in read_paragraphs(book, document):
+                for sentence in split_sentences(paragraph):
+                    if not HAN_PATTERN.search(sentence):
+                        stats['no_chinese'] += 1
+                        continue
+                    sentence_hash = hash(sentence)
+                    if sentence_hash in seen_sentences:
+                        stats['duplicate'] += 1
+                        continue
+                    seen_sentences.add(sentence_hash)
+                    if known_characters is not None and unknown_count(sentence, known_characters) > max_unknown:
+                        stats['unknown_words'] += 1
+                        continue
+                    stats['kept'] += 1
+                    yield sentence
+
+# Paths inside the archive of the spine's documents, in reading order
+def spine_documents(book):
+    container = ET.fromstring(book.read(CONTAINER_FILE))
+    rootfile = next((element for element in container.iter() if local_name(element.tag) == 'rootfile'), None)
+    if rootfile is None:
+        raise Exception(f'No package file listed in {CONTAINER_FILE}')
+    package_file = rootfile.get('full-path')
+    package_directory = posixpath.dirname(package_file)
+    package = ET.fromstring(book.read(package_file))
+
+    manifest = {}
+    spine = []
+    for element in package.iter():
+        if local_name(element.tag) == 'item':
+            manifest[element.get('id')] = element.get('href')
+        elif local_name(element.tag) == 'itemref' and element.get('linear', 'yes') != 'no':
+            spine.append(element.get('idref'))
+
+    archive_files = set(book.namelist())
+    documents = []
+    for idref in spine:
+        if idref not in manifest:
+            continue
+        href = unquote(manifest[idref].split('#')[0])
+        document = posixpath.normpath(posixpath.join(package_directory, href))
+        if document in archive_files and document not in documents:
+            documents.append(document)
+    return documents
+
+# Tag name without its XML namespace, e.g. '{urn:oasis:names:tc:opendocument:xmlns:container}rootfile' -> 'rootfile'
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+# Streams one XHTML document out of the archive and yields its paragraphs' text
+def read_paragraphs(book, document):
+    parser = ParagraphParser()
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    with book.open(document) as fp:
+        while True:
+            data = fp.read(READ_SIZE)
+            parser.feed(decoder.decode(data, final=not data))
+            yield from parser.paragraphs
+            parser.paragraphs.clear()
+            if not data:
+                break
+    parser.close()
+    yield from parser.paragraphs
+
+'''
+ParagraphParser collects the text of an (X)HTML document into paragraphs as it
+is fed. HTMLParser is used over an XML parser because e-books are often not
+well-formed XML (undeclared entities such as &nbsp;, unclosed tags).
+'''
+class ParagraphParser(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.paragraphs = []
+        self.text = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self.skip_depth += 1
+        elif tag in BLOCK_TAGS:
+            self.end_paragraph()
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in BLOCK_TAGS:
+            self.end_paragraph()
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag in BLOCK_TAGS:
+            self.end_paragraph()
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.text.append(data)
+
+    def close(self):
+        super().close()
+        self.end_paragraph()
+
+    def end_paragraph(self):
+        paragraph = WHITESPACE_PATTERN.sub(' ', ''.join(self.text)).strip()
+        self.text = []
+        if paragraph:
+            self.paragraphs.append(paragraph)
+
+# Splits a paragraph into sentences, keeping each sentence's punctuation and closing quotes
+def split_sentences(paragraph):
+    sentences = []
+    for sentence in SENTENCE_PATTERN.findall(paragraph):
+        sentence = sentence.strip()
+        if sentence:
+            sentences.append(sentence)
+    return sentences
+
+# Number of distinct Chinese characters in sentence that aren't known
+def unknown_count(sentence, known_characters):
+    return len(set(HAN_PATTERN.findall(sentence)) - known_characters)
+
+if __name__ == '__main__':
+    input_file = 'book.epub'
+    output_file = 'book.txt'
+    epub2txt(input_file, output_file, verbose=True)
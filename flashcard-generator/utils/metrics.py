@@ -0,0 +1,165 @@
+import contextlib
+import cProfile
+import json
+import sys
+import threading
+import time
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak RSS is left out of the report there
+    resource = None
+
+from run_manifest import atomic_output
+
+'''
+Metrics collects where a run spends its time and money, for av2subs, subs2txt,
+txt2pleco, parse_common_voice and flashcard-generator:
+- per stage: wall time, CPU time, number of calls, items processed (in the
+  stage's own unit, e.g. audio seconds, chunks, lines) and throughput
+- peak RSS of the process, and at the end of each stage
+- API requests, latency, tokens and cost
+
+Usage:
+    metrics = Metrics()
+    with metrics.stage('vad', unit='chunks') as stage:
+        ...
+        stage.items += len(chunks)
+    metrics.save('metrics.json')
+
+Stages with the same name add up (e.g. 'transcribe' over every episode of a
+season). CPU time is the process's user + system time, including finished child
+processes (ffmpeg, transcription workers), spent while the stage was open; when
+stages overlap on different threads, their CPU times overlap too.
+
+For function-level detail, wrap a run in metrics.profile('run.prof') and open
+the file with pstats or snakeviz. Stages are plain functions, so sampling
+profilers such as `py-spy record -- python flashcard-generator.py ...` show
+them by name as well.
+'''
+
+class Metrics:
+    def __init__(self):
+        self.stages = {}
+        self.api = {'requests': 0, 'latency_seconds': 0.0, 'prompt_tokens': 0, 'completion_tokens': 0, 'cost': 0.0}
+        self.start_time = time.time()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = cpu_seconds()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name, unit='items', items=0):
+        stage = StageTimer(items)
+        wall = time.perf_counter()
+        cpu = cpu_seconds()
+        try:
+            yield stage
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = cpu_seconds() - cpu
+            with self.lock:
+                totals = self.stages.setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'items': 0, 'unit': unit})
+                totals['calls'] += 1
+                totals['wall_seconds'] += wall
+                totals['cpu_seconds'] += cpu
+                totals['items'] += stage.items
+                totals['peak_rss_mb'] = peak_rss_mb()
+
+    # Records one API request (latency in seconds, usage as counted by the API)
+    def api_call(self, latency, prompt_tokens, completion_tokens, cost):
+        with self.lock:
+            self.api['requests'] += 1
+            self.api['latency_seconds'] += latency
+            self.api['prompt_tokens'] += prompt_tokens
+            self.api['completion_tokens'] += completion_tokens
+            self.api['cost'] += cost
+
+    def report(self):
+        with self.lock:
+            stages = {}
+            for name, totals in self.stages.items():
+                stages[name] = dict(totals)
+                stages[name]['items_per_second'] = totals['items'] / totals['wall_seconds'] if totals['wall_seconds'] else 0.0
+            api = dict(self.api)
+        api['mean_latency_seconds'] = api['latency_seconds'] / api['requests'] if api['requests'] else 0.0
+        return {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.start_time)),
+            'wall_seconds': time.perf_counter() - self.start_wall,
+            'cpu_seconds': cpu_seconds() - self.start_cpu,
+            'peak_rss_mb': peak_rss_mb(),
+            'stages': stages,
+            'api': api
+        }
+
+    # Writes the report as JSON (atomically, so a report is never half-written)
+    def save(self, output_file):
+        report = self.report()
+        with atomic_output(output_file) as temp_file, open(temp_file, 'w', encoding='utf-8') as fp:
+            json.dump(report, fp, indent=2)
+        return report
+
+    def print_report(self):
+        report = self.report()
+        print(f'Wall time: {report["wall_seconds"]:.1f}s, CPU time: {report["cpu_seconds"]:.1f}s, peak RSS: {report["peak_rss_mb"] or 0:.0f}MB', flush=True)
+        for name, stage in report['stages'].items():
+            print(f'\t{name}: {stage["wall_seconds"]:.2f}s wall, {stage["cpu_seconds"]:.2f}s CPU, '
+                  f'{stage["items"]:g} {stage["unit"]} ({stage["items_per_second"]:.1f}/s)', flush=True)
+        if report['api']['requests']:
+            api = report['api']
+            print(f'\tAPI: {api["requests"]} requests, {api["mean_latency_seconds"]:.2f}s mean latency, '
+                  f'{api["prompt_tokens"]} prompt + {api["completion_tokens"]} completion tokens, ${api["cost"]:.4f}', flush=True)
+
+    '''
+    Runs the block under cProfile and writes the stats to output_file, e.g.
+        with metrics.profile('run.prof'):
+            audio2subs(...)
+    cProfile only sees the thread it was started on.
+    '''
+    @contextlib.contextmanager
+    def profile(self, output_file):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+            profiler.dump_stats(output_file)
+
+# Handed out by Metrics.stage so the block can count what it processed
+class StageTimer:
+    def __init__(self, items=0):
+        self.items = items
+
+# User + system time of this process and its finished children
+def cpu_seconds():
+    if resource is None:
+        return time.process_time()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime
+
+# High-water mark of the process's resident memory, or None where it can't be measured
+def peak_rss_mb():
+    # On Linux, ru_maxrss survives exec, so a spawned child would report its parent's
+    # peak; VmHWM only covers this process image
+    try:
+        with open('/proc/self/status', 'r') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return max_rss / (1024 * 1024) if sys.platform == 'darwin' else max_rss / 1024
+
+# Null stand-in used when a function isn't given a Metrics, so call sites don't need to check
+class NoMetrics:
+    @contextlib.contextmanager
+    def stage(self, name, unit='items', items=0):
+        yield StageTimer(items)
+
+    def api_call(self, latency, prompt_tokens, completion_tokens, cost):
+        pass
@@ -0,0 +1,104 @@
+import os
+import threading
+
+'''
+Model registry for the audio stages (av2subs, video2subs).
+
+- Models load from local, pinned locations, so no run depends on the network:
+    silero-vad: a local clone of snakers4/silero-vad at SILERO_VAD_DIRECTORY if
+                there is one, else torch.hub's cached copy of the pinned
+                SILERO_VAD_REPO tag (downloaded once, never re-validated)
+    Whisper:    checkpoints in WHISPER_DIRECTORY (whisper.load_model downloads
+                a missing one there once and checks its SHA-256 after that), or
+                a path to a .pt file
+  MODEL_DIRECTORY defaults to models/ next to utils/ and can be moved with the
+  CHINESE_TOOLS_MODEL_DIR environment variable.
+- Each Whisper model/device pair is loaded at most once per process, even when
+  several threads ask for it at once. whisper.decode installs kv-cache hooks
+  on the model while it runs, so only one thread may use a Whisper model at a
+  time; for parallel transcription use worker processes
+  (av2subs.transcribeChunksParallel).
+- silero-vad keeps its recurrent state inside the model object, so each thread
+  gets its own copy (it's small and quick to load), held in thread-local
+  storage so it is freed when the thread exits.
+- torch, onnxruntime and whisper are only imported the first time a model is
+  needed, so text-only tools never pay for them.
+- select_device only asks torch whether CUDA is available; it never initialises
+  CUDA itself, so CPU-only hosts don't pay for a failed CUDA start-up.
+
+warm_up loads models on a background thread, so a CLI can start decoding audio
+while Whisper is still being read from disk. Its silero-vad copy is only used by
+the warm-up thread, but loading it imports torch and onnxruntime and fills
+torch.hub's cache for the threads that need it.
+'''
+
+MODEL_DIRECTORY = os.environ.get('CHINESE_TOOLS_MODEL_DIR',
+                                 os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'models'))
+SILERO_VAD_DIRECTORY = os.path.join(MODEL_DIRECTORY, 'silero-vad')
+SILERO_VAD_REPO = 'snakers4/silero-vad:v5.1.2'
+WHISPER_DIRECTORY = os.path.join(MODEL_DIRECTORY, 'whisper')
+# Forces a device ('cpu', 'cuda', 'cuda:1', ...) instead of picking one
+DEVICE_ENVIRONMENT_VARIABLE = 'CHINESE_TOOLS_DEVICE'
+
+# Loaded Whisper models, keyed by ('whisper', name, device)
+_MODELS = {}
+# One lock per key, so two threads never load the same model twice
+_MODEL_LOCKS = {}
+_REGISTRY_LOCK = threading.Lock()
+# Each thread's own silero-vad, as silero_vad
+_THREAD_MODELS = threading.local()
+
+# Returns the model stored under key, calling load() to create it the first time
+def get_model(key, load):
+    if key in _MODELS:
+        return _MODELS[key]
+    with _REGISTRY_LOCK:
+        lock = _MODEL_LOCKS.setdefault(key, threading.Lock())
+    with lock:
+        if key not in _MODELS:
+            _MODELS[key] = load()
+    return _MODELS[key]
+
+# The calling thread's silero-vad as (model, (get_speech_timestamps, save_audio, read_audio, VADIterator, collect_chunks))
+def load_silero_vad():
+    if not hasattr(_THREAD_MODELS, 'silero_vad'):
+        _THREAD_MODELS.silero_vad = _load_silero_vad()
+    return _THREAD_MODELS.silero_vad
+
+def _load_silero_vad():
+    import torch
+    import onnxruntime
+    # silero-vad spits out tons of warnings that are out of our control without this
+    onnxruntime.set_default_logger_severity(3)
+    if os.path.isdir(SILERO_VAD_DIRECTORY):
+        return torch.hub.load(repo_or_dir=SILERO_VAD_DIRECTORY, model='silero_vad', source='local', onnx=True, verbose=False)
+    return torch.hub.load(repo_or_dir=SILERO_VAD_REPO, model='silero_vad', onnx=True, verbose=False,
+                          trust_repo=True, skip_validation=True)
+
+def load_whisper(whisper_model, device=None):
+    device = device or select_device()
+    return get_model(('whisper', whisper_model, device), lambda: _load_whisper(whisper_model, device))
+
+def _load_whisper(whisper_model, device):
+    import whisper
+    if not os.path.exists(WHISPER_DIRECTORY):
+        os.makedirs(WHISPER_DIRECTORY)
+    return whisper.load_model(whisper_model, device=device, download_root=WHISPER_DIRECTORY)
+
+def select_device():
+    if os.environ.get(DEVICE_ENVIRONMENT_VARIABLE):
+        return os.environ[DEVICE_ENVIRONMENT_VARIABLE]
+    import torch
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+# Starts loading the given models in the background and returns the thread
+def warm_up(whisper_model=None, vad=True, device=None):
+    def load():
+        if vad:
+            load_silero_vad()
+        if whisper_model:
+            load_whisper(whisper_model, device=device)
+
+    thread = threading.Thread(target=load, name='model-warm-up', daemon=True)
+    thread.start()
+    return thread
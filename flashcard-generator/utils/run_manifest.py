@@ -0,0 +1,119 @@
+import contextlib
+import hashlib
+import json
+import os
+
+'''
+A run manifest records the units of work a run has finished, so that a run
+restarted with the same run_id picks up where it stopped instead of starting
+over (and paying for the same API calls again).
+
+Each entry is (stage, key) -> value, e.g.
+- ('vad', <threshold>) -> speech timestamps of the input
+- ('transcribe', <hash of the chunk's samples and Whisper settings>) -> segments
+- ('translate', <hash of the model and prompt>) -> the model's response
+
+Entries are appended to temp/<run_id>/manifest.jsonl as one JSON line each and
+flushed to disk straight away. A crash can at most leave a truncated last
+line, which is ignored when the manifest is loaded again.
+'''
+
+DEFAULT_TEMP_DIRECTORY = 'temp'
+# Bytes read from the start and end of an input file for its fingerprint
+FINGERPRINT_BYTES = 1 << 20
+
+class RunManifest:
+    def __init__(self, run_id, temp_directory=DEFAULT_TEMP_DIRECTORY):
+        run_directory = f'{temp_directory}/{run_id}'
+        if not os.path.exists(run_directory):
+            os.makedirs(run_directory)
+
+        self.manifest_file = f'{run_directory}/manifest.jsonl'
+        self.entries = {}
+        self.resumed = 0
+        if os.path.exists(self.manifest_file):
+            valid_bytes = 0
+            with open(self.manifest_file, 'rb') as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break
+                    if not line.endswith(b'\n'):
+                        break
+                    self.entries[(entry['stage'], entry['key'])] = entry['value']
+                    valid_bytes += len(line)
+            # Drop whatever a crash left after the last complete entry before appending to it
+            with open(self.manifest_file, 'r+b') as fp:
+                fp.truncate(valid_bytes)
+        self.output = open(self.manifest_file, 'a', encoding='utf-8')
+
+    '''
+    Ties the manifest to one input file. If the run was started on a different
+    (or since modified) input, everything recorded so far is thrown away.
+    '''
+    def check_input(self, input_file):
+        fingerprint = file_fingerprint(input_file)
+        if self.entries.get(('input', 'fingerprint')) not in (None, fingerprint):
+            self.reset()
+        if ('input', 'fingerprint') not in self.entries:
+            self.record('input', 'fingerprint', fingerprint)
+
+    # Returns the recorded value for (stage, key), or None if that unit isn't done
+    def get(self, stage, key):
+        value = self.entries.get((stage, key))
+        if value is not None:
+            self.resumed += 1
+        return value
+
+    def record(self, stage, key, value):
+        self.entries[(stage, key)] = value
+        self.output.write(json.dumps({'stage': stage, 'key': key, 'value': value}, ensure_ascii=False) + '\n')
+        self.output.flush()
+        os.fsync(self.output.fileno())
+
+    # Number of finished units in stage
+    def completed(self, stage):
+        return sum(1 for entry_stage, _ in self.entries if entry_stage == stage)
+
+    def reset(self):
+        self.entries = {}
+        self.output.truncate(0)
+
+    def close(self):
+        self.output.close()
+
+# Content hash used as a manifest key, e.g. content_key(model, prompt)
+def content_key(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(json.dumps(part, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+# Cheap fingerprint of a (possibly multi-GB) file: its size and a hash of its first and last FINGERPRINT_BYTES
+def file_fingerprint(input_file):
+    size = os.path.getsize(input_file)
+    digest = hashlib.sha256(str(size).encode('utf-8'))
+    with open(input_file, 'rb') as fp:
+        digest.update(fp.read(FINGERPRINT_BYTES))
+        if size > FINGERPRINT_BYTES:
+            fp.seek(max(FINGERPRINT_BYTES, size - FINGERPRINT_BYTES))
+            digest.update(fp.read())
+    return digest.hexdigest()
+
+'''
+atomic_output yields a temporary path next to output_file. Once the block
+finishes, the temporary file replaces output_file in one os.replace, so
+output_file is never left half-written; if the block raises, the temporary
+file is removed and output_file is untouched.
+'''
+@contextlib.contextmanager
+def atomic_output(output_file):
+    temp_file = f'{output_file}.{os.getpid()}.tmp'
+    try:
+        yield temp_file
+        os.replace(temp_file, output_file)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
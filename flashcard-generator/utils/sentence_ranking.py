@@ -0,0 +1,144 @@
+import collections
+
+import cedict
+
+'''
+Picks the sentences worth turning into flashcards before any of them are sent
+to the API, given the learner's known words.
+
+Each sentence is segmented into words (Segmenter) and its unknown words are
+counted. Sentences made only of known words teach nothing, and sentences with
+more than max_unknown unknown words are too hard to learn from, so only the
+"i+1" sentences in between are candidates. Candidates are ranked by how often
+their unknown words come up in the whole input (a word that's everywhere is
+worth learning first), then by how few unknown words they have and how cheap
+they are to translate. Each unknown word gets at most cards_per_word cards,
+and candidates are taken in rank order until the card or cost budget runs out.
+
+The selected sentences keep their input order, so the cards still introduce
+vocabulary in the order the media does.
+'''
+
+# "i+1": sentences with exactly one unknown word
+MAX_UNKNOWN_WORDS = 1
+# Cards kept for each unknown word; more would pay for the same word twice
+CARDS_PER_WORD = 2
+
+'''
+Segmenter splits sentences into words by maximum matching over a DAG of every
+vocabulary word that starts at each character (the approach jieba takes).
+
+The vocabulary is the known words plus, if given, a CC-CEDICT dictionary (see
+cedict.load_cedict), so unknown words are still recognised as whole words. It
+is stored as two flat sets, the words and all of their prefixes, which is far
+smaller than a trie of nodes and lets each step of the DAG walk be one set
+lookup. The route with the fewest words wins; ties go to the route with the
+fewest unknown words.
+'''
+class Segmenter:
+    def __init__(self, known_words, dictionary=None):
+        self.known_words = frozenset(known_words)
+        words = set(word for word in self.known_words if 0 < len(word) <= cedict.MAX_MATCH_LENGTH)
+        if dictionary is not None:
+            words.update(word for word in dictionary if len(word) <= cedict.MAX_MATCH_LENGTH)
+        self.words = frozenset(words)
+        self.prefixes = frozenset(word[:length] for word in words for length in range(1, len(word)))
+
+    # End positions of the vocabulary words starting at each position of sentence
+    def dag(self, sentence):
+        words = self.words
+        prefixes = self.prefixes
+        dag = []
+        for i in range(len(sentence)):
+            # A single character is always a word, even if it isn't in the vocabulary
+            ends = [i + 1]
+            j = i + 1
+            while j < len(sentence) and sentence[i:j] in prefixes:
+                j += 1
+                if sentence[i:j] in words:
+                    ends.append(j)
+            dag.append(ends)
+        return dag
+
+    def segment(self, sentence):
+        known_words = self.known_words
+        dag = self.dag(sentence)
+        # route[i] = (words, unknown words, end of the first word) for the best segmentation of sentence[i:]
+        route = [None] * len(sentence) + [(0, 0, len(sentence))]
+        for i in range(len(sentence) - 1, -1, -1):
+            best = None
+            for j in dag[i]:
+                words, unknown, _ = route[j]
+                candidate = (words + 1, unknown + (sentence[i:j] not in known_words), j)
+                if best is None or candidate < best:
+                    best = candidate
+            route[i] = best
+
+        segmented = []
+        i = 0
+        while i < len(sentence):
+            j = route[i][2]
+            segmented.append(sentence[i:j])
+            i = j
+        return segmented
+
+    # The distinct words of sentence the learner doesn't know (punctuation, digits and Latin letters don't count)
+    def unknown_words(self, sentence):
+        unknown = []
+        for word in self.segment(sentence):
+            if word not in self.known_words and word not in unknown and any(is_chinese(character) for character in word):
+                unknown.append(word)
+        return unknown
+
+def is_chinese(character):
+    return '㐀' <= character <= '鿿' or '豈' <= character <= '﫿' or character >= '\U00020000'
+
+'''
+select_sentences returns the positions in sentences to make cards for (in input
+order) and a count of what was dropped and why. cost(position), if given, is
+the estimated cost of a sentence's card (0 for one that's already translated),
+which max_cost is checked against; max_cards caps the number of cards. Pass
+cards_per_word=None to keep every candidate that fits the budget.
+'''
+def select_sentences(sentences, segmenter, max_unknown=MAX_UNKNOWN_WORDS, cards_per_word=CARDS_PER_WORD, max_cards=None, max_cost=None, cost=None):
+    stats = {'selected': 0, 'all_known': 0, 'too_many_unknown': 0, 'redundant': 0, 'over_budget': 0}
+    unknown_words = [segmenter.unknown_words(sentence) for sentence in sentences]
+    word_counts = collections.Counter(word for words in unknown_words for word in words)
+
+    candidates = []
+    for i, words in enumerate(unknown_words):
+        if not words:
+            stats['all_known'] += 1
+        elif len(words) > max_unknown:
+            stats['too_many_unknown'] += 1
+        else:
+            candidates.append(i)
+    # Most useful first: most frequent unknown words, then fewest unknown words, then shortest
+    candidates.sort(key=lambda i: (-sum(word_counts[word] for word in unknown_words[i]) / len(unknown_words[i]),
+                                   len(unknown_words[i]), len(sentences[i]), i))
+
+    selected = []
+    word_cards = collections.Counter()
+    total_cost = 0.0
+    for i in candidates:
+        if cards_per_word is not None and all(word_cards[word] >= cards_per_word for word in unknown_words[i]):
+            stats['redundant'] += 1
+            continue
+        sentence_cost = cost(i) if cost is not None else 0.0
+        if (max_cards is not None and len(selected) >= max_cards) or \
+           (max_cost is not None and total_cost + sentence_cost > max_cost):
+            stats['over_budget'] += 1
+            continue
+        selected.append(i)
+        word_cards.update(unknown_words[i])
+        total_cost += sentence_cost
+
+    stats['selected'] = len(selected)
+    stats['new_words'] = len(word_cards)
+    stats['estimated_cost'] = total_cost
+    return sorted(selected), stats
+
+# Reads a known words list, one word per line
+def read_known_words(known_words_file):
+    with open(known_words_file, 'r', encoding='utf-8') as fp:
+        return [line.strip() for line in fp if line.strip()]
@@ -0,0 +1,132 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+'''
+A local stand-in for the OpenAI chat completions endpoint, for exercising
+txt2pleco without an API key or paying for tokens:
+
+    python stub_openai_server.py --port 8765 --latency 0.5 --rpm 60
+
+then call txt2pleco(..., base_url='http://127.0.0.1:8765/v1', api_key='stub').
+
+Each line between the last <INPUT> and </INPUT> of the user message gets a
+fake Pleco line back (or a fake numbered translation for numbered lines). Every response waits `latency` seconds. Requests beyond
+`requests_per_minute` get a 429 with a Retry-After header, and `error_rate` of
+requests fail with a 500.
+'''
+
+class StubChatCompletionsHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_json(404, {'error': {'message': f'Unknown path {self.path}'}})
+            return
+
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        with server.lock:
+            server.request_count += 1
+            now = time.monotonic()
+            while server.request_times and now - server.request_times[0] > 60:
+                server.request_times.popleft()
+            rate_limited = server.requests_per_minute is not None and \
+                           len(server.request_times) >= server.requests_per_minute
+            if not rate_limited:
+                server.request_times.append(now)
+
+        if rate_limited:
+            server.rate_limited_count += 1
+            retry_after = 60 - (now - server.request_times[0])
+            self.send_json(429, {'error': {'message': 'Rate limit reached', 'type': 'requests'}}, 
+                           headers={'Retry-After': f'{retry_after:.2f}'})
+            return
+        if random.random() < server.error_rate:
+            self.send_json(500, {'error': {'message': 'Stub server error'}})
+            return
+
+        time.sleep(server.latency)
+        prompt = body['messages'][-1]['content']
+        content = '\n'.join(stub_answer_line(line) for line in input_lines(prompt))
+        prompt_tokens = sum(len(message['content']) for message in body['messages'])
+        self.send_json(200, {
+            'id': f'chatcmpl-stub-{server.request_count}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'stub'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': content},
+                'finish_reason': 'stop'
+            }],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': len(content),
+                'total_tokens': prompt_tokens + len(content)
+            }
+        })
+
+    def send_json(self, status, payload, headers={}):
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+# The lines of the last <INPUT> block in a txt2pleco prompt
+def input_lines(prompt):
+    blocks = re.findall(r'<INPUT>\n(.*?)</INPUT>', prompt, flags=re.S)
+    if not blocks:
+        return []
+    return [line for line in blocks[-1].split('\n') if line.strip()]
+
+# Numbered lines come from a gloss-only prompt and get a numbered translation back
+def stub_answer_line(line):
+    match = re.match(r'^(\d+)\. ', line)
+    if match:
+        return f'{match.group(1)}. Stub translation'
+    return f'{line}[{line}]\tpīnyīn\tStub translation'
+
+# Starts the stub server on a background thread. Returns the server; call server.shutdown() to stop it.
+def run_stub_server(host='127.0.0.1', port=0, latency=0.0, requests_per_minute=None, error_rate=0.0, verbose=False):
+    server = ThreadingHTTPServer((host, port), StubChatCompletionsHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.requests_per_minute = requests_per_minute
+    server.error_rate = error_rate
+    server.verbose = verbose
+    server.lock = threading.Lock()
+    server.request_times = deque()
+    server.request_count = 0
+    server.rate_limited_count = 0
+    server.base_url = f'http://{host}:{server.server_address[1]}/v1'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stub OpenAI chat completions server.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to wait before each response')
+    parser.add_argument('--rpm', type=int, default=None, help='Requests per minute before returning 429s')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Fraction of requests that fail with a 500')
+    args = parser.parse_args()
+
+    server = run_stub_server(args.host, args.port, args.latency, args.rpm, args.error_rate, verbose=True)
+    print(f'Stub server listening on {server.base_url}', flush=True)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
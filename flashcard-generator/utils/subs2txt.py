@@ -1,4 +1,12 @@
-import pysrt
+import re
+import unicodedata
+import zlib
+from array import array
+
+import numpy as np
+
+from metrics import NoMetrics
+from run_manifest import atomic_output
 
 LATIN_ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
 CHARS_TO_IGNORE = ',.?! 。…'
@@ -7,36 +15,226 @@ CHARS_TO_IGNORE = ',.?! 。…'
 BLACKLISTED_LINES = ['未经许可,不得翻唱或使用',
                      '请不吝点赞 订阅 转发 打赏支持明镜与点点栏目']
 
-def subs2txt(input_file, output_file, min_chars=5, no_english=True, verbose=False):
+'''
+str.translate table that deletes CHARS_TO_IGNORE and every Unicode punctuation
+character (categories P*), e.g. the full-width ，。！？ in Whisper's output.
+Code points are looked up in unicodedata the first time they're seen.
+'''
+class IgnoreTable(dict):
+    def __missing__(self, codepoint):
+        character = chr(codepoint)
+        self[codepoint] = None if character in CHARS_TO_IGNORE or unicodedata.category(character).startswith('P') else codepoint
+        return self[codepoint]
+
+# Precompiled versions of the above, so each subtitle is checked in one C-level pass
+LATIN_PATTERN = re.compile(f'[{LATIN_ALPHABET}]')
+IGNORE_TABLE = IgnoreTable()
+
+# The form lines are compared in: NFKC (full-width forms folded) without punctuation or spaces
+def normalize_text(text):
+    return unicodedata.normalize('NFKC', text).translate(IGNORE_TABLE)
+
+BLACKLIST = frozenset(normalize_text(line) for line in BLACKLISTED_LINES)
+
+# Near-duplicate detection: lines whose character bigrams overlap a blacklisted
+# or already kept line by at least NEAR_DUPLICATE_THRESHOLD (Jaccard similarity)
+# are dropped. Whisper's hallucinations come back with small variations
+# (punctuation, a character or two), which exact matching misses.
+NEAR_DUPLICATE_THRESHOLD = 0.8
+SHINGLE_SIZE = 2
+# MinHash signature of MINHASH_BANDS x MINHASH_ROWS hashes, split into bands for LSH
+MINHASH_BANDS = 8
+MINHASH_ROWS = 4
+MINHASH_PRIME = (1 << 61) - 1
+# Lines whose signatures are computed together
+NEAR_DUPLICATE_BATCH_SIZE = 4096
+
+'''
+subs2txt streams one or more .srt files (e.g. a whole season's transcripts)
+and writes the lines that pass the filters to output_file, in their original
+order:
+- at least min_chars characters that aren't punctuation or in CHARS_TO_IGNORE
+- no Latin letters (if no_english)
+- not a blacklisted line, or a near-duplicate of one (compared after normalize_text)
+- not a repeat, or a near-duplicate, of a line already kept
+
+Pass near_duplicate_threshold=None to only drop exact repeats.
+output_file is replaced atomically once every line has been written.
+Returns the number of lines dropped for each reason (and times the run as the
+'subs2txt' stage of metrics, if given).
+'''
+def subs2txt(input_file, output_file, min_chars=5, no_english=True, near_duplicate_threshold=NEAR_DUPLICATE_THRESHOLD, metrics=None, verbose=False):
     if verbose:
         print('\nSUBS2TXT\n=======', flush=True)
-    
-    output = open(output_file, 'wb+')
-    subs = pysrt.open(input_file)
-    texts_to_write = []
-    for sub in subs:
+    if metrics is None:
+        metrics = NoMetrics()
+
+    input_files = [input_file] if isinstance(input_file, str) else input_file
+    texts = (text for file in input_files for text in read_subtitle_texts(file))
+    stats = {'kept': 0, 'too_short': 0, 'english': 0, 'blacklisted': 0, 'duplicate': 0, 'near_duplicate': 0}
+
+    with metrics.stage('subs2txt', unit='subtitles') as stage:
+        with atomic_output(output_file) as temp_output_file, open(temp_output_file, 'wb+') as output:
+            for text in filter_subtitle_texts(texts, stats, min_chars, no_english, near_duplicate_threshold):
+                if stats['kept'] > 1:
+                    output.write(b'\n')
+                output.write(text.encode('utf-8'))
+        stage.items = sum(stats.values())
+
+    if verbose:
+        print(', '.join(f'{reason}: {count}' for reason, count in stats.items()), flush=True)
+    return stats
+
+# Yields the texts that pass the filters, counting what was dropped and why in stats
+def filter_subtitle_texts(texts, stats, min_chars=5, no_english=True, near_duplicate_threshold=NEAR_DUPLICATE_THRESHOLD):
+    seen_texts = set()
+    detector = None
+    if near_duplicate_threshold is not None:
+        detector = NearDuplicateDetector(near_duplicate_threshold)
+        detector.add(detector.signatures(BLACKLISTED_LINES))
+
+    batch = []
+    for text in texts:
+        normalized_text = normalize_text(text)
         # Check if subtitle isn't long enough
-        qualifying_chars = [char in sub.text for char in sub.text if char not in CHARS_TO_IGNORE]
-        if len(qualifying_chars) < min_chars:
+        if len(normalized_text) < min_chars:
+            stats['too_short'] += 1
             continue
 
-        # If applicable, check if subtitle contains any latin letters.
-        if no_english:
-            if any([char in LATIN_ALPHABET for char in sub.text]):
-                continue
-        
-        if sub.text in BLACKLISTED_LINES:
+        # If applicable, check if subtitle contains any latin letters (full-width ones included).
+        if no_english and LATIN_PATTERN.search(normalized_text):
+            stats['english'] += 1
+            continue
+
+        if normalized_text in BLACKLIST:
+            stats['blacklisted'] += 1
             continue
-        
-        texts_to_write.append(sub.text)
-    
-    # Remove any duplicate lines
-    texts_to_write = list(set(texts_to_write))
 
-    output.write('\n'.join(texts_to_write).encode('utf-8'))
-    output.close()
+        # Remove any duplicate lines, even if only their punctuation or character widths differ
+        if normalized_text in seen_texts:
+            stats['duplicate'] += 1
+            continue
+        seen_texts.add(normalized_text)
+
+        if detector is None:
+            stats['kept'] += 1
+            yield text
+            continue
+
+        # MinHash signatures are computed for a whole batch of lines at once
+        batch.append(text)
+        if len(batch) == NEAR_DUPLICATE_BATCH_SIZE:
+            yield from filter_near_duplicates(batch, detector, stats)
+            batch = []
+
+    if batch:
+        yield from filter_near_duplicates(batch, detector, stats)
+
+def filter_near_duplicates(batch, detector, stats):
+    signatures = detector.signatures(batch)
+    for text, signature in zip(batch, signatures):
+        if detector.is_near_duplicate(signature):
+            stats['near_duplicate'] += 1
+            continue
+        detector.add([signature])
+        stats['kept'] += 1
+        yield text
+
+'''
+read_subtitle_texts streams an .srt file and yields the text of each subtitle
+(lines joined with a newline, like pysrt's SubRipItem.text) without loading
+the whole file or building subtitle objects.
+'''
+def read_subtitle_texts(input_file):
+    text_lines = []
+    in_text = False
+    with open(input_file, 'r', encoding='utf-8-sig') as fp:
+        for line in fp:
+            line = line.rstrip('\r\n')
+            if not line.strip():
+                if text_lines:
+                    yield '\n'.join(text_lines)
+                text_lines = []
+                in_text = False
+            elif in_text:
+                text_lines.append(line)
+            elif '-->' in line:
+                in_text = True
+
+    if text_lines:
+        yield '\n'.join(text_lines)
+
+'''
+NearDuplicateDetector finds lines similar to lines it has already seen using
+MinHash signatures over character bigrams and locality-sensitive hashing: a
+signature is split into MINHASH_BANDS bands, lines sharing any band become
+candidates, and a candidate counts as a near-duplicate when the signatures
+agree on at least `threshold` of their hashes (an estimate of the Jaccard
+similarity of the bigram sets). Lookups cost the same no matter how many lines
+have been added.
+
+Signatures are computed for many lines at once: the bigram hashes of every
+line are concatenated, permuted in one NumPy operation, and reduced to a
+per-line minimum with np.minimum.reduceat.
+'''
+class NearDuplicateDetector:
+    def __init__(self, threshold=NEAR_DUPLICATE_THRESHOLD, seed=0):
+        random_state = np.random.RandomState(seed)
+        permutations = MINHASH_BANDS * MINHASH_ROWS
+        self.a = random_state.randint(1, 1 << 31, size=(permutations, 1)).astype(np.uint64)
+        self.b = random_state.randint(0, 1 << 31, size=(permutations, 1)).astype(np.uint64)
+        # Odd multipliers to fold each band's rows into one bucket key (wrapping uint64 arithmetic)
+        self.band_multipliers = (random_state.randint(0, 1 << 31, size=MINHASH_ROWS).astype(np.uint64) << np.uint64(1)) | np.uint64(1)
+        self.threshold = threshold
+        self.buckets = [{} for _ in range(MINHASH_BANDS)]
+        self.signatures_seen = []
+
+    '''
+    Returns one (signature, band keys) pair per text, or None for texts too
+    short to have a bigram.
+    '''
+    def signatures(self, texts):
+        hashes = array('Q')
+        offsets = array('q', [0])
+        for text in texts:
+            text = normalize_text(text)
+            hashes.extend(zlib.crc32(text[i: i+SHINGLE_SIZE].encode('utf-8')) 
+                          for i in range(len(text) - SHINGLE_SIZE + 1))
+            offsets.append(len(hashes))
+        offsets = np.frombuffer(offsets, dtype=np.int64)
+        if len(hashes) == 0:
+            return [None] * len(texts)
+
+        # (a * x + b) mod p for every permutation and bigram, then the minimum per permutation and line
+        values = (self.a * np.frombuffer(hashes, dtype=np.uint64) + self.b) % MINHASH_PRIME
+        has_shingles = offsets[1:] > offsets[:-1]
+        minimums = np.minimum.reduceat(values, offsets[:-1][has_shingles], axis=1).T
+        band_keys = (minimums.reshape(-1, MINHASH_BANDS, MINHASH_ROWS) * self.band_multipliers).sum(axis=2, dtype=np.uint64)
+
+        signatures = [None] * len(texts)
+        for i, signature, keys in zip(np.flatnonzero(has_shingles), minimums, band_keys.tolist()):
+            signatures[i] = (signature, keys)
+        return signatures
+
+    def is_near_duplicate(self, signature):
+        if signature is None:
+            return False
+        signature, keys = signature
+        candidates = set()
+        for band in range(MINHASH_BANDS):
+            candidates.update(self.buckets[band].get(keys[band], ()))
+        return any((self.signatures_seen[i] == signature).mean() >= self.threshold for i in candidates)
+
+    def add(self, signatures):
+        for signature in signatures:
+            if signature is None:
+                continue
+            signature, keys = signature
+            self.signatures_seen.append(signature)
+            for band in range(MINHASH_BANDS):
+                self.buckets[band].setdefault(keys[band], []).append(len(self.signatures_seen) - 1)
 
 if __name__ == '__main__':
     input_file = 'transcript.srt'
     output_file = 'transcript.txt'
-    subs2txt(input_file, output_file)        
+    subs2txt(input_file, output_file)
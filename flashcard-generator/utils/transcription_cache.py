@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+'''
+A persistent cache of Whisper output per audio chunk, used by av2subs.
+
+Entries are keyed by a SHA-256 of the chunk's float32 PCM samples together with
+the transcription settings (model name, prompt, decoding options), so a re-run
+only transcribes chunks whose audio or settings actually changed. Changing
+speech_threshold moves chunk boundaries, so only chunks whose samples differ
+miss the cache.
+
+Entries live in one SQLite file. When the total size of the stored segments
+goes over max_bytes, the least recently used entries are evicted.
+'''
+
+DEFAULT_CACHE_FILE = 'temp/transcription_cache.sqlite3'
+DEFAULT_MAX_CACHE_BYTES = 256 * 1024 * 1024
+
+class TranscriptionCache:
+    def __init__(self, cache_file=DEFAULT_CACHE_FILE, max_bytes=DEFAULT_MAX_CACHE_BYTES):
+        cache_directory = os.path.dirname(cache_file)
+        if cache_directory and not os.path.exists(cache_directory):
+            os.makedirs(cache_directory)
+
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # Callers may share one instance between threads (e.g. flashcard-generator's
+        # pipeline stages), as long as they don't use it at the same time
+        self.connection = sqlite3.connect(cache_file, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS transcripts '
+                                '(key TEXT PRIMARY KEY, segments TEXT, size INTEGER, last_used REAL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS transcripts_last_used ON transcripts (last_used)')
+        self.connection.commit()
+
+    # Cache key for one chunk of audio under the given transcription settings
+    def key(self, audio_chunk, settings):
+        return chunk_key(audio_chunk, settings)
+
+    # Returns the cached segments for key, or None on a miss
+    def get(self, key):
+        row = self.connection.execute('SELECT segments FROM transcripts WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.connection.execute('UPDATE transcripts SET last_used = ? WHERE key = ?', (time.time(), key))
+        self.connection.commit()
+        return json.loads(row[0])
+
+    def put(self, key, segments):
+        value = json.dumps(segments, ensure_ascii=False)
+        self.connection.execute('INSERT OR REPLACE INTO transcripts VALUES (?, ?, ?, ?)', 
+                                (key, value, len(value.encode('utf-8')), time.time()))
+        self.connection.commit()
+        self.evict()
+
+    # Drops least recently used entries until the cache fits in max_bytes
+    def evict(self):
+        total_bytes = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM transcripts').fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return
+
+        evicted_keys = []
+        for key, size in self.connection.execute('SELECT key, size FROM transcripts ORDER BY last_used'):
+            if total_bytes <= self.max_bytes:
+                break
+            evicted_keys.append((key,))
+            total_bytes -= size
+        self.connection.executemany('DELETE FROM transcripts WHERE key = ?', evicted_keys)
+        self.connection.commit()
+
+    def stats(self):
+        entries, total_bytes = self.connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM transcripts').fetchone()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': entries,
+            'bytes': total_bytes
+        }
+
+    def close(self):
+        self.connection.close()
+
+# SHA-256 of a chunk's samples and the transcription settings (also used as av2subs' run manifest key)
+def chunk_key(audio_chunk, settings):
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(audio_chunk, dtype=np.float32).tobytes())
+    digest.update(json.dumps(settings, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    return digest.hexdigest()
@@ -0,0 +1,93 @@
+import os
+import re
+import sqlite3
+import unicodedata
+
+'''
+A persistent translation memory for txt2pleco: Pleco rows keyed by the
+normalized simplified sentence and the model that produced them. Lines that
+come back across episodes (theme songs, catchphrases, recurring Whisper
+hallucinations) are looked up here instead of being paid for again.
+
+Rows can be exported to and imported from a .tsv file with the columns
+model, sentence, Pleco row (the row itself contains tabs, so it goes last).
+'''
+
+DEFAULT_MEMORY_FILE = 'translation_memory.sqlite3'
+
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+# Full-width/half-width variants and stray whitespace shouldn't make a sentence "new"
+def normalize_sentence(sentence):
+    sentence = unicodedata.normalize('NFKC', sentence)
+    return WHITESPACE_PATTERN.sub(' ', sentence).strip()
+
+class TranslationMemory:
+    def __init__(self, memory_file=DEFAULT_MEMORY_FILE):
+        memory_directory = os.path.dirname(memory_file)
+        if memory_directory and not os.path.exists(memory_directory):
+            os.makedirs(memory_directory)
+
+        self.hits = 0
+        self.misses = 0
+        # Callers may share one instance between threads (e.g. flashcard-generator's
+        # pipeline stages), as long as they don't use it at the same time
+        self.connection = sqlite3.connect(memory_file, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS translations '
+                                '(sentence TEXT, model TEXT, row TEXT, PRIMARY KEY (sentence, model))')
+        self.connection.commit()
+
+    # Returns the stored Pleco row for sentence, or None if it hasn't been translated by model
+    def get(self, sentence, model):
+        row = self.connection.execute('SELECT row FROM translations WHERE sentence = ? AND model = ?', 
+                                      (normalize_sentence(sentence), model)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def put(self, sentence, model, row):
+        self.connection.execute('INSERT OR REPLACE INTO translations VALUES (?, ?, ?)', 
+                                (normalize_sentence(sentence), model, row))
+        self.connection.commit()
+
+    # Adds every row of a .tsv written by export_tsv. Returns the number of rows imported.
+    def import_tsv(self, input_file):
+        rows = []
+        with open(input_file, 'r', encoding='utf-8') as fp:
+            for line in fp:
+                values = line.rstrip('\n').split('\t', 2)
+                if len(values) == 3:
+                    rows.append((normalize_sentence(values[1]), values[0], values[2]))
+        self.connection.executemany('INSERT OR REPLACE INTO translations VALUES (?, ?, ?)', rows)
+        self.connection.commit()
+        return len(rows)
+
+    # Writes every stored row (optionally only those of one model) to a .tsv. Returns the number of rows exported.
+    def export_tsv(self, output_file, model=None):
+        query = 'SELECT model, sentence, row FROM translations'
+        parameters = ()
+        if model is not None:
+            query += ' WHERE model = ?'
+            parameters = (model,)
+
+        exported = 0
+        with open(output_file, 'w', encoding='utf-8') as fp:
+            for model_name, sentence, row in self.connection.execute(query + ' ORDER BY model, sentence', parameters):
+                fp.write(f'{model_name}\t{sentence}\t{row}\n')
+                exported += 1
+        return exported
+
+    def stats(self):
+        entries = self.connection.execute('SELECT COUNT(*) FROM translations').fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': entries
+        }
+
+    def close(self):
+        self.connection.close()
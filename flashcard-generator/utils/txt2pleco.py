@@ -1,5 +1,20 @@
-import openai
+import asyncio
+import os
+import random
+import re
+import time
+
 import dotenv
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+from translation_memory import normalize_sentence
+from metrics import NoMetrics
+from run_manifest import atomic_output, content_key
+from sentence_ranking import MAX_UNKNOWN_WORDS, Segmenter, select_sentences
+import cedict
 
 '''
 Pleco import .txt format
@@ -7,7 +22,28 @@ Pleco import .txt format
 simp[trad]n\tpiyin\tdefinition
 '''
 
+# Fixed batch size used before token-budget batching, kept as the cost baseline
 MAX_LINES_PER_BATCH = 15
+# Token-budget batching: each request's prompt plus expected completion is
+# packed up to TARGET_BATCH_TOKENS, without the expected completion going over
+# MAX_COMPLETION_TOKENS (so long paragraphs don't get truncated).
+TARGET_BATCH_TOKENS = 3000
+MAX_COMPLETION_TOKENS = 1500
+# Each output line repeats the sentence, adds the traditional characters, the
+# pinyin and an English translation, so it runs about this many times longer
+# than the input line.
+COMPLETION_TOKENS_PER_INPUT_TOKEN = 4
+# With the traditional characters and pinyin filled in locally (see cedict.py),
+# the model only writes the English translation.
+GLOSS_COMPLETION_TOKENS_PER_INPUT_TOKEN = 2
+# Number of batches in flight at once
+MAX_CONCURRENT_REQUESTS = 8
+# Retries for rate-limited (429), server-side (5xx) and connection errors, with
+# exponential backoff starting at RETRY_BASE_DELAY seconds
+MAX_RETRIES = 6
+RETRY_BASE_DELAY = 1.0
+# Rounds of follow-up batches for lines a response had no row for
+MISSING_LINE_RETRIES = 1
 SYSTEM_MESSAGE = '你是一个乐于助人的助手。'
 INSTRUCTIONS = '''Given a list of Chinese sentences, follow this pattern:
 <INPUT>
@@ -26,60 +62,568 @@ Here are some specific examples:
 
 Output:
 他们告诉我他们会说两种语言。[他們告訴我他們會說兩種語言。]	Tāmen gàosù wǒ tāmen huì shuō liǎng zhǒng yǔyán	They told me they spoke two languages.
-我还有好多问题要问你呢[ 我還有好多問題要問你呢 ]	Wǒ hái yǒu hǎoduō wèntí yào wèn nǐ ne	I still have so many questions to ask you
-这里没人做那件事。這裡沒人做那件事。]	Zhèlǐ méi rén zuò nà jiàn shì	No one here does that.
+我还有好多问题要问你呢。[我還有好多問題要問你呢。]	Wǒ hái yǒu hǎoduō wèntí yào wèn nǐ ne	I still have so many questions to ask you.
+这里没人做那件事。[這裡沒人做那件事。]	Zhèlǐ méi rén zuò nà jiàn shì	No one here does that.
     
 Here is my input:
 <INPUT>
 '''
+GLOSS_INSTRUCTIONS = '''Translate each of the following numbered Chinese sentences into natural English.
+Answer with one line per sentence, starting with the same number, and nothing else.
+
+Here is an example:
+<INPUT>
+1. 他们告诉我他们会说两种语言。
+2. 我还有好多问题要问你呢。
+</INPUT>
+
+Output:
+1. They told me they spoke two languages.
+2. I still have so many questions to ask you.
+
+Here is my input:
+<INPUT>
+'''
+GLOSS_LINE_PATTERN = re.compile(r'^\s*(\d+)\s*[.、:：)]\s*(.*)$')
 TOKEN_COST_DICT = {
     'gpt-3.5-turbo': {'input': 0.001, 'output': 0.002},
     'gpt-4': {'input': 0.03, 'output': 0.06}
 }
+# Default requests-per-minute and tokens-per-minute budgets per model
+RATE_LIMIT_DICT = {
+    'gpt-3.5-turbo': {'rpm': 3500, 'tpm': 160000},
+    'gpt-4': {'rpm': 500, 'tpm': 10000}
+}
+
+'''
+input_file is a file of line-separated sentences, or any iterable of sentences
+(e.g. epub2txt.epub2sentences).
+
+Lines are packed into batches by estimated token count (see batch_lines) rather
+than a fixed number of lines, so short subtitle lines share the cost of the
+instructions and long paragraphs don't overflow the completion. Pass
+target_batch_tokens=None to go back to MAX_LINES_PER_BATCH lines per batch.
+
+Batches are sent concurrently (up to `concurrency` in flight) while staying
+under the requests-per-minute and tokens-per-minute budgets, which default to
+RATE_LIMIT_DICT[model]. Batches that hit a 429, a 5xx or a connection error are
+retried with exponential backoff. Responses are written in the original batch
+order as soon as every earlier batch has been written. Lines a response has no
+row for are sent again in follow-up batches (MISSING_LINE_RETRIES rounds);
+lines still unanswered after that are counted in the report's missing_lines.
+
+base_url/api_key can point the client at another OpenAI-compatible server,
+e.g. stub_openai_server.py. When api_key is None it is read from secrets.env.
+
+If a TranslationMemory is given, every line is looked up in it first and only
+unseen sentences are sent to the API; new rows are stored as they come back.
+Repeated lines within the input only produce one card.
 
-def txt2pleco(input_file, output_file, model='gpt-3.5-turbo', known_words=[], header='txt2pleco_import', verbose=False):
+If a CC-CEDICT dictionary is given (see cedict.load_cedict), the traditional
+characters and pinyin are filled in locally and the model is only asked for
+the English translation (GLOSS_INSTRUCTIONS), which cuts completion tokens.
+Lines with characters the dictionary doesn't have still get the full prompt.
+
+If a RunManifest is given (see run_manifest.py), every response is recorded in
+it under a hash of its prompt, and batches it already has a response for aren't
+sent again, so a run that crashed at batch 90 of 130 resumes from there. The
+output file is written atomically: it only appears once every row is in it.
+
+If known_words are given, only the sentences worth a card are kept (see
+sentence_ranking.py): those with 1 to max_unknown_words unknown words, ranked
+by how useful their unknown words are, up to max_cards cards and an estimated
+max_cost in dollars. Sentences already in the translation memory count as free.
+This runs before any request is made, so dropped sentences cost nothing.
+
+If a Metrics is given (see metrics.py), the 'prepare' (dedupe, translation
+memory, batching) and 'translate' stages are timed in it, along with the
+latency, tokens and cost of every API request.
+
+Returns a report of the run (see batching_report).
+'''
+def txt2pleco(input_file, output_file, model='gpt-3.5-turbo', known_words=[], max_unknown_words=MAX_UNKNOWN_WORDS, max_cards=None, max_cost=None, header='txt2pleco_import', memory=None, dictionary=None, manifest=None, metrics=None, target_batch_tokens=TARGET_BATCH_TOKENS, concurrency=MAX_CONCURRENT_REQUESTS, requests_per_minute=None, tokens_per_minute=None, base_url=None, api_key=None, verbose=False):
     if verbose:
         print('\nTXT2PLECO\n=========', flush=True)
+    if metrics is None:
+        metrics = NoMetrics()
     
-    input = open(input_file, 'rb')
-    lines = input.readlines()
-    batches = [lines[i:i+MAX_LINES_PER_BATCH] for i in range(0, len(lines), MAX_LINES_PER_BATCH)]
-    batches = [[line.decode('utf-8') for line in batch] for batch in batches]
-    input.close()
+    with metrics.stage('prepare', unit='lines') as stage:
+        if isinstance(input_file, str):
+            input = open(input_file, 'rb')
+            lines = [line.decode('utf-8') for line in input.readlines()]
+            input.close()
+        else:
+            # Any iterable of sentences, e.g. epub2txt.epub2sentences(...), as lines
+            lines = [sentence.rstrip('\n') + '\n' for sentence in input_file]
 
-    if verbose:
-        print('Prompting ChatGPT', flush=True)
-    client = openai.OpenAI(
-        api_key=dotenv.dotenv_values('secrets.env')['OPENAI_API_KEY']
-    )
-
-    total_cost = 0
-    output = open(output_file, 'wb+')
-    output.write(f'//{header}\n'.encode('utf-8'))
-    for i in range(len(batches)):
-        if verbose:
-            print(f'\tWorking on batch {i+1} of {len(batches)}. Cost so far: ${round(total_cost, 2)}', flush=True)
-        prompt = INSTRUCTIONS + ''.join(batches[i]) + '</INPUT>'
-        response, usage = prompt_model(client, model, SYSTEM_MESSAGE, prompt)
-        total_cost += (usage.prompt_tokens * TOKEN_COST_DICT[model]['input'] / 1000) + \
-                     (usage.completion_tokens * TOKEN_COST_DICT[model]['output'] / 1000)
-        output.write(response.encode('utf-8'))
-        output.write('\n'.encode('utf-8'))
+        # rows[i] holds the Pleco rows to write for lines[i], once they're known
+        rows = {}
+        lines_to_send = []
+        seen_sentences = set()
+        for i in range(len(lines)):
+            sentence = normalize_sentence(lines[i])
+            if not sentence or sentence in seen_sentences:
+                rows[i] = []
+                continue
+            seen_sentences.add(sentence)
+
+            cached_row = memory.get(sentence, model) if memory is not None else None
+            if cached_row is not None:
+                rows[i] = [cached_row]
+            else:
+                lines_to_send.append(i)
+        if verbose and memory is not None:
+            print(f'{len(seen_sentences) - len(lines_to_send)} of {len(seen_sentences)} sentences found in translation memory', flush=True)
+
+        # The instructions are the same for every request, so they're measured once per run
+        # and always sent first, which lets the API reuse its cached prompt prefix.
+        instructions = INSTRUCTIONS if dictionary is None else GLOSS_INSTRUCTIONS
+        completion_ratio = COMPLETION_TOKENS_PER_INPUT_TOKEN if dictionary is None else GLOSS_COMPLETION_TOKENS_PER_INPUT_TOKEN
+        instruction_tokens = estimate_tokens(SYSTEM_MESSAGE + instructions + '</INPUT>', model)
+
+        # Only the sentences worth a card go on to the API
+        cards = len(seen_sentences)
+        ranking = None
+        if known_words:
+            if verbose and dictionary is None:
+                print('No CC-CEDICT dictionary given, so unknown words are counted character by character', flush=True)
+            candidates = sorted([i for i in rows if rows[i]] + lines_to_send)
+            line_cost = lambda j: 0.0 if rows.get(candidates[j]) else card_cost(lines[candidates[j]], model, completion_ratio)
+            selected, ranking = select_sentences([normalize_sentence(lines[i]) for i in candidates],
+                                                 Segmenter(known_words, dictionary),
+                                                 max_unknown=max_unknown_words,
+                                                 max_cards=max_cards,
+                                                 max_cost=max_cost,
+                                                 cost=line_cost)
+            selected = set(candidates[j] for j in selected)
+            for i in candidates:
+                if i not in selected:
+                    rows[i] = []
+            lines_to_send = [i for i in lines_to_send if i in selected]
+            cards = len(selected)
+            if verbose:
+                print(f'{cards} of {len(candidates)} sentences selected for cards '
+                      f'({ranking["all_known"]} all known, {ranking["too_many_unknown"]} too hard, '
+                      f'{ranking["redundant"]} redundant, {ranking["over_budget"]} over budget)', flush=True)
+
+        # Lines the dictionary can't fully read (e.g. a character it doesn't have) get the full
+        # prompt instead, so the model writes their pinyin rather than it coming out incomplete
+        if dictionary is None:
+            groups = [(False, lines_to_send)]
+        else:
+            glossed_lines = [i for i in lines_to_send if cedict.covers(lines[i].strip(), dictionary)]
+            glossed_set = set(glossed_lines)
+            groups = [(True, glossed_lines), (False, [i for i in lines_to_send if i not in glossed_set])]
+            if verbose and len(glossed_lines) < len(lines_to_send):
+                print(f'{len(lines_to_send) - len(glossed_lines)} lines have characters missing from CC-CEDICT and get the full prompt', flush=True)
+
+        # batch_glossed[b] is True for batches sent with GLOSS_INSTRUCTIONS
+        batch_indices = []
+        batch_glossed = []
+        batches = []
+        prompts = []
+        expected_tokens = []
+        batch_keys = []
+
+        # Packs the lines at positions group into new batches and returns their numbers
+        def add_batches(group, glossed):
+            group_instructions = GLOSS_INSTRUCTIONS if glossed else INSTRUCTIONS
+            group_ratio = GLOSS_COMPLETION_TOKENS_PER_INPUT_TOKEN if glossed else COMPLETION_TOKENS_PER_INPUT_TOKEN
+            if target_batch_tokens is None:
+                batch_sizes = [len(group[i:i+MAX_LINES_PER_BATCH]) for i in range(0, len(group), MAX_LINES_PER_BATCH)]
+            else:
+                group_instruction_tokens = estimate_tokens(SYSTEM_MESSAGE + group_instructions + '</INPUT>', model)
+                batch_sizes = [len(batch) for batch in batch_lines([lines[i] for i in group], model, group_instruction_tokens, target_batch_tokens, group_ratio)]
+            new_batches = []
+            batch_start = 0
+            for batch_size in batch_sizes:
+                batch_indices.append(group[batch_start: batch_start+batch_size])
+                batch_glossed.append(glossed)
+                batches.append([lines[i] for i in batch_indices[-1]])
+                prompts.append(build_prompt(group_instructions, batches[-1], numbered=glossed))
+                expected_tokens.append(estimate_tokens(SYSTEM_MESSAGE + prompts[-1], model) + estimate_tokens(''.join(batches[-1]), model) * group_ratio)
+                batch_keys.append(content_key(model, SYSTEM_MESSAGE, prompts[-1]))
+                new_batches.append(len(batches) - 1)
+                batch_start += batch_size
+            return new_batches
+
+        round_batches = [batch_i for glossed, group in groups for batch_i in add_batches(group, glossed)]
+        stage.items = len(lines)
+
+    next_line_to_write = 0
+    # Lines the model didn't answer, by whether they were glossed, to be prompted again in the next round
+    missing_lines = {True: [], False: []}
+    retry_missing_lines = True
+    unanswered_lines = 0
+    # Unpaired rows that follow a line still waiting on its next round
+    held_rows = {}
+    # Batches answered from the run manifest rather than the API
+    resumed_batches = set()
+
+    # Writes rows in input order, up to the first line that is still waiting on a batch
+    def write_ready_rows():
+        nonlocal next_line_to_write
+        while next_line_to_write in rows:
+            for row in rows.pop(next_line_to_write):
+                output.write(f'{row}\n'.encode('utf-8'))
+            next_line_to_write += 1
+
+    # Stores a batch's rows against its lines (and in the translation memory and run manifest).
+    # Lines the response has no row for are held back for the next round, or dropped in the last one.
+    def handle_response(batch_i, response):
+        nonlocal unanswered_lines
+        if manifest is not None and batch_i not in resumed_batches:
+            manifest.record('translate', batch_keys[batch_i], response)
+        if not batch_glossed[batch_i]:
+            paired_rows, unpaired_rows = pair_response_rows(batches[batch_i], response)
+        else:
+            paired_rows, unpaired_rows = local_pleco_rows(batches[batch_i], response, dictionary), []
+        for j, i in enumerate(batch_indices[batch_i]):
+            if j in paired_rows:
+                rows[i] = [paired_rows[j]] + held_rows.pop(i, [])
+                if memory is not None:
+                    memory.put(lines[i], model, paired_rows[j])
+            elif retry_missing_lines:
+                missing_lines[batch_glossed[batch_i]].append(i)
+            else:
+                rows[i] = held_rows.pop(i, [])
+                unanswered_lines += 1
+        last_line = batch_indices[batch_i][-1]
+        if last_line in rows:
+            rows[last_line].extend(unpaired_rows)
+        else:
+            held_rows.setdefault(last_line, []).extend(unpaired_rows)
+        write_ready_rows()
+
+    usage = {'prompt_tokens': 0, 'completion_tokens': 0, 'cost': 0}
+    with metrics.stage('translate', unit='batches') as stage:
+        stage.items = 0
+        with atomic_output(output_file) as temp_output_file, open(temp_output_file, 'wb+') as output:
+            output.write(f'//{header}\n'.encode('utf-8'))
+            # Lines before the first batch may all be cached already
+            write_ready_rows()
 
+            for round_i in range(MISSING_LINE_RETRIES + 1):
+                retry_missing_lines = round_i < MISSING_LINE_RETRIES
+                # Batches that already have a response from an earlier, unfinished run. Retry batches
+                # are built the same way every run, so they resume too.
+                resumed_responses = {}
+                if manifest is not None:
+                    for batch_i in round_batches:
+                        response = manifest.get('translate', batch_keys[batch_i])
+                        if response is not None:
+                            resumed_responses[batch_i] = response
+                    if verbose:
+                        print(f'{len(resumed_responses)} of {len(round_batches)} batches already translated in this run', flush=True)
+                resumed_batches.update(resumed_responses)
+                for batch_i, response in resumed_responses.items():
+                    handle_response(batch_i, response)
+
+                batches_to_send = [batch_i for batch_i in round_batches if batch_i not in resumed_responses]
+                if batches_to_send:
+                    if api_key is None:
+                        api_key = dotenv.dotenv_values('secrets.env')['OPENAI_API_KEY']
+                    rate_limits = RATE_LIMIT_DICT.get(model, {})
+
+                    if verbose:
+                        print(f'Prompting ChatGPT with {len(batches_to_send)} batches ({concurrency} concurrent requests)', flush=True)
+                    round_usage = asyncio.run(prompt_batches([prompts[batch_i] for batch_i in batches_to_send],
+                                                             [expected_tokens[batch_i] for batch_i in batches_to_send],
+                                                             lambda j, response: handle_response(batches_to_send[j], response),
+                                                             model, api_key, base_url, concurrency,
+                                                             requests_per_minute or rate_limits.get('rpm'),
+                                                             tokens_per_minute or rate_limits.get('tpm'),
+                                                             metrics=metrics, verbose=verbose))
+                    for key in usage:
+                        usage[key] += round_usage[key]
+                    stage.items += len(batches_to_send)
+
+                if not missing_lines[True] and not missing_lines[False]:
+                    break
+                if verbose:
+                    print(f'{len(missing_lines[True]) + len(missing_lines[False])} lines got no answer, prompting them again', flush=True)
+                # Sorted so the retry batches (and their manifest keys) don't depend on which batch came back first
+                round_batches = [batch_i for glossed in (True, False) for batch_i in add_batches(sorted(missing_lines[glossed]), glossed)]
+                missing_lines = {True: [], False: []}
+
+    report = batching_report(lines, batches, usage, model, instruction_tokens, completion_ratio, cards=cards - unanswered_lines, missing_lines=unanswered_lines)
+    if memory is not None:
+        report['memory'] = memory.stats()
+    if ranking is not None:
+        report['ranking'] = ranking
     if verbose:
-        print(f'Done prompting ChatGPT. Total cost: ${round(total_cost, 2)}')
-    output.close()
+        print(f'Done prompting ChatGPT. Total cost: ${round(report["total_cost"], 2)}')
+        print(f'\t{report["cards"]} cards in {report["batches"]} batches (vs {report["baseline_batches"]} fixed-size batches)', flush=True)
+        print(f'\tEstimated tokens saved: {report["tokens_saved"]} prompt, {report["completion_tokens_saved"]} completion', flush=True)
+        print(f'\tCost per card: ${report["cost_per_card"]:.5f} (fixed-size baseline: ${report["baseline_cost_per_card"]:.5f})', flush=True)
+        if report['missing_lines']:
+            print(f'\t{report["missing_lines"]} lines got no answer, even when prompted again, and have no card', flush=True)
+        if memory is not None:
+            print(f'\tTranslation memory hit rate: {report["memory"]["hit_rate"]:.0%}', flush=True)
+    return report
+
+# The user prompt for one batch. Gloss prompts number their lines so translations can be matched back.
+def build_prompt(instructions, batch, numbered=False):
+    if numbered:
+        batch = [f'{j+1}. {line.strip()}\n' for j, line in enumerate(batch)]
+    return instructions + ''.join(batch) + '</INPUT>'
+
+'''
+pair_response_rows matches the rows of a response back to the batch's lines.
+The model normally answers with one row per line in order; when the row count
+is off, rows are matched on their leading simplified sentence instead. Returns
+({line position in batch: row}, [rows that matched no line]).
+'''
+def pair_response_rows(batch, response):
+    response_rows = [row.strip() for row in response.split('\n') if row.strip()]
+    if len(response_rows) == len(batch):
+        return dict(enumerate(response_rows)), []
+
+    strip_chars = ' 。.!！?？'
+    positions = {normalize_sentence(line).strip(strip_chars): j for j, line in enumerate(batch)}
+    paired_rows = {}
+    unpaired_rows = []
+    for row in response_rows:
+        simplified = normalize_sentence(row.split('\t')[0].split('[')[0]).strip(strip_chars)
+        j = positions.get(simplified)
+        if j is not None and j not in paired_rows:
+            paired_rows[j] = row
+        else:
+            unpaired_rows.append(row)
+    return paired_rows, unpaired_rows
+
+'''
+batch_lines packs consecutive lines into batches so that each request's
+estimated prompt (instructions + lines) plus expected completion stays under
+target_batch_tokens, and the expected completion alone stays under
+MAX_COMPLETION_TOKENS. A line that is too long for any batch is sent alone.
+'''
+def batch_lines(lines, model, instruction_tokens, target_batch_tokens=TARGET_BATCH_TOKENS, completion_ratio=COMPLETION_TOKENS_PER_INPUT_TOKEN):
+    batches = []
+    batch = []
+    batch_tokens = instruction_tokens
+    completion_tokens = 0
+    for line in lines:
+        line_tokens = estimate_tokens(line, model)
+        line_completion_tokens = line_tokens * completion_ratio
+        if batch and (batch_tokens + line_tokens + line_completion_tokens > target_batch_tokens or 
+                      completion_tokens + line_completion_tokens > MAX_COMPLETION_TOKENS):
+            batches.append(batch)
+            batch = []
+            batch_tokens = instruction_tokens
+            completion_tokens = 0
+        batch.append(line)
+        batch_tokens += line_tokens + line_completion_tokens
+        completion_tokens += line_completion_tokens
+
+    if batch:
+        batches.append(batch)
+    return batches
+
+# Estimated cost in dollars of one line's share of a request (its prompt tokens and expected completion)
+def card_cost(line, model, completion_ratio=COMPLETION_TOKENS_PER_INPUT_TOKEN):
+    line_tokens = estimate_tokens(line, model)
+    return (line_tokens * TOKEN_COST_DICT[model]['input'] + line_tokens * completion_ratio * TOKEN_COST_DICT[model]['output']) / 1000
+
+# Token count of text, using tiktoken when it's installed and a per-character estimate otherwise
+def estimate_tokens(text, model):
+    if tiktoken is not None:
+        try:
+            return len(tiktoken.encoding_for_model(model).encode(text))
+        except KeyError:
+            pass
+
+    # CJK characters are roughly one token each, everything else about four characters per token
+    cjk_chars = sum(1 for char in text if ord(char) >= 0x2E80)
+    return cjk_chars + (len(text) - cjk_chars + 3) // 4
+
+'''
+local_pleco_rows builds Pleco rows for a batch sent with GLOSS_INSTRUCTIONS:
+the traditional characters and pinyin come from the dictionary, the English
+from the model's numbered answer. Returns {line position in batch: row} for
+every line the model answered; txt2pleco prompts the others again.
+'''
+def local_pleco_rows(batch, response, dictionary):
+    response_rows = [row.strip() for row in response.split('\n') if row.strip()]
+    glosses = {}
+    for row in response_rows:
+        match = GLOSS_LINE_PATTERN.match(row)
+        if match and 0 < int(match.group(1)) <= len(batch):
+            glosses[int(match.group(1)) - 1] = match.group(2).strip()
+    # Unnumbered answers can still be matched up if there's one per line
+    if not glosses and len(response_rows) == len(batch):
+        glosses = dict(enumerate(response_rows))
+
+    rows = {}
+    for j, english in glosses.items():
+        simplified = batch[j].strip()
+        traditional, pinyin = cedict.pleco_fields(simplified, dictionary)
+        rows[j] = f'{simplified}[{traditional}]\t{pinyin}\t{english}'
+    return rows
+
+'''
+batching_report compares the run against the old way of sending every input
+line in fixed MAX_LINES_PER_BATCH batches with the full INSTRUCTIONS and a full
+Pleco row as the answer. Savings come from repeating the instructions fewer
+times, skipping duplicates and translation memory hits, and (with a local
+dictionary) shorter answers. Token savings are estimates (estimate_tokens);
+costs use TOKEN_COST_DICT. missing_lines counts the lines that never got a
+row, even after being prompted again.
+'''
+def batching_report(lines, batches, usage, model, instruction_tokens, completion_ratio, cards, missing_lines=0):
+    all_line_tokens = estimate_tokens(''.join(lines), model)
+    sent_line_tokens = estimate_tokens(''.join(line for batch in batches for line in batch), model)
+    baseline_batches = (len(lines) + MAX_LINES_PER_BATCH - 1) // MAX_LINES_PER_BATCH
+    baseline_instruction_tokens = estimate_tokens(SYSTEM_MESSAGE + INSTRUCTIONS + '</INPUT>', model)
+
+    tokens_saved = (baseline_batches * baseline_instruction_tokens + all_line_tokens) - \
+                   (len(batches) * instruction_tokens + sent_line_tokens)
+    completion_tokens_saved = all_line_tokens * COMPLETION_TOKENS_PER_INPUT_TOKEN - sent_line_tokens * completion_ratio
+    baseline_cost = usage['cost'] + tokens_saved * TOKEN_COST_DICT[model]['input'] / 1000 + \
+                    completion_tokens_saved * TOKEN_COST_DICT[model]['output'] / 1000
+    return {
+        'cards': cards,
+        'missing_lines': missing_lines,
+        'batches': len(batches),
+        'baseline_batches': baseline_batches,
+        'instruction_tokens': instruction_tokens,
+        'prompt_tokens': usage['prompt_tokens'],
+        'completion_tokens': usage['completion_tokens'],
+        'tokens_saved': tokens_saved,
+        'completion_tokens_saved': completion_tokens_saved,
+        'total_cost': usage['cost'],
+        'baseline_cost': baseline_cost,
+        'cost_per_card': usage['cost'] / cards if cards else 0.0,
+        'baseline_cost_per_card': baseline_cost / cards if cards else 0.0
+    }
+
+# Sends every prompt to the model and calls handle_response(prompt index, response)
+# as each one completes (in any order). expected_tokens are the per-prompt estimates
+# used for rate limiting. Returns the total token usage and cost.
+async def prompt_batches(prompts, expected_tokens, handle_response, model, api_key, base_url, concurrency, requests_per_minute=None, tokens_per_minute=None, metrics=None, verbose=False):
+    # Created here so its asyncio.Lock belongs to the loop asyncio.run just started
+    # (on Python 3.8/3.9 it binds to the loop current when it's created)
+    rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    # Retries are handled by prompt_model_with_retries, not the client
+    # openai takes most of a second to import, and runs served entirely from the
+    # translation memory or run manifest never need it
+    import openai
+    client = openai.AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+    semaphore = asyncio.Semaphore(concurrency)
+    completed_batches = 0
+    total_usage = {'prompt_tokens': 0, 'completion_tokens': 0, 'cost': 0}
+
+    async def prompt_batch(i):
+        async with semaphore:
+            start = time.perf_counter()
+            response, usage = await prompt_model_with_retries(client, model, SYSTEM_MESSAGE, prompts[i], rate_limiter, expected_tokens[i])
+            latency = time.perf_counter() - start
+        return i, response, usage, latency
+
+    try:
+        for task in asyncio.as_completed([prompt_batch(i) for i in range(len(prompts))]):
+            i, response, usage, latency = await task
+            completed_batches += 1
+            cost = (usage.prompt_tokens * TOKEN_COST_DICT[model]['input'] / 1000) + \
+                   (usage.completion_tokens * TOKEN_COST_DICT[model]['output'] / 1000)
+            total_usage['prompt_tokens'] += usage.prompt_tokens
+            total_usage['completion_tokens'] += usage.completion_tokens
+            total_usage['cost'] += cost
+            if metrics is not None:
+                metrics.api_call(latency, usage.prompt_tokens, usage.completion_tokens, cost)
+            if verbose:
+                print(f'\tFinished batch {i+1} ({completed_batches} of {len(prompts)} done). Cost so far: ${round(total_usage["cost"], 2)}', flush=True)
+            handle_response(i, response)
+    finally:
+        await client.close()
+
+    return total_usage
+
+async def prompt_model_with_retries(client, model, system_message, prompt, rate_limiter, expected_tokens):
+    import openai
+    for attempt in range(MAX_RETRIES + 1):
+        await rate_limiter.acquire(expected_tokens)
+        try:
+            completion = await client.chat.completions.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": system_message},
+                    {"role": "user", "content": prompt}
+                ]
+            )
+            return completion.choices[0].message.content, completion.usage
+        except (openai.RateLimitError, openai.APIStatusError, openai.APIConnectionError) as e:
+            status_code = getattr(e, 'status_code', None)
+            retryable = status_code is None or status_code == 429 or status_code >= 500
+            if not retryable or attempt == MAX_RETRIES:
+                raise
+            await asyncio.sleep(retry_delay(e, attempt))
+
+# Honours the server's Retry-After header if present, else exponential backoff with jitter
+def retry_delay(error, attempt):
+    response = getattr(error, 'response', None)
+    if response is not None:
+        try:
+            return float(response.headers.get('retry-after'))
+        except (TypeError, ValueError):
+            pass
+    return RETRY_BASE_DELAY * (2 ** attempt) * (1 + random.random())
+
+'''
+RateLimiter keeps requests under a requests-per-minute and a tokens-per-minute
+budget using two token buckets that refill continuously. A budget of None is
+unlimited. Create it inside the event loop that will use it.
+'''
+class RateLimiter:
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.available_requests = requests_per_minute
+        self.available_tokens = tokens_per_minute
+        self.last_refill = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens):
+        # A single request larger than the whole budget could never be sent otherwise
+        if self.tokens_per_minute is not None:
+            tokens = min(tokens, self.tokens_per_minute)
+        async with self.lock:
+            while True:
+                self.refill()
+                wait = max(self.wait_time(self.available_requests, 1, self.requests_per_minute),
+                           self.wait_time(self.available_tokens, tokens, self.tokens_per_minute))
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+
+            if self.requests_per_minute is not None:
+                self.available_requests -= 1
+            if self.tokens_per_minute is not None:
+                self.available_tokens -= tokens
 
-def prompt_model(client, model, system_message, prompt):
-    completion = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": system_message},
-            {"role": "user", "content": prompt}
-        ]
-    )
+    def refill(self):
+        now = time.monotonic()
+        elapsed_minutes = (now - self.last_refill) / 60
+        self.last_refill = now
+        if self.requests_per_minute is not None:
+            self.available_requests = min(self.requests_per_minute, self.available_requests + elapsed_minutes * self.requests_per_minute)
+        if self.tokens_per_minute is not None:
+            self.available_tokens = min(self.tokens_per_minute, self.available_tokens + elapsed_minutes * self.tokens_per_minute)
 
-    return completion.choices[0].message.content, completion.usage
+    # Seconds until `available` reaches `needed` at a refill rate of `per_minute`
+    @staticmethod
+    def wait_time(available, needed, per_minute):
+        if per_minute is None or available >= needed:
+            return 0
+        return (needed - available) * 60 / per_minute
 
 if __name__ == '__main__':
-    txt2pleco('transcript.txt', 'pleco_flashcards.txt', header='Qiaohu Ep.1', verbose=True)
\ No newline at end of file
+    from translation_memory import TranslationMemory
+    from run_manifest import RunManifest
+    memory = TranslationMemory()
+    # Re-running after a crash picks up from the last finished batch
+    manifest = RunManifest('pleco_flashcards')
+    dictionary = cedict.load_cedict() if os.path.exists(cedict.DEFAULT_CEDICT_FILE) else None
+    txt2pleco('transcript.txt', 'pleco_flashcards.txt', header='Qiaohu Ep.1', memory=memory, dictionary=dictionary, manifest=manifest, verbose=True)
+    manifest.close()
+    memory.close()
\ No newline at end of file
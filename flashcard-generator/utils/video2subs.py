@@ -1,77 +1,136 @@
-import os
-from datetime import timedelta
-
-import whisper
-import moviepy.editor as mp
 import numpy as np
-import torch
+
+import models
+from subs2txt import normalize_text
+from av2subs import AUDIO_SAMPLE_RATE, streamAudio, transcribeChunksInProcess
+
+'''
+video2subs transcribes the whole audio track of a video (or any file ffmpeg can
+read) into an .srt and optionally a .txt, without VAD:
+- ffmpeg decodes and resamples the track to 16kHz mono float32, which is read
+  one window at a time (av2subs.streamAudio)
+- Whisper transcribes windows of WINDOW_SECONDS that overlap by
+  OVERLAP_SECONDS, so speech cut off at the end of one window is heard whole
+  at the start of the next
+- each segment is kept by the window it sits in the middle of (the seam is
+  halfway through the overlap), and a segment repeated on both sides of a seam
+  is only written once, even if the two windows time or word it a little
+  differently
+- subtitles are written with millisecond timestamps as soon as their window is
+  done
+
+Only the current window is held in memory, so multi-hour videos don't use more
+memory than short ones.
+'''
 
 WHISPER_MODEL = 'tiny'
-INPUT_FILE = os.path.abspath('test_file.mp4')
+WHISPER_PROMPT = '以下为中文。'
+INPUT_FILE = 'test_file.mp4'
 OUTPUT_SRT_FILE = 'test.srt'
 OUTPUT_TXT_FILE = 'test.txt'
-LANGUAGE = 'zh'
-
-def main(input_file, output_srt_file, whisper_model, output_txt_file=None):
-    print('Loading audio', flush=True)
-    audio = loadAudio(input_file)[:5000]
-
-    print('Getting transcript', flush=True)
-    transcript = getTranscript(audio, whisper_model)
-
-    print('Saving to .srt file', flush=True)
-    saveTranscriptToSRT(transcript, output_srt_file)
-
-    if output_txt_file:
-        print('Saving to .txt file', flush=True)
-        saveTranscriptToTXT(transcript, output_txt_file)
-
-# loads audio track from input file
-def loadAudio(file):
-    video = mp.VideoFileClip(file)
-    audio = video.audio
-    audio.write_audiofile(INPUT_FILE[:-4] + "_audio.mp3")
-    audio_array = audio.to_soundarray()
-
-    video.close()
-    return audio_array.astype(np.float32)
-
-# using the audio track, uses whisper model to get transcription
-def getTranscript(audio, whisper_model):
-    torch.cuda.init()
-
-    # setting device on GPU if available, else CPU
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    print("device selected for transcription: " + device.type, flush=True)
-
-    model = whisper.load_model(whisper_model)
-    model = model.to(device)
-    
-    return model.transcribe(audio, language=LANGUAGE, verbose=True, fp16=False)
-
-# saves the transcript as an .srt file
-# heavy inspiration drawn from: https://github.com/openai/whisper/discussions/98#discussioncomment-3725983
-def saveTranscriptToSRT(transcript, output_file):
-    srt_file = open(output_file, 'w+', encoding='utf-8')
-    segments = transcript['segments']
-    
-    for segment in segments:
-        start_time = str(0)+str(timedelta(seconds=int(segment['start'])))+',000'
-        end_time = str(0)+str(timedelta(seconds=int(segment['end'])))+',000'
-        text = segment['text']
-        segmentId = segment['id']+1
-        segment = f"{segmentId}\n{start_time} --> {end_time}\n{text[1:] if text[0] == ' ' else text}\n\n"
-
-        srt_file.write(segment)
-
-# saves the transcript as a .txt file
-def saveTranscriptToTXT(transcript, output_file):
-    txt_file = open(output_file, 'w+', encoding='utf-8')
-    segments = transcript['segments']
-    
-    for segment in segments:
-        text = segment['text']
-        txt_file.write(text)
+# Whisper sees at most 30 seconds at once
+WINDOW_SECONDS = 30
+# Audio shared by consecutive windows
+OVERLAP_SECONDS = 5
+
+def main(input_file, output_srt_file, whisper_model, output_txt_file=None, whisper_prompt=WHISPER_PROMPT,
+         window_seconds=WINDOW_SECONDS, overlap_seconds=OVERLAP_SECONDS):
+    print("device selected for transcription: " + models.select_device(), flush=True)
+    print(f'Transcribing {input_file}', flush=True)
+
+    srt_file = open(output_srt_file, 'w', encoding='utf-8')
+    txt_file = open(output_txt_file, 'w', encoding='utf-8') if output_txt_file else None
+    try:
+        segments = transcribeStream(input_file, whisper_model, whisper_prompt, window_seconds, overlap_seconds)
+        for segment_id, segment in enumerate(segments, start=1):
+            srt_file.write(f"{segment_id}\n{srtTime(segment['start'])} --> {srtTime(segment['end'])}\n{segment['text']}\n\n")
+            srt_file.flush()
+            if txt_file:
+                txt_file.write(segment['text'] + '\n')
+                txt_file.flush()
+    finally:
+        srt_file.close()
+        if txt_file:
+            txt_file.close()
+
+'''
+transcribeStream yields the transcript of input_file as segments with 'start'
+and 'end' in seconds from the start of the input and 'text', in order.
+
+Segments whose midpoint falls past a window's seam are held back until the
+next window has been transcribed; the next window hears them with more context
+and replaces them. Only the last window's held-back segments are kept as they
+are.
+'''
+def transcribeStream(input_file, whisper_model, whisper_prompt, window_seconds=WINDOW_SECONDS, overlap_seconds=OVERLAP_SECONDS):
+    if overlap_seconds >= window_seconds:
+        raise Exception('The overlap must be shorter than the window')
+
+    previous = None      # last segment yielded
+    previous_seam = 0.0  # segments before this time were kept from the previous window
+    held_back = []
+    for window_start, window in overlappingWindows(input_file, window_seconds, overlap_seconds):
+        offset = window_start / AUDIO_SAMPLE_RATE
+        seam = offset + len(window) / AUDIO_SAMPLE_RATE - overlap_seconds / 2
+        print(f'\tTranscribing {offset:.0f}s-{offset + len(window) / AUDIO_SAMPLE_RATE:.0f}s', flush=True)
+
+        held_back = []
+        for segment in transcribeChunksInProcess([window], whisper_model, whisper_prompt, batch_size=1)[0]:
+            segment = {'start': offset + segment['start'], 'end': offset + segment['end'], 'text': segment['text']}
+            midpoint = (segment['start'] + segment['end']) / 2
+            if midpoint < previous_seam or isRepeat(segment, previous):
+                continue
+            if midpoint >= seam:
+                held_back.append(segment)
+                continue
+            previous = clampStart(segment, previous)
+            yield previous
+        previous_seam = seam
+
+    for segment in held_back:
+        if not isRepeat(segment, previous):
+            previous = clampStart(segment, previous)
+            yield previous
+
+'''
+overlappingWindows yields (start sample, samples) for windows of window_seconds
+that each start overlap_seconds before the previous one ended. The first
+window has no overlap to carry, so it is overlap_seconds shorter, and the last
+one is however much audio is left.
+'''
+def overlappingWindows(input_file, window_seconds=WINDOW_SECONDS, overlap_seconds=OVERLAP_SECONDS):
+    overlap_samples = int(overlap_seconds * AUDIO_SAMPLE_RATE)
+    tail = np.zeros(0, dtype=np.float32)
+    position = 0 # samples decoded so far
+    for block in streamAudio(input_file, window_seconds=window_seconds - overlap_seconds):
+        window = np.concatenate([tail, block])
+        yield position - len(tail), window
+        position += len(block)
+        tail = window[-overlap_samples:] if overlap_samples else tail
+
+# True if segment is the previous segment heard again on the other side of a seam: the two
+# overlap in time and one's text contains the other's, ignoring punctuation and spaces
+# (a window that hears more of the sentence may add a word or a full stop)
+def isRepeat(segment, previous):
+    if previous is None or segment['start'] >= previous['end']:
+        return False
+    text = normalize_text(segment['text'])
+    previous_text = normalize_text(previous['text'])
+    return bool(text and previous_text) and (text in previous_text or previous_text in text)
+
+# Keeps subtitles from overlapping where two windows' timings disagree slightly
+def clampStart(segment, previous):
+    if previous is not None and segment['start'] < previous['end']:
+        segment['start'] = min(previous['end'], segment['end'])
+    return segment
+
+# Seconds as an .srt timestamp, e.g. 3723.4567 -> 01:02:03,457
+def srtTime(seconds):
+    milliseconds = round(seconds * 1000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours:02}:{minutes:02}:{seconds:02},{milliseconds:03}'
 
 if __name__ == '__main__':
-    main(INPUT_FILE, OUTPUT_SRT_FILE, WHISPER_MODEL, output_txt_file=OUTPUT_TXT_FILE)
\ No newline at end of file
+    main(INPUT_FILE, OUTPUT_SRT_FILE, WHISPER_MODEL, output_txt_file=OUTPUT_TXT_FILE)